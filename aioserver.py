@@ -0,0 +1,229 @@
+import asyncio
+import socket
+import time
+from threading import Thread
+from framing import FRAME_HEADER, MAX_FRAME_SIZE
+from metrics import MeteredSocket, DROPPED
+from reliable import LossySocket
+from fragments import SOCKET_BUFFER
+from router import Router, FramedReply, legacy_complete
+
+
+class AsyncServer(Thread):
+    def __init__(self, tcp_port, udp_port, rooms, loss=0.0):
+        """
+        Create udp and tcp servers sharing one asyncio event loop
+        (dropping a loss share of the datagrams sent, see LossySocket)
+        """
+        Thread.__init__(self)
+        self.rooms = rooms
+        self.router = Router(rooms)
+        self.tcp_port = int(tcp_port)
+        self.udp_port = udp_port
+        self.loss = loss
+        self.transport = None
+        self.loop = asyncio.new_event_loop()
+        #  Directory changes of --workers wait for the relay workers :
+        #  routed in executor threads, so the event loop never blocks
+        self.offload = len(getattr(rooms, "workers", ())) != 0
+
+    def run(self):
+        """
+        Start the event loop until stop_listening is called
+        """
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start_servers())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.stop()
+
+    async def start_servers(self):
+        """
+        Bind udp endpoint (unless relayed by workers) and tcp listener
+        """
+        if self.udp_port is not None:
+            self.transport, protocol = await self.loop.create_datagram_endpoint(
+                lambda: UdpProtocol(self.router),
+                local_addr=("0.0.0.0", int(self.udp_port)))
+            sock = self.transport.get_extra_info("socket")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+            self.transport = MeteredSocket(UdpTransport(self.transport, protocol))
+            if self.loss:
+                self.transport = LossySocket(self.transport, self.loss)
+            protocol.transport = self.transport
+            self.loop.create_task(self.tick_rooms())
+        if self.rooms.matchmaker is not None:
+            self.loop.create_task(self.match_players())
+        self.tcp_server = await asyncio.start_server(self.handle_connection,
+                                                     "0.0.0.0",
+                                                     self.tcp_port,
+                                                     backlog=1024)
+
+    async def tick_rooms(self):
+        """
+        Drive periodic room work (tick rooms, reliable resends) on the
+        udp transport
+        """
+        while True:
+            try:
+                delay = self.rooms.tick(time.time(), self.transport)
+            except Exception as e:
+                print("Tick failed (%s)" % repr(e))
+                delay = None
+            if delay is None or delay > 0.5:
+                delay = 0.5
+            await asyncio.sleep(max(delay, 0))
+
+    async def match_players(self):
+        """
+        Form matches from the queued autojoin requests, one batch per
+        matchmaker interval (answers are written by the event loop)
+        """
+        while True:
+            try:
+                await self.call(self.router.matchmake, time.time())
+            except Exception as e:
+                print("Matchmaking failed (%s)" % repr(e))
+            await asyncio.sleep(self.rooms.matchmaker.interval)
+
+    async def call(self, function, *args):
+        """
+        Run routing code, in an executor thread when it may wait for
+        relay workers (see offload)
+        """
+        if self.offload:
+            return await self.loop.run_in_executor(None, function, *args)
+        return function(*args)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve a legacy one-shot request or a framed persistent session
+        """
+        addr = writer.get_extra_info("peername")[:2]
+        conn = StreamConnection(writer, self.loop if self.offload else None)
+        try:
+            first = await reader.read(1)
+            if first == b"{":
+                #  Legacy client : one json request per connection
+                data = first + await reader.read(1023)
+                #  Requests filling the first read may go on
+                while len(data) >= 1024 and not legacy_complete(data):
+                    chunk = await reader.read(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                await self.call(self.router.handle_tcp, conn, addr, data)
+                await writer.drain()
+                return
+
+            header = first + await reader.readexactly(FRAME_HEADER.size - 1)
+            while True:
+                length, request_id = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    break
+                body = await reader.readexactly(length)
+                await self.call(self.router.handle_tcp,
+                                FramedReply(conn, request_id),
+                                addr,
+                                body)
+                await writer.drain()
+                header = await reader.readexactly(FRAME_HEADER.size)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            pass  # Server shutdown
+        finally:
+            writer.close()
+
+    def stop_listening(self):
+        """
+        Ask the event loop to exit (thread safe)
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def stop(self):
+        """
+        Close sockets and event loop
+        """
+        if self.transport is not None:
+            self.transport.close()
+        self.tcp_server.close()
+        #  Persistent sessions are still waiting for requests
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks,
+                                                    return_exceptions=True))
+        self.loop.run_until_complete(self.tcp_server.wait_closed())
+        self.loop.close()
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, router):
+        """
+        Relay game datagrams through the router
+        """
+        self.router = router
+        self.transport = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+    def datagram_received(self, data, address):
+        try:
+            self.router.handle_udp(data, address, self.transport)
+        except Exception:
+            DROPPED.labels("error").inc()
+
+
+class UdpTransport:
+    def __init__(self, transport, protocol):
+        """
+        Datagram transport refusing sends while its buffer is over the
+        high-water mark, as a full non-blocking socket would
+        """
+        self.transport = transport
+        self.protocol = protocol
+
+    def sendto(self, data, addr):
+        if self.protocol.paused:
+            raise BlockingIOError()
+        self.transport.sendto(data, addr)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+class StreamConnection:
+    def __init__(self, writer, loop=None):
+        """
+        Socket-like wrapper so routing code can reply on a stream
+        (from other threads too when the loop of the stream is given)
+        """
+        self.writer = writer
+        self.loop = loop
+
+    def send(self, data):
+        """
+        Queue data on the stream
+        """
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        """
+        Queue data on the stream (writes are never partial)
+        """
+        if self.loop is None:
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
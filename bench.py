@@ -0,0 +1,488 @@
+#!/usr/bin/python
+
+import argparse
+import asyncio
+import json
+import random
+import socket
+import subprocess
+import sys
+import time
+from framing import FRAME_HEADER, pack_frame
+from wire import PREFIX, encode_request, decode_relay
+
+
+def percentile(values, q):
+    """
+    q quantile of values (None without values)
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class Results:
+
+    def __init__(self, name):
+        """
+        Measures of one scenario (latencies in seconds)
+        """
+        self.name = name
+        self.latencies = []
+        self.count = 0
+        self.errors = 0
+        self.elapsed = 0
+        self.extra = {}
+
+    def report(self):
+        """
+        Scenario summary : throughput, p50/p99 latency in milliseconds
+        """
+        p50 = percentile(self.latencies, 0.5)
+        p99 = percentile(self.latencies, 0.99)
+        report = {"scenario": self.name,
+                  "count": self.count,
+                  "errors": self.errors,
+                  "seconds": round(self.elapsed, 3),
+                  "per_second": round(self.count / self.elapsed, 1) if self.elapsed else None,
+                  "p50_ms": round(p50 * 1000, 3) if p50 is not None else None,
+                  "p99_ms": round(p99 * 1000, 3) if p99 is not None else None}
+        report.update(self.extra)
+        return report
+
+
+class BotProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        """
+        Udp endpoint of a bot, measuring the relayed messages it gets
+        (bench messages carry their send time under "t")
+        """
+        self.results = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.results is None:
+            return
+        now = time.time()
+        try:
+            if data[:1] == PREFIX:
+                messages = [json.loads(payload) for session, payload, seq
+                            in decode_relay(data)]
+            else:
+                envelope = json.loads(data)
+                envelope.pop("seq", None)
+                messages = envelope.values()
+        except ValueError:
+            self.results.errors += 1
+            return
+        for message in messages:
+            if not isinstance(message, dict) or "t" not in message:
+                continue
+            self.results.count += 1
+            self.results.latencies.append(now - message["t"])
+
+
+class Bot:
+
+    def __init__(self, host, tcp_port, udp_port, binary=False):
+        """
+        Lightweight client speaking the real protocol : framed tcp
+        control requests and udp messages (json or binary), no thread
+        nor receive queue
+        """
+        self.server_tcp = (host, int(tcp_port))
+        self.server_udp = (host, int(udp_port))
+        self.binary = binary
+        self.identifier = None
+        self.session = None
+        self.room_id = None
+        self.room_session = None
+        self.request_id = 0
+        self.sequence = 0
+        self.reader = None
+        self.writer = None
+        self.protocol = None
+        #  Bots may run several scenarios requests at once : responses
+        #  are read by one of them at a time
+        self.lock = asyncio.Lock()
+
+    async def connect(self, loop):
+        """
+        Open the udp endpoint and the tcp control connection
+        """
+        transport, self.protocol = await loop.create_datagram_endpoint(
+            BotProtocol,
+            local_addr=("127.0.0.1", 0))
+        self.reader, self.writer = await asyncio.open_connection(*self.server_tcp)
+        sock = self.writer.get_extra_info("socket")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    async def pipeline(self, messages):
+        """
+        Send control requests at once, return their messages in order
+        """
+        async with self.lock:
+            data = b""
+            for message in messages:
+                message["identifier"] = self.identifier
+                self.request_id += 1
+                data += pack_frame(self.request_id, json.dumps(message).encode())
+            self.writer.write(data)
+            responses = []
+            for message in messages:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+                length, request_id = FRAME_HEADER.unpack(header)
+                responses.append(json.loads(await self.reader.readexactly(length)))
+
+        for response in responses:
+            if response["success"] != "True":
+                raise Exception("Request failed : %s" % response["message"])
+            if "udp_port" in response:
+                #  Room relayed by a worker process
+                self.server_udp = (self.server_udp[0], int(response["udp_port"]))
+            if "session" in response:
+                self.session = response["session"]
+            if "room_session" in response:
+                self.room_session = response["room_session"]
+        return [response["message"] for response in responses]
+
+    async def request(self, message, results=None):
+        """
+        Send a control request and wait for its message (timed in results)
+        """
+        start = time.perf_counter()
+        try:
+            response = (await self.pipeline([message]))[0]
+        except Exception:
+            if results is None:
+                raise
+            results.errors += 1
+            return None
+        if results is not None:
+            results.latencies.append(time.perf_counter() - start)
+            results.count += 1
+        return response
+
+    async def register(self, results=None):
+        """
+        Register with the port of our udp endpoint
+        """
+        payload = self.protocol.transport.get_extra_info("sockname")[1]
+        if self.binary:
+            payload = {"udp_port": payload, "protocol": "binary"}
+        self.identifier = await self.request({"action": "register",
+                                              "payload": payload},
+                                             results)
+
+    def send(self, recipients=None):
+        """
+        Send a timestamped message to the room (or to recipients bots)
+        """
+        self.sequence += 1
+        body = json.dumps({"t": time.time(), "n": self.sequence}).encode()
+        if self.room_session is not None:
+            if recipients is not None:
+                recipients = [recipient.session for recipient in recipients]
+            self.protocol.transport.sendto(encode_request(self.session,
+                                                          self.room_session,
+                                                          None,
+                                                          body,
+                                                          recipients),
+                                           self.server_udp)
+            return
+        header = {"action": "send",
+                  "room_id": self.room_id,
+                  "identifier": self.identifier}
+        if recipients is not None:
+            header["action"] = "sendto"
+            header["payload"] = {"recipients": [recipient.identifier
+                                                for recipient in recipients]}
+        self.protocol.transport.sendto(json.dumps(header).encode() + b"\n" + body,
+                                       self.server_udp)
+
+    def close(self):
+        """
+        Close both sockets
+        """
+        if self.writer is not None:
+            self.writer.close()
+        if self.protocol is not None and self.protocol.transport is not None:
+            self.protocol.transport.close()
+
+
+class Bench:
+
+    def __init__(self, args):
+        """
+        Run the scenarios against one server, in order : register storm,
+        autojoin storm (rooms filled to the server capacity), get_rooms
+        on a large room table, then steady-state relay in those rooms
+        """
+        self.args = args
+        self.bots = []
+        self.results = []
+
+    async def storm(self, requests):
+        """
+        Run coroutines with at most concurrency of them at once, return
+        the elapsed time
+        """
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(request):
+            async with semaphore:
+                await request
+
+        start = time.perf_counter()
+        await asyncio.gather(*[limited(request) for request in requests])
+        return time.perf_counter() - start
+
+    async def run(self):
+        """
+        Connect the clients and run every scenario
+        """
+        loop = asyncio.get_running_loop()
+        for bot_index in range(self.args.clients):
+            self.bots.append(Bot(self.args.host,
+                                 self.args.tcp_port,
+                                 self.args.udp_port,
+                                 self.args.protocol == "binary"))
+        try:
+            await self.storm([bot.connect(loop) for bot in self.bots])
+
+            results = Results("register")
+            results.elapsed = await self.storm([bot.register(results) for bot in self.bots])
+            self.results.append(results)
+
+            results = Results("autojoin")
+            self.bots = [bot for bot in self.bots if bot.identifier is not None]
+            results.elapsed = await self.storm([self.autojoin(bot, results)
+                                                for bot in self.bots])
+            results.extra["rooms"] = len(set(bot.room_id for bot in self.bots))
+            self.results.append(results)
+
+            await self.get_rooms()
+            await self.relay()
+        finally:
+            for bot in self.bots:
+                bot.close()
+
+    async def autojoin(self, bot, results):
+        """
+        Join the first non-full room (timed in results)
+        """
+        bot.room_id = await bot.request({"action": "autojoin"}, results)
+
+    async def get_rooms(self):
+        """
+        Add extra rooms then time get_rooms queries on every bot
+        """
+        creator = self.bots[0]
+        #  Creating a room joins it : the creator keeps relaying to its
+        #  own room (and worker) afterwards
+        server_udp = creator.server_udp
+        room_session = creator.room_session
+        for start in range(0, self.args.extra_rooms, 100):
+            count = min(100, self.args.extra_rooms - start)
+            await creator.pipeline([{"action": "create",
+                                     "payload": "bench-%d" % (start + index)}
+                                    for index in range(count)])
+        creator.server_udp = server_udp
+        creator.room_session = room_session
+
+        results = Results("get_rooms")
+        queries = [self.bots[index % len(self.bots)].request({"action": "get_rooms"},
+                                                              results)
+                   for index in range(self.args.queries)]
+        results.elapsed = await self.storm(queries)
+        rooms = await self.bots[0].request({"action": "get_rooms"})
+        results.extra["rooms"] = len(rooms)
+        self.results.append(results)
+
+    async def relay(self):
+        """
+        Every bot sends rate messages per second for duration seconds,
+        to its room or (sendto share of them) to one room member
+        """
+        if self.args.duration <= 0:
+            return
+        results = Results("relay")
+        rooms = {}
+        for bot in self.bots:
+            rooms.setdefault(bot.room_id, []).append(bot)
+            bot.protocol.results = results
+
+        expected = [0]
+        sent = [0]
+
+        async def sender(bot, members):
+            interval = 1.0 / self.args.rate
+            deadline = time.perf_counter() + self.args.duration
+            await asyncio.sleep(random.random() * interval)
+            while time.perf_counter() < deadline:
+                others = [member for member in members if member is not bot]
+                if len(others) != 0 and random.random() < self.args.sendto:
+                    bot.send([random.choice(others)])
+                    expected[0] += 1
+                else:
+                    bot.send()
+                    expected[0] += len(others)
+                sent[0] += 1
+                await asyncio.sleep(interval)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[sender(bot, members)
+                               for members in rooms.values()
+                               for bot in members])
+        await asyncio.sleep(self.args.drain)
+        results.elapsed = time.perf_counter() - start
+        results.extra["sent"] = sent[0]
+        results.extra["expected"] = expected[0]
+        results.extra["loss"] = round(1 - results.count / expected[0], 4) if expected[0] else None
+        self.results.append(results)
+
+
+def start_server(args):
+    """
+    Start a local server.py for the bench, wait until it accepts
+    """
+    command = [sys.executable, "server.py",
+               "--tcpport", str(args.tcp_port),
+               "--udpport", str(args.udp_port),
+               "--capacity", str(args.room_size),
+               "--tick-rate", str(args.tick_rate),
+               "--idle-timeout", "0"] + args.server_args.split()
+    server = subprocess.Popen(command,
+                              stdin=subprocess.PIPE,
+                              stdout=subprocess.DEVNULL)
+    for attempt in range(100):
+        try:
+            socket.create_connection((args.host, args.tcp_port), 0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise Exception("Server did not start")
+
+
+def stop_server(server):
+    """
+    Quit the started server (stopping its relay workers too)
+    """
+    try:
+        server.communicate(b"quit\n", timeout=10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+if __name__ == "__main__":
+    """
+    Load-generation bench : report throughput, p50/p99 latency and loss
+    """
+    parser = argparse.ArgumentParser(description='Simple game server bench')
+    parser.add_argument('--host',
+                        dest='host',
+                        help='Server host',
+                        default="127.0.0.1")
+    parser.add_argument('--tcpport',
+                        dest='tcp_port',
+                        help='Server tcp port',
+                        type=int,
+                        default=1234)
+    parser.add_argument('--udpport',
+                        dest='udp_port',
+                        help='Server udp port',
+                        type=int,
+                        default=1234)
+    parser.add_argument('--external',
+                        dest='external',
+                        help='Bench a running server instead of starting server.py',
+                        action='store_true')
+    parser.add_argument('--server-args',
+                        dest='server_args',
+                        help='Extra server.py arguments (ex: "--mode asyncio")',
+                        default="")
+    parser.add_argument('--clients',
+                        dest='clients',
+                        help='Simulated clients',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--concurrency',
+                        dest='concurrency',
+                        help='Control requests in flight during storms',
+                        type=int,
+                        default=200)
+    parser.add_argument('--room-size',
+                        dest='room_size',
+                        help='Room capacity of the started server (players per relay room)',
+                        type=int,
+                        default=8)
+    parser.add_argument('--extra-rooms',
+                        dest='extra_rooms',
+                        help='Rooms created before the get_rooms scenario',
+                        type=int,
+                        default=5000)
+    parser.add_argument('--queries',
+                        dest='queries',
+                        help='get_rooms requests',
+                        type=int,
+                        default=200)
+    parser.add_argument('--rate',
+                        dest='rate',
+                        help='Messages per second sent by each client',
+                        type=float,
+                        default=10)
+    parser.add_argument('--sendto',
+                        dest='sendto',
+                        help='Share of messages sent to one room member instead of the room',
+                        type=float,
+                        default=0.1)
+    parser.add_argument('--tick-rate',
+                        dest='tick_rate',
+                        help='Room tick rate of the started server (tick rooms relay the latest message only, the others count as lost)',
+                        type=float,
+                        default=0)
+    parser.add_argument('--duration',
+                        dest='duration',
+                        help='Seconds of relay traffic (0 skips it)',
+                        type=float,
+                        default=10)
+    parser.add_argument('--drain',
+                        dest='drain',
+                        help='Seconds waited for late messages after the relay traffic',
+                        type=float,
+                        default=1)
+    parser.add_argument('--protocol',
+                        dest='protocol',
+                        help='Wire protocol of the clients',
+                        choices=["json", "binary"],
+                        default="json")
+    parser.add_argument('--json',
+                        dest='json',
+                        help='Print results as json',
+                        action='store_true')
+
+    args = parser.parse_args()
+    server = None
+    if not args.external:
+        server = start_server(args)
+    try:
+        bench = Bench(args)
+        asyncio.run(bench.run())
+    finally:
+        if server is not None:
+            stop_server(server)
+
+    if args.json:
+        print(json.dumps([results.report() for results in bench.results]))
+    else:
+        for results in bench.results:
+            report = results.report()
+            print("%-10s %s" % (report.pop("scenario"),
+                                ", ".join("%s %s" % item for item in report.items())))
@@ -1,145 +1,484 @@
+import asyncio
+import itertools
 import json
+import struct
+import time
+from collections import OrderedDict
 import threading
 import socket
+from reliable import ReliableChannel, LossySocket, RESEND_DELAY
+from wire import MAGIC, PREFIX, FRAGMENT_PREFIX, encode_request, decode_relay, \
+    encode_relay, decode_fragment, single_value
+from fragments import FRAGMENT_SIZE, SOCKET_BUFFER, Reassembler, split
+from framing import FRAME_HEADER, MAX_FRAME_SIZE, pack_frame, recv_frame
 
+#  Delta room states kept per sender to rebuild the next ones
+DELTA_WINDOW = 32
 
-class Client:
+#  Seconds without control request before telling server we are alive
+HEARTBEAT_INTERVAL = 5.0
 
-    def __init__(self,
-                 server_host,
-                 server_port_tcp=1234,
-                 server_port_udp=1234,
-                 client_port_udp=1235):
+
+class RingBuffer:
+
+    def __init__(self, capacity=256, slot_size=4096, drop_policy="drop_oldest"):
+        """
+        Bounded receive queue : datagrams are received straight into
+        preallocated slots (drop_oldest or drop_newest when full)
+        """
+        if drop_policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError("Unknown drop policy %s" % drop_policy)
+        self.capacity = int(capacity)
+        self.slot_size = int(slot_size)
+        self.drop_policy = drop_policy
+        self.buffer = bytearray(self.capacity * self.slot_size)
+        self.view = memoryview(self.buffer)
+        self.lengths = [0] * self.capacity
+        self.rebuilt = {}
+        self.scratch = memoryview(bytearray(self.slot_size))
+        self.head = 0
+        self.count = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Index of the slot the next datagram goes to (None when the queue
+        is full : the datagram goes to scratch space until commit)
+        """
+        self.lock.acquire()
+        try:
+            if self.count == self.capacity:
+                return None
+            return (self.head + self.count) % self.capacity
+        finally:
+            self.lock.release()
+
+    def slot(self, index):
+        """
+        Writable view of a slot (scratch space when the queue is full)
+        """
+        if index is None:
+            return self.scratch
+        start = index * self.slot_size
+        return self.view[start:start + self.slot_size]
+
+    def contains(self, index, length, pattern):
+        """
+        Check if the datagram received in a slot holds pattern
+        """
+        if index is None:
+            return self.scratch.obj.find(pattern, 0, length) != -1
+        start = index * self.slot_size
+        return self.buffer.find(pattern, start, start + length) != -1
+
+    def put(self, data):
         """
-        Create a game server client
+        Queue a datagram built elsewhere (e.g. released in order by
+        the reliable channel)
+        """
+        self.commit(self.reserve(), len(data), data)
+
+    def commit(self, index, length, rebuilt=None):
+        """
+        Queue the datagram received in a slot, applying the drop policy
+        to datagrams received in scratch space
+        (rebuilt replaces its content, e.g. rebuilt delta states)
+        """
+        self.lock.acquire()
+        try:
+            if index is None:
+                if self.count == self.capacity:
+                    self.dropped += 1
+                    if self.drop_policy == "drop_newest":
+                        return
+                    self.rebuilt.pop(self.head, None)
+                    self.head = (self.head + 1) % self.capacity
+                    self.count -= 1
+                index = (self.head + self.count) % self.capacity
+                if rebuilt is None:
+                    self.slot(index)[:length] = self.scratch[:length]
+            self.lengths[index] = length
+            if rebuilt is not None:
+                self.rebuilt[index] = rebuilt
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def drain(self):
+        """
+        Pop every queued datagram, in arrival order
+        """
+        self.lock.acquire()
+        try:
+            messages = []
+            for offset in range(self.count):
+                index = (self.head + offset) % self.capacity
+                data = self.rebuilt.pop(index, None)
+                if data is None:
+                    start = index * self.slot_size
+                    data = bytes(self.view[start:start + self.lengths[index]])
+                messages.append(data)
+            self.head = (self.head + self.count) % self.capacity
+            self.count = 0
+        finally:
+            self.lock.release()
+        return messages
+
+
+class Redirect(Exception):
+    def __init__(self, node, room_id):
+        """
+        The room lives on another server node
+        """
+        Exception.__init__(self, room_id)
+        self.node = node
+        self.room_id = room_id
+
+
+class BaseClient:
+
+    def __init__(self, server_host, server_port_tcp, server_port_udp,
+                 client_port_udp, protocol, sequenced=False):
+        """
+        Game server protocol state, requests building and datagrams
+        decoding, whatever drives the sockets (see Client and AsyncClient)
         """
         self.identifier = None
-        self.server_message = []
+        #  Proves the identifier is ours when registering again
+        self.token = None
+        self.protocol = protocol
+        #  Sequenced clients number their messages and drop stale ones
+        self.sequenced = sequenced
+        self.sequence = itertools.count(1)
+        self.last_seq = {}
+        #  Binary protocol : our session, the room one, players sessions
+        self.session = None
+        self.room_session = None
+        self.peers = {}
+        self.sessions = {}
+        self.reliable = ReliableChannel()
         self.room_id = None
         self.client_udp = ("0.0.0.0", client_port_udp)
-        self.lock = threading.Lock()
-        self.server_listener = SocketThread(self.client_udp,
-                                            self,
-                                            self.lock)
-        self.server_listener.start()
         self.server_udp = (server_host, server_port_udp)
         self.server_tcp = (server_host, server_port_tcp)
+        self.delta_states = {}
+        self.request_id = 0
+        self.last_request = time.time()
+        #  Large messages are sent in fragments, see fragments
+        self.message_ids = itertools.count(1)
+        self.fragments = Reassembler()
+        #  Room listing kept up to date by get_rooms : filters, version, rooms
+        self.listing_filters = None
+        self.listing_version = None
+        self.listing = OrderedDict()
 
-        self.register()
+    def create_request(self, room_name, tick_rate, delta, interest_radius):
+        """
+        Create room request (options only sent when set)
+        """
+        payload = room_name
+        if tick_rate is not None or delta or interest_radius is not None:
+            payload = {"name": room_name,
+                       "tick_rate": tick_rate,
+                       "delta": delta,
+                       "interest_radius": interest_radius}
+        return {"action": "create", "payload": payload, "identifier": self.identifier}
 
-    def create_room(self, room_name=None):
+    def autojoin_request(self, region, rating, party, party_size):
         """
-        Create a new room on server
+        Autojoin request (matchmaking criteria only sent when set)
         """
-        message = json.dumps({"action": "create", "payload": room_name, "identifier": self.identifier})
-        self.sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock_tcp.connect(self.server_tcp)
-        self.sock_tcp.send(message.encode())
-        data = self.sock_tcp.recv(1024)
-        self.sock_tcp.close()
-        message = self.parse_data(data)
-        self.room_id = message
+        message = {"action": "autojoin", "identifier": self.identifier}
+        if region is not None or rating is not None or party is not None:
+            message["payload"] = {"region": region,
+                                  "rating": rating,
+                                  "party": party,
+                                  "party_size": party_size}
+        return message
 
-    def join_room(self, room_id):
+    def rooms_request(self, not_full, prefix, capacity):
         """
-        Join an existing room
+        Get rooms request, asking for the changes since our listing
+        when it was built with the same filters
         """
-        self.room_id = room_id
-        message = json.dumps({"action": "join", "payload": room_id, "identifier": self.identifier})
-        self.sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock_tcp.connect(self.server_tcp)
-        self.sock_tcp.send(message.encode())
-        data = self.sock_tcp.recv(1024)
-        self.sock_tcp.close()
-        message = self.parse_data(data)
-        self.room_id = message
+        filters = {"not_full": not_full, "prefix": prefix, "capacity": capacity}
+        query = dict(filters)
+        if filters == self.listing_filters and self.listing_version is not None:
+            query["since"] = self.listing_version
+        return filters, {"action": "get_rooms",
+                         "payload": query,
+                         "identifier": self.identifier}
 
-    def autojoin(self):
+    def update_listing(self, filters, answer):
         """
-        Join the first non-full room
+        Apply a get_rooms answer to our listing, return its rooms
         """
-        message = json.dumps({"action": "autojoin", "identifier": self.identifier})
-        self.sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock_tcp.connect(self.server_tcp)
-        self.sock_tcp.send(message.encode())
-        data = self.sock_tcp.recv(1024)
-        self.sock_tcp.close()
-        message = self.parse_data(data)
-        self.room_id = message
+        if answer["modified"]:
+            if not answer["delta"]:
+                self.listing = OrderedDict()
+            for room in answer["rooms"]:
+                self.listing[room["id"]] = room
+            for room_id in answer.get("removed", ()):
+                self.listing.pop(room_id, None)
+            self.listing_filters = filters
+            self.listing_version = answer["version"]
+        return list(self.listing.values())
 
-    def leave_room(self):
+    def page_request(self, offset, limit, not_full, prefix, capacity):
         """
-        Leave the current room
+        Get rooms request for one page
         """
-        message = json.dumps({
-            "action": "leave",
-            "room_id": self.room_id,
-            "identifier": self.identifier
-        })
-        self.sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock_tcp.connect(self.server_tcp)
-        self.sock_tcp.send(message.encode())
-        data = self.sock_tcp.recv(1024)
-        self.sock_tcp.close()
-        message = self.parse_data(data)
-
-    def get_rooms(self):
-        """
-        Get the list of remote rooms
-        """
-        message = json.dumps({"action": "get_rooms", "identifier": self.identifier})
-        self.sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock_tcp.connect(self.server_tcp)
-        self.sock_tcp.send(message.encode())
-        data = self.sock_tcp.recv(1024)
-        self.sock_tcp.close()
-        message = self.parse_data(data)
-        return message
+        return {"action": "get_rooms",
+                "payload": {"offset": offset,
+                            "limit": limit,
+                            "not_full": not_full,
+                            "prefix": prefix,
+                            "capacity": capacity},
+                "identifier": self.identifier}
 
-    def send(self, message):
+    def send(self, message, position=None, reliable=False):
         """
         Send data to all players in the same room
+        (position is our (x, y) position in interest rooms, reliable
+        messages are resent until received and delivered in order)
         """
-        message = json.dumps({
+        header = {
             "action": "send",
-            "payload": {"message": message},
             "room_id": self.room_id,
             "identifier": self.identifier
-        })
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(message.encode(), self.server_udp)
+        }
+        if position is not None:
+            header["position"] = list(position)
+        self.send_udp(header, message, reliable)
 
-    def sendto(self, recipients, message):
+    def sendto(self, recipients, message, reliable=False):
         """
         Send data to one or more player in room
+        (reliable messages are resent until received and delivered in order)
         """
-        message = json.dumps({
+        header = {
             "action": "sendto",
             "payload": {
-                "recipients": recipients,
-                "message": message
+                "recipients": recipients
             },
             "room_id": self.room_id,
             "identifier": self.identifier
-        })
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(message.encode(), self.server_udp)
+        }
+        self.send_udp(header, message, reliable)
 
-    def register(self):
+    def send_udp(self, header, message, reliable=False):
         """
-        Register the client to server and get a uniq identifier
+        Send a json header and the message, which the server relays as
+        is (reliable messages are numbered by the reliable channel, others
+        by sequenced clients, binary clients send a binary header when
+        they know every session, messages over FRAGMENT_SIZE bytes are
+        sent in fragments)
+        """
+        body = json.dumps(message).encode()
+        if self.sequenced and not reliable:
+            header["seq"] = next(self.sequence)
+        parts = [(header, body)]
+        if len(body) > FRAGMENT_SIZE:
+            fragments = split(body)
+            message_id = next(self.message_ids)
+            parts = [(dict(header, fragment=[message_id, index, len(fragments)]), fragment)
+                     for index, fragment in enumerate(fragments)]
+        if reliable:
+            now = time.time()
+            for header, body in parts:
+                seq = self.reliable.push((header, body), now)
+                if seq is not None:
+                    self.send_reliable(seq, header, body)
+            return
+        for header, body in parts:
+            data = None
+            if self.room_session is not None:
+                data = self.encode_binary(header, body)
+            if data is None:
+                data = json.dumps(header).encode() + b"\n" + body
+            self.sock_udp.sendto(data, self.server_udp)
+
+    def encode_binary(self, header, body):
+        """
+        Binary form of a send or sendto request (None while the session
+        of a recipient is unknown)
+        """
+        recipients = None
+        if header["action"] == "sendto":
+            recipients = header["payload"]["recipients"]
+            if isinstance(recipients, str):
+                recipients = [recipients]
+            try:
+                recipients = [self.sessions[recipient] for recipient in recipients]
+            except KeyError:
+                return None
+        return encode_request(self.session,
+                              self.room_session,
+                              header.get("seq"),
+                              body,
+                              recipients,
+                              header.get("position"),
+                              header.get("fragment"))
+
+    def send_reliable(self, seq, header, body):
+        """
+        Send a reliable message with our current acks
+        """
+        header["reliable"] = self.reliable_header(seq)
+        data = json.dumps(header).encode() + b"\n" + body
+        self.sock_udp.sendto(data, self.server_udp)
+
+    def reliable_header(self, seq):
+        """
+        [seq, ack, bits, epoch] of a reliable datagram (without epoch
+        when server gave none)
+        """
+        header = [seq] + self.reliable.acks()
+        if self.reliable.epoch:
+            header.append(self.reliable.epoch)
+        return header
+
+    def receive_reliable(self, data):
+        """
+        Handle a reliable datagram from server, return the messages
+        now deliverable in order (server channel of another epoch, e.g.
+        restarted server : ours starts over, datagrams of epochs we
+        left are ignored)
+        """
+        newline = data.find(b"\n")
+        header = json.loads(data[:newline])["__reliable__"]
+        seq, ack, bits = header[:3]
+        if len(header) > 3:
+            if header[3] in self.reliable.retired:
+                return []
+            if header[3] != self.reliable.epoch:
+                self.reliable.reset(header[3])
+        self.reliable.acknowledge(ack, bits)
+        if seq == 0:
+            return []
+        messages = self.reliable.receive(seq, data[newline + 1:])
+        header = {
+            "reliable": self.reliable_header(0),
+            "identifier": self.identifier
+        }
+        self.sock_udp.sendto(json.dumps(header).encode(), self.server_udp)
+        return messages
+
+    def resend(self, now):
         """
-        message = json.dumps({
+        Resend the reliable messages server did not acknowledge in time
+        (and send the ones held by a full window)
+        """
+        for seq, (header, body) in self.reliable.due(now):
+            self.send_reliable(seq, header, body)
+
+    def register_request(self):
+        """
+        Register request (sessions of a previous registration are reset)
+        """
+        payload = self.client_udp[1]
+        if self.protocol == "binary" or self.sequenced or self.token is not None:
+            payload = {"udp_port": payload, "protocol": self.protocol}
+            if self.sequenced:
+                payload["sequenced"] = True
+            if self.token is not None:
+                payload["token"] = self.token
+        self.session = None
+        self.room_session = None
+        return {
             "action": "register",
-            "payload": self.client_udp[1]
-        })
-        self.sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock_tcp.connect(self.server_tcp)
-        self.sock_tcp.send(message.encode())
-        data = self.sock_tcp.recv(1024)
-        self.sock_tcp.close()
-        message = self.parse_data(data)
-        self.identifier = message
+            "payload": payload,
+            "identifier": self.identifier
+        }
+
+    def bind(self):
+        """
+        Tell the udp endpoint of the server where our datagrams come
+        from, through a NAT or not (once registered)
+        """
+        if self.token is None or self.sock_udp is None:
+            return
+        message = {"action": "bind", "identifier": self.identifier, "payload": self.token}
+        self.sock_udp.sendto(json.dumps(message).encode(), self.server_udp)
+
+    def learn(self, sessions):
+        """
+        Record players sessions ({identifier: session})
+        """
+        for identifier, session in sessions.items():
+            self.peers[session] = identifier
+            self.sessions[identifier] = session
+
+    def reassemble(self, data):
+        """
+        Relayed datagram of a message sent in fragments, once its last
+        fragment arrived (None until then, other datagrams are returned
+        unchanged)
+        """
+        if data[:1] == FRAGMENT_PREFIX:
+            session, seq, message_id, index, count, fragment = decode_fragment(data)
+            message = self.fragments.add((session, message_id), index, count,
+                                         fragment, time.time())
+            if message is None:
+                return None
+            return encode_relay([(session, message, seq)])
+        if data[:16] != b'{"__fragment__":':
+            return data
+        newline = data.find(b"\n")
+        sender, seq, message_id, index, count = json.loads(data[:newline])["__fragment__"]
+        message = self.fragments.add((sender, message_id), index, count,
+                                     data[newline + 1:], time.time())
+        #  Spliced in the envelope : a forged message could pose as others
+        if message is None or not single_value(message):
+            return None
+        sequences = b""
+        if seq is not None:
+            sequences = b'"seq": ' + json.dumps({sender: seq}).encode() + b", "
+        return b"{" + sequences + json.dumps(sender).encode() + b": " + message + b"}"
+
+    def rebuild(self, data):
+        """
+        Rebuild full states from a delta room datagram and acknowledge
+        them (None if nothing could be rebuilt)
+        """
+        envelope = json.loads(data)
+        acks = {}
+        for sender, value in list(envelope.items()):
+            if not isinstance(value, dict) or "__delta__" not in value:
+                continue
+            seq, base, changed, removed = value["__delta__"]
+            states = self.delta_states.setdefault(sender, OrderedDict())
+            if base == 0:
+                state = changed
+            elif base in states:
+                state = dict(states[base])
+                state.update(changed)
+                for key in removed:
+                    state.pop(key, None)
+            else:
+                #  Baseline lost, the server resends a full state
+                #  until a newer state is acknowledged
+                del envelope[sender]
+                continue
+            states[seq] = state
+            if len(states) > DELTA_WINDOW:
+                states.popitem(last=False)
+            acks[sender] = seq
+            envelope[sender] = state
+
+        if len(acks) != 0:
+            message = json.dumps({
+                "action": "ack",
+                "payload": acks,
+                "room_id": self.room_id,
+                "identifier": self.identifier
+            })
+            self.sock_udp.sendto(message.encode(), self.server_udp)
+        if len(envelope) == 0 or list(envelope) == ["seq"]:
+            return None
+        return json.dumps(envelope).encode()
 
     def parse_data(self, data):
         """
@@ -148,43 +487,435 @@ class Client:
         try:
             data = json.loads(data)
             if data['success'] == "True":
+                #  New udp endpoint, or new registration : bind to it
+                rebind = "udp_port" in data or "token" in data
+                if "udp_port" in data:
+                    #  Room relayed by another server worker
+                    self.server_udp = (self.server_udp[0], int(data["udp_port"]))
+                if "epoch" in data:
+                    #  Registered : server reliable channel starts over too
+                    self.reliable.reset(data["epoch"])
+                if "token" in data:
+                    self.token = data["token"]
+                if "session" in data:
+                    self.session = data["session"]
+                if "room_session" in data:
+                    self.room_session = data["room_session"]
+                if "sessions" in data:
+                    self.learn(data["sessions"])
+                if rebind:
+                    self.bind()
                 return data['message']
+            elif "redirect" in data:
+                raise Redirect(data["redirect"], data["message"])
             else:
                 raise Exception(data['message'])
         except ValueError:
             print(data)
 
+    def relay_envelope(self, entries):
+        """
+        Json envelope of binary relayed entries from known sessions
+        """
+        sequences = {}
+        messages = {}
+        for session, payload, seq in entries:
+            sender = self.peers.get(session)
+            if sender is None:
+                continue  # Player gone
+            if seq is not None:
+                sequences[sender] = seq
+            messages[sender] = json.loads(payload)
+        envelope = {}
+        if len(sequences) != 0:
+            envelope["seq"] = sequences
+        envelope.update(messages)
+        return envelope
+
+    def envelope_updates(self, envelope):
+        """
+        Messages of an envelope as (sender, seq, message), seq is the
+        sender reliable channel sequence number of reliable messages
+        (None for the others), or for sequenced clients the sender
+        sequence number of unreliable messages (None for reliable ones),
+        messages older than the last one seen from the same sender are
+        then skipped
+        """
+        sequences = envelope.pop("seq", {})
+        if not self.sequenced:
+            return [(sender, sequences.get(sender), message)
+                    for sender, message in envelope.items()]
+        updates = []
+        for sender, message in envelope.items():
+            seq = sequences.get(sender)
+            if seq is not None:
+                if seq <= self.last_seq.get(sender, 0):
+                    continue
+                self.last_seq[sender] = seq
+            updates.append((sender, seq, message))
+        return updates
+
+
+class Client(BaseClient):
+
+    def __init__(self,
+                 server_host,
+                 server_port_tcp=1234,
+                 server_port_udp=1234,
+                 client_port_udp=1235,
+                 queue_size=256,
+                 slot_size=4096,
+                 drop_policy="drop_oldest",
+                 loss=0.0,
+                 protocol="json",
+                 sequenced=False):
+        """
+        Create a game server client (received datagrams wait in a queue
+        of queue_size slots of slot_size bytes, see RingBuffer, loss is
+        the share of udp datagrams dropped on purpose, see LossySocket,
+        protocol "binary" asks server for the binary wire protocol,
+        sequenced clients number the messages they send and skip stale
+        ones, see envelope_updates)
+        """
+        BaseClient.__init__(self, server_host, server_port_tcp, server_port_udp,
+                            client_port_udp, protocol, sequenced)
+        self.server_message = RingBuffer(queue_size, slot_size, drop_policy)
+        self.server_listener = SocketThread(self.client_udp,
+                                            self,
+                                            self.server_message)
+        self.sock_udp = self.server_listener.sock
+        if loss:
+            self.sock_udp = LossySocket(self.sock_udp, loss)
+        self.server_listener.start()
+        self.sock_tcp = None
+        self.tcp_lock = threading.Lock()
+        self.responses = {}
+
+        self.register()
+
+    def connect(self):
+        """
+        Open the persistent tcp control connection
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect(self.server_tcp)
+        except OSError:
+            sock.close()
+            raise
+        self.sock_tcp = sock
+
+    def disconnect(self):
+        """
+        Drop the control connection, responses still expected from it
+        are lost (tcp lock held by caller, the next request reconnects)
+        """
+        if self.sock_tcp is not None:
+            self.sock_tcp.close()
+            self.sock_tcp = None
+        self.responses = {}
+
+    def send_request(self, message):
+        """
+        Send a control request without waiting, return its request id
+        (ConnectionError if the connection is lost)
+        """
+        body = json.dumps(message).encode()
+        self.tcp_lock.acquire()
+        try:
+            if self.sock_tcp is None:
+                self.connect()
+            self.request_id += 1
+            request_id = self.request_id
+            self.sock_tcp.sendall(pack_frame(request_id, body))
+            self.last_request = time.time()
+        except OSError:
+            self.disconnect()
+            raise ConnectionError("Connection to server lost")
+        finally:
+            self.tcp_lock.release()
+        return request_id
+
+    def heartbeat(self, now):
+        """
+        Tell server we are alive when no control request was sent lately
+        (request id 0 has no response, skipped while a request is running)
+        """
+        if self.identifier is None or now - self.last_request < HEARTBEAT_INTERVAL:
+            return
+        if not self.tcp_lock.acquire(False):
+            return
+        try:
+            if self.sock_tcp is not None:
+                body = json.dumps({"action": "heartbeat", "identifier": self.identifier})
+                self.sock_tcp.sendall(pack_frame(0, body.encode()))
+            self.last_request = now
+        except OSError:
+            #  The next request reconnects
+            self.disconnect()
+        finally:
+            self.tcp_lock.release()
+        #  Also keeps the udp mapping of a NAT, and recovers a lost bind
+        self.bind()
+
+    def get_response(self, request_id):
+        """
+        Wait for the response of a control request (ConnectionError if
+        the connection is lost first)
+        """
+        self.tcp_lock.acquire()
+        try:
+            while request_id not in self.responses:
+                if self.sock_tcp is None:
+                    raise ConnectionError("Connection closed by server")
+                response_id, body = recv_frame(self.sock_tcp)
+                if response_id is None:
+                    raise ConnectionError("Connection closed by server")
+                self.responses[response_id] = body
+            data = self.responses.pop(request_id)
+        except OSError:
+            self.disconnect()
+            raise
+        finally:
+            self.tcp_lock.release()
+        return self.parse_data(data)
+
+    def request(self, message):
+        """
+        Send a control request and wait for its response (sent once
+        more on a new connection if the server closed the previous one,
+        as a restarting server does)
+        """
+        try:
+            return self.get_response(self.send_request(message))
+        except ConnectionError:
+            return self.get_response(self.send_request(message))
+
+    def pipeline(self, messages):
+        """
+        Send several control requests at once, then collect responses
+        """
+        request_ids = [self.send_request(message) for message in messages]
+        return [self.get_response(request_id) for request_id in request_ids]
+
+    def create_room(self, room_name=None, tick_rate=None, delta=False,
+                    interest_radius=None):
+        """
+        Create a new room on server (tick rooms batch room messages,
+        tick_rate times per second, delta rooms only send changed keys
+        of dict messages, interest rooms only send messages to players
+        within interest_radius of the sender position)
+        """
+        message = self.request(self.create_request(room_name, tick_rate, delta,
+                                                   interest_radius))
+        self.room_id = message
+
+    def join_room(self, room_id):
+        """
+        Join an existing room
+        """
+        self.room_id = room_id
+        try:
+            message = self.request({"action": "join", "payload": room_id, "identifier": self.identifier})
+        except Redirect as redirect:
+            self.move_to(redirect.node)
+            message = self.request({"action": "join", "payload": room_id, "identifier": self.identifier})
+        self.room_id = message
+
+    def autojoin(self, region=None, rating=None, party=None, party_size=1):
+        """
+        Join the first non-full room, or wait for a match when server
+        runs matchmaking (with players of the same region and a close
+        rating, party members are matched together once party_size
+        of them asked with the same party id)
+        """
+        try:
+            message = self.request(self.autojoin_request(region, rating, party,
+                                                         party_size))
+        except Redirect as redirect:
+            self.move_to(redirect.node)
+            message = self.request({"action": "join", "payload": redirect.room_id, "identifier": self.identifier})
+        self.room_id = message
+
+    def move_to(self, node):
+        """
+        Switch to another server node, keeping our identifier
+        """
+        self.tcp_lock.acquire()
+        try:
+            self.disconnect()
+        finally:
+            self.tcp_lock.release()
+        self.server_tcp = (node["host"], int(node["tcp_port"]))
+        self.server_udp = (node["host"], int(node["udp_port"]))
+        self.listing_version = None
+        self.register()
+
+    def leave_room(self):
+        """
+        Leave the current room
+        """
+        self.request({
+            "action": "leave",
+            "room_id": self.room_id,
+            "identifier": self.identifier
+        })
+
+    def get_rooms(self, not_full=False, prefix=None, capacity=None):
+        """
+        Get the list of remote rooms (only non-full ones, the ones whose
+        name starts with prefix, or of this capacity), server only sends
+        the rooms changed since the previous call with the same filters
+        """
+        filters, message = self.rooms_request(not_full, prefix, capacity)
+        return self.update_listing(filters, self.request(message))
+
+    def get_rooms_page(self, offset=0, limit=50, not_full=False, prefix=None,
+                       capacity=None):
+        """
+        Get one page of the list of remote rooms, with the offset of the
+        next page (None after the last one)
+        """
+        answer = self.request(self.page_request(offset, limit, not_full, prefix,
+                                                capacity))
+        return answer["rooms"], answer["next"]
+
+    def register(self):
+        """
+        Register the client to server and get a uniq identifier
+        (and a session when server agrees to the binary protocol)
+        """
+        message = self.request(self.register_request())
+        self.identifier = message
+
+    def resolve(self, sessions):
+        """
+        Ask server which players stand behind binary sessions
+        """
+        identifiers = self.request({
+            "action": "resolve",
+            "payload": sessions,
+            "identifier": self.identifier
+        })
+        self.learn(dict((identifier, int(session))
+                        for session, identifier in identifiers.items()))
+
+    def close(self):
+        """
+        Close the tcp control connection and the udp listener
+        """
+        if self.sock_tcp is not None:
+            self.sock_tcp.close()
+            self.sock_tcp = None
+        self.server_listener.stop()
+
     def get_messages(self):
         """
-        Get recieved messages from server
+        Get recieved messages from server, in arrival order
+        (binary datagrams are given in their json form)
         """
-        message = self.server_message
-        self.server_message = []
-        return set(message)
+        messages = self.server_message.drain()
+        for index, data in enumerate(messages):
+            if data[:1] == PREFIX:
+                messages[index] = json.dumps(self.decode_relay(data)).encode()
+        return messages
+
+    def decode_relay(self, data):
+        """
+        Envelope of a binary relayed datagram, as sent in json
+        ({"seq": {sender: seq}, sender: message})
+        """
+        entries = decode_relay(data)
+        unknown = [session for session, payload, seq in entries
+                   if session not in self.peers]
+        if len(unknown) != 0:
+            self.resolve(unknown)
+        return self.relay_envelope(entries)
+
+    def get_updates(self):
+        """
+        Get decoded messages as (sender, seq, message), in arrival order
+        (see envelope_updates for seq)
+        """
+        updates = []
+        for data in self.server_message.drain():
+            try:
+                if data[:1] == PREFIX:
+                    envelope = self.decode_relay(data)
+                else:
+                    envelope = json.loads(data)
+            except (ValueError, struct.error):
+                continue
+            updates.extend(self.envelope_updates(envelope))
+        return updates
 
 
 class SocketThread(threading.Thread):
-    def __init__(self, addr, client, lock):
+    def __init__(self, addr, client, queue):
         """
         Client udp connection
         """
         threading.Thread.__init__(self)
         self.client = client
-        self.lock = lock
+        self.queue = queue
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind(addr)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        #  Wake up to resend lost reliable messages and send heartbeats
+        self.sock.settimeout(RESEND_DELAY / 2)
 
     def run(self):
         """
-        Get responses from server
+        Get responses from server, straight into the queue slots
         """
+        #  Linux reports the real size of datagrams larger than a slot
+        flags = getattr(socket, "MSG_TRUNC", 0)
         while True:
-            data, addr = self.sock.recvfrom(1024)
-            self.lock.acquire()
+            now = time.time()
+            self.client.resend(now)
+            self.client.heartbeat(now)
+            index = self.queue.reserve()
+            slot = self.queue.slot(index)
             try:
-                self.client.server_message.append(data)
-            finally:
-                self.lock.release()
+                length, addr = self.sock.recvfrom_into(slot, len(slot), flags)
+            except socket.timeout:
+                continue
+            except OSError:
+                break  # Socket closed
+            if length > len(slot):
+                self.queue.truncated += 1
+                continue
+            if slot[:15] == b'{"__reliable__"':
+                try:
+                    messages = self.client.receive_reliable(slot[:length].tobytes())
+                except (ValueError, KeyError, TypeError):
+                    continue
+                for message in messages:
+                    try:
+                        message = self.client.reassemble(message)
+                    except (ValueError, KeyError, TypeError, struct.error):
+                        continue
+                    if message is not None:
+                        self.queue.put(message)
+                continue
+            if slot[:1] == FRAGMENT_PREFIX or slot[:16] == b'{"__fragment__":':
+                try:
+                    message = self.client.reassemble(slot[:length].tobytes())
+                except (ValueError, KeyError, TypeError, struct.error):
+                    continue
+                if message is not None:
+                    self.queue.put(message)
+                continue
+            rebuilt = None
+            if slot[0] != MAGIC and self.queue.contains(index, length, b'"__delta__"'):
+                try:
+                    rebuilt = self.client.rebuild(slot[:length].tobytes())
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if rebuilt is None:
+                    continue
+            self.queue.commit(index, length, rebuilt)
 
     def stop(self):
         """
@@ -193,6 +924,373 @@ class SocketThread(threading.Thread):
         self.sock.close()
 
 
+class AsyncClient(BaseClient):
+
+    def __init__(self,
+                 server_host,
+                 server_port_tcp=1234,
+                 server_port_udp=1234,
+                 client_port_udp=0,
+                 queue_size=256,
+                 loss=0.0,
+                 protocol="json",
+                 on_message=None,
+                 sequenced=False):
+        """
+        Asyncio game server client, without thread : control requests
+        are awaited (await client.join_room(room_id)), send and sendto
+        never block, received messages are given to
+        on_message(sender, seq, message) or wait for
+        "async for sender, seq, message in client" in a queue of
+        queue_size messages (the oldest are dropped)
+
+        await client.start() binds the udp port (a free one for 0),
+        connects and registers (sequenced : see Client)
+        """
+        BaseClient.__init__(self, server_host, server_port_tcp, server_port_udp,
+                            client_port_udp, protocol, sequenced)
+        self.loss = loss
+        self.on_message = on_message
+        self.messages = asyncio.Queue(queue_size)
+        self.dropped = 0
+        self.transport = None
+        self.sock_udp = None
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.maintainer = None
+        self.closed = False
+        self.connect_lock = asyncio.Lock()
+        #  Request id -> future of the response body
+        self.pending = {}
+
+    async def start(self):
+        """
+        Bind the udp endpoint, connect and register
+        """
+        loop = asyncio.get_running_loop()
+        self.transport, protocol = await loop.create_datagram_endpoint(
+            lambda: ClientProtocol(self),
+            local_addr=self.client_udp)
+        sock = self.transport.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        self.client_udp = (self.client_udp[0], sock.getsockname()[1])
+        self.sock_udp = self.transport
+        if self.loss:
+            self.sock_udp = LossySocket(self.sock_udp, self.loss)
+        self.maintainer = loop.create_task(self.maintain())
+        await self.register()
+        return self
+
+    async def connect(self):
+        """
+        Open the persistent tcp control connection (once for concurrent
+        requests)
+        """
+        async with self.connect_lock:
+            if self.writer is not None:
+                return
+            self.reader, self.writer = await asyncio.open_connection(*self.server_tcp)
+            self.receiver = asyncio.get_running_loop().create_task(
+                self.receive_responses(self.reader))
+
+    async def receive_responses(self, reader):
+        """
+        Hand each response frame to the request waiting for it
+        """
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                length, request_id = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    break
+                body = await reader.readexactly(length)
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if self.reader is reader:
+                self.disconnect()
+
+    def disconnect(self):
+        """
+        Drop the control connection, failing the requests waiting for it
+        (the next request reconnects)
+        """
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+        pending = self.pending
+        self.pending = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed by server"))
+
+    async def request(self, message):
+        """
+        Send a control request and wait for its response, other
+        requests can be running meanwhile (sent once more on a new
+        connection if the server closed the previous one, as a
+        restarting server does)
+        """
+        try:
+            body = await self.exchange(message)
+        except ConnectionError:
+            body = await self.exchange(message)
+        return self.parse_data(body)
+
+    async def exchange(self, message):
+        """
+        Send a control request, return the raw response
+        """
+        if self.writer is None:
+            await self.connect()
+        self.request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.request_id] = future
+        self.writer.write(pack_frame(self.request_id, json.dumps(message).encode()))
+        self.last_request = time.time()
+        return await future
+
+    async def pipeline(self, messages):
+        """
+        Send several control requests at once, then collect responses
+        """
+        return await asyncio.gather(*[self.request(message) for message in messages])
+
+    def heartbeat(self, now):
+        """
+        Tell server we are alive when no control request was sent lately
+        """
+        if self.identifier is None or now - self.last_request < HEARTBEAT_INTERVAL:
+            return
+        if self.writer is not None:
+            body = json.dumps({"action": "heartbeat", "identifier": self.identifier})
+            self.writer.write(pack_frame(0, body.encode()))
+        self.bind()
+        self.last_request = now
+
+    async def maintain(self):
+        """
+        Resend lost reliable messages and send heartbeats until closed
+        """
+        while True:
+            now = time.time()
+            self.resend(now)
+            self.heartbeat(now)
+            await asyncio.sleep(RESEND_DELAY / 2)
+
+    async def register(self):
+        """
+        Register the client to server and get a uniq identifier
+        """
+        self.identifier = await self.request(self.register_request())
+
+    async def resolve(self, sessions):
+        """
+        Ask server which players stand behind binary sessions
+        """
+        identifiers = await self.request({
+            "action": "resolve",
+            "payload": sessions,
+            "identifier": self.identifier
+        })
+        self.learn(dict((identifier, int(session))
+                        for session, identifier in identifiers.items()))
+
+    async def create_room(self, room_name=None, tick_rate=None, delta=False,
+                          interest_radius=None):
+        """
+        Create a new room on server (see Client.create_room)
+        """
+        self.room_id = await self.request(self.create_request(room_name, tick_rate,
+                                                              delta, interest_radius))
+
+    async def join_room(self, room_id):
+        """
+        Join an existing room
+        """
+        self.room_id = room_id
+        message = {"action": "join", "payload": room_id, "identifier": self.identifier}
+        try:
+            self.room_id = await self.request(message)
+        except Redirect as redirect:
+            await self.move_to(redirect.node)
+            self.room_id = await self.request(message)
+
+    async def autojoin(self, region=None, rating=None, party=None, party_size=1):
+        """
+        Join the first non-full room, or a match (see Client.autojoin)
+        """
+        try:
+            self.room_id = await self.request(self.autojoin_request(region, rating,
+                                                                    party, party_size))
+        except Redirect as redirect:
+            await self.move_to(redirect.node)
+            self.room_id = await self.request({"action": "join",
+                                               "payload": redirect.room_id,
+                                               "identifier": self.identifier})
+
+    async def move_to(self, node):
+        """
+        Switch to another server node, keeping our identifier
+        """
+        self.disconnect()
+        self.server_tcp = (node["host"], int(node["tcp_port"]))
+        self.server_udp = (node["host"], int(node["udp_port"]))
+        self.listing_version = None
+        await self.register()
+
+    async def leave_room(self):
+        """
+        Leave the current room
+        """
+        await self.request({
+            "action": "leave",
+            "room_id": self.room_id,
+            "identifier": self.identifier
+        })
+
+    async def get_rooms(self, not_full=False, prefix=None, capacity=None):
+        """
+        Get the list of remote rooms (see Client.get_rooms)
+        """
+        filters, message = self.rooms_request(not_full, prefix, capacity)
+        return self.update_listing(filters, await self.request(message))
+
+    async def get_rooms_page(self, offset=0, limit=50, not_full=False, prefix=None,
+                             capacity=None):
+        """
+        Get one page of the list of remote rooms, with the offset of the
+        next page (None after the last one)
+        """
+        answer = await self.request(self.page_request(offset, limit, not_full,
+                                                      prefix, capacity))
+        return answer["rooms"], answer["next"]
+
+    def datagram_received(self, data):
+        """
+        Deliver the messages of a datagram from server
+        """
+        try:
+            if data[:15] == b'{"__reliable__"':
+                messages = self.receive_reliable(data)
+            else:
+                messages = [data]
+            for message in messages:
+                message = self.reassemble(message)
+                if message is not None and message[:1] != PREFIX \
+                        and b'"__delta__"' in message:
+                    message = self.rebuild(message)
+                if message is not None:
+                    self.deliver(message)
+        except (ValueError, KeyError, TypeError, struct.error):
+            pass
+
+    def deliver(self, data):
+        """
+        Decode a relayed datagram and hand over its messages
+        (binary ones from unknown sessions wait for resolve)
+        """
+        if data[:1] == PREFIX:
+            entries = decode_relay(data)
+            unknown = [session for session, payload, seq in entries
+                       if session not in self.peers]
+            if len(unknown) != 0:
+                asyncio.ensure_future(self.deliver_resolved(entries, unknown))
+                return
+            envelope = self.relay_envelope(entries)
+        else:
+            envelope = json.loads(data)
+        for update in self.envelope_updates(envelope):
+            self.dispatch(update)
+
+    async def deliver_resolved(self, entries, unknown):
+        """
+        Deliver binary entries once their senders are known
+        """
+        try:
+            await self.resolve(unknown)
+        except Exception:
+            pass  # Senders gone, their entries are skipped
+        for update in self.envelope_updates(self.relay_envelope(entries)):
+            self.dispatch(update)
+
+    def dispatch(self, update):
+        """
+        Give a (sender, seq, message) to on_message, or queue it
+        """
+        if self.closed:
+            return
+        if self.on_message is not None:
+            self.on_message(*update)
+            return
+        if self.messages.full():
+            self.messages.get_nowait()
+            self.dropped += 1
+        self.messages.put_nowait(update)
+
+    def get_updates(self):
+        """
+        Get the queued messages as (sender, seq, message), without waiting
+        """
+        updates = []
+        while not self.messages.empty():
+            update = self.messages.get_nowait()
+            if update is not None:
+                updates.append(update)
+        return updates
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+        Wait for the next (sender, seq, message), until closed
+        """
+        if self.closed:
+            raise StopAsyncIteration
+        update = await self.messages.get()
+        if update is None:
+            #  Closed meanwhile, wake up the next waiter too
+            self.messages.put_nowait(None)
+            raise StopAsyncIteration
+        return update
+
+    def close(self):
+        """
+        Close the control connection and the udp endpoint, ending
+        async for loops
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.messages.full():
+            self.messages.get_nowait()
+        self.messages.put_nowait(None)
+        if self.maintainer is not None:
+            self.maintainer.cancel()
+        if self.receiver is not None:
+            self.receiver.cancel()
+        self.disconnect()
+        if self.transport is not None:
+            self.transport.close()
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        """
+        Udp endpoint of an AsyncClient
+        """
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.datagram_received(data)
+
+
 if __name__ == "__main__":
     """
     Example with 3 clients
@@ -243,10 +1341,6 @@ if __name__ == "__main__":
                       "message": "I love emacs"})
 
         # get server data (only client 3)
-        message = client1.get_messages()
-        if len(message) != 0:
-            for message in message:
-                message = json.loads(message)
-                sender, value = message.popitem()
-                print("%s say %s" % (value["name"], value["message"]))
+        for sender, seq, value in client1.get_updates():
+            print("%s say %s" % (value["name"], value["message"]))
 
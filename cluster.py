@@ -0,0 +1,319 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import os
+import socket
+from queue import Queue
+from threading import Thread, Lock
+from framing import pack_frame, recv_frame
+from listing import RoomListing, check_query
+from rooms import Rooms, RoomNotFound, RoomRedirect
+
+
+class ClusterRooms(Rooms):
+
+    def __init__(self, capacity, directory, node, options=None,
+                 idle_timeout=None, empty_grace=None, player_limit=None,
+                 matchmaking=None):
+        """
+        Rooms of one cluster node, published to the shared directory
+        (node is the host, tcp_port and udp_port clients should use)
+        """
+        Rooms.__init__(self, capacity, options, idle_timeout, empty_grace,
+                       player_limit, matchmaking)
+        self.node = node
+        self.node_id = "%s:%s" % (node["host"], node["tcp_port"])
+        self.directory = DirectoryClient(directory)
+        #  Players move between nodes with their tokens : every node signs
+        #  them with the secret of the directory
+        try:
+            self.secret = bytes.fromhex(self.directory.request({"action": "register_node",
+                                                                "node_id": self.node_id,
+                                                                "node": node}))
+        except OSError:
+            print("Directory unreachable, players can not move to other nodes")
+            self.directory.notify({"action": "register_node",
+                                   "node_id": self.node_id,
+                                   "node": node})
+
+    def create(self, room_name=None, identifier=None, options=None, session=None,
+               legacy=False):
+        """
+        Create a new room and publish it
+        """
+        self.lock.acquire()
+        try:
+            identifier = Rooms.create(self, room_name, identifier, options, session)
+            self.publish(identifier)
+        finally:
+            self.lock.release()
+        return identifier
+
+    def restore(self, players, rooms, secret=None):
+        """
+        Load a snapshot and publish the restored rooms (tokens stay
+        signed with the secret of the directory)
+        """
+        restored = Rooms.restore(self, players, rooms)
+        for identifier in restored:
+            self.publish(identifier)
+        return restored
+
+    def join(self, player_identifier, room_id=None, legacy=False):
+        """
+        Add player to a local room, or redirect the player to the owner node
+        """
+        if room_id is None:
+            if len(self.available) == 0:
+                found = self.directory.request({"action": "find_available",
+                                                "node_id": self.node_id})
+                if found is not None:
+                    raise RoomRedirect(found["room_id"], found["node"])
+        elif room_id not in self.rooms:
+            node = self.directory.request({"action": "lookup",
+                                           "room_id": room_id})
+            if node is None:
+                raise RoomNotFound()
+            raise RoomRedirect(room_id, node)
+
+        self.lock.acquire()
+        try:
+            room_id = Rooms.join(self, player_identifier, room_id)
+            self.publish(room_id)
+        finally:
+            self.lock.release()
+        return room_id
+
+    def leave(self, player_identifier, room_id):
+        """
+        Remove a player from a room and publish the new room state
+        """
+        self.lock.acquire()
+        try:
+            Rooms.leave(self, player_identifier, room_id)
+            self.publish(room_id)
+        finally:
+            self.lock.release()
+
+    def remove_empty(self, now=None):
+        """
+        Delete empty rooms and withdraw them from the directory
+        """
+        removed = Rooms.remove_empty(self, now)
+        for room_id in removed:
+            self.directory.notify({"action": "unpublish", "room_id": room_id})
+        return removed
+
+    def list_rooms(self):
+        """
+        Describe the rooms of every node
+        """
+        try:
+            return self.directory.request({"action": "list"})
+        except OSError:
+            print("Directory unreachable, listing local rooms only")
+            return Rooms.list_rooms(self)
+
+    def query_rooms(self, query=None):
+        """
+        Json encoded get_rooms answer, from the directory listing
+        """
+        if query is not None:
+            check_query(query)
+        try:
+            return json.dumps(self.directory.request({"action": "list",
+                                                      "query": query})).encode()
+        except OSError:
+            print("Directory unreachable, listing local rooms only")
+            return Rooms.query_rooms(self, query)
+
+    def publish(self, room_id):
+        """
+        Queue the current state of a local room for the directory
+        (described under the registry lock, sent once it is released)
+        """
+        self.lock.acquire()
+        try:
+            room = self.rooms.get(room_id)
+            if room is None:
+                return
+            message = {"action": "publish",
+                       "node_id": self.node_id,
+                       "room": room.describe()}
+        finally:
+            self.lock.release()
+        self.directory.notify(message)
+
+
+class DirectoryClient:
+
+    def __init__(self, addr):
+        """
+        Persistent framed connection to the room directory
+        """
+        self.addr = addr
+        self.sock = None
+        self.lock = Lock()
+        self.request_id = 0
+        #  Updates are sent by their own thread : registry changes (made
+        #  under the registry lock, sometimes nested) never wait for the
+        #  directory
+        self.updates = Queue()
+        self.sender = Thread(target=self.send_updates)
+        self.sender.daemon = True
+        self.sender.start()
+
+    def send(self, request_id, message):
+        """
+        Send one frame, reconnecting if needed
+        """
+        if self.sock is None:
+            self.sock = socket.create_connection(self.addr)
+        try:
+            self.sock.sendall(pack_frame(request_id, json.dumps(message).encode()))
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+
+    def notify(self, message):
+        """
+        Queue a directory update, sent in order by the sender thread
+        """
+        self.updates.put(message)
+
+    def send_updates(self):
+        """
+        Send the queued directory updates (request id 0 has no reply)
+        """
+        while True:
+            message = self.updates.get()
+            self.lock.acquire()
+            try:
+                self.send(0, message)
+            except OSError as e:
+                print("Directory update lost (%s)" % str(e))
+            finally:
+                self.lock.release()
+
+    def request(self, message):
+        """
+        Send a directory query and wait for its answer
+        """
+        self.lock.acquire()
+        try:
+            self.request_id += 1
+            self.send(self.request_id, message)
+            request_id, body = recv_frame(self.sock)
+            if request_id is None:
+                self.sock.close()
+                self.sock = None
+                raise ConnectionError("Directory closed the connection")
+        finally:
+            self.lock.release()
+        return json.loads(body)["message"]
+
+
+class DirectoryServer(Thread):
+    def __init__(self, port):
+        """
+        Shared room directory of a cluster (stand-in for a real store)
+        """
+        Thread.__init__(self)
+        self.port = int(port)
+        self.lock = Lock()
+        self.nodes = {}
+        self.rooms = {}
+        self.available = {}
+        self.listing = RoomListing()
+        #  Signs player tokens on every node, see Rooms.owns
+        self.secret = os.urandom(32).hex()
+
+    def run(self):
+        """
+        Accept node connections
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("0.0.0.0", self.port))
+        self.sock.listen(128)
+        while True:
+            conn, addr = self.sock.accept()
+            session = Thread(target=self.serve, args=(conn,))
+            session.daemon = True
+            session.start()
+
+    def serve(self, conn):
+        """
+        Answer the requests of one node
+        """
+        try:
+            while True:
+                request_id, body = recv_frame(conn)
+                if request_id is None:
+                    break
+                self.lock.acquire()
+                try:
+                    result = self.handle(json.loads(body))
+                finally:
+                    self.lock.release()
+                if request_id != 0:
+                    if isinstance(result, bytes):
+                        #  Already encoded listing
+                        response = b'{"success": "True", "message": ' + result + b'}'
+                    else:
+                        response = json.dumps({"success": "True", "message": result}).encode()
+                    conn.sendall(pack_frame(request_id, response))
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def handle(self, request):
+        """
+        Apply one directory request
+        """
+        action = request["action"]
+        if action == "register_node":
+            self.nodes[request["node_id"]] = request["node"]
+            return self.secret
+        elif action == "publish":
+            room = request["room"]
+            self.rooms[room["id"]] = (request["node_id"], room)
+            self.listing.update(room)
+            if room["nb_players"] < room["capacity"]:
+                self.available[room["id"]] = request["node_id"]
+            else:
+                self.available.pop(room["id"], None)
+        elif action == "unpublish":
+            self.rooms.pop(request["room_id"], None)
+            self.available.pop(request["room_id"], None)
+            self.listing.remove(request["room_id"])
+        elif action == "lookup":
+            entry = self.rooms.get(request["room_id"])
+            if entry is not None:
+                return self.nodes[entry[0]]
+        elif action == "find_available":
+            for room_id, node_id in self.available.items():
+                if node_id != request["node_id"]:
+                    return {"room_id": room_id, "node": self.nodes[node_id]}
+        elif action == "list":
+            return self.listing.query(request.get("query"))
+        return None
+
+
+if __name__ == "__main__":
+    """
+    Start a room directory for cluster nodes
+    """
+    parser = argparse.ArgumentParser(description='Simple game server directory')
+    parser.add_argument('--port',
+                        dest='port',
+                        help='Listening tcp port',
+                        default="1300")
+
+    args = parser.parse_args()
+    directory = DirectoryServer(args.port)
+    print("Directory listening on port %s" % args.port)
+    directory.run()
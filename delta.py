@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from threading import Lock
+
+#  Snapshots kept per sender, older baselines fall back to full states
+WINDOW = 32
+
+
+def diff(old, new):
+    """
+    Top level changes between two dict states : (changed, removed)
+    """
+    changed = {}
+    for key, value in new.items():
+        if key not in old or old[key] != value:
+            changed[key] = value
+    removed = [key for key in old if key not in new]
+    return changed, removed
+
+
+class DeltaEncoder:
+
+    def __init__(self):
+        """
+        Per room sender states and per recipient acknowledged baselines
+        """
+        self.lock = Lock()
+        self.sequences = {}
+        self.history = {}
+        self.acked = {}
+
+    def update(self, sender, state):
+        """
+        Record a new state of sender, return its sequence number
+        """
+        self.lock.acquire()
+        try:
+            seq = self.sequences.get(sender, 0) + 1
+            self.sequences[sender] = seq
+            history = self.history.setdefault(sender, OrderedDict())
+            history[seq] = state
+            if len(history) > WINDOW:
+                history.popitem(last=False)
+        finally:
+            self.lock.release()
+        return seq
+
+    def baseline(self, sender, recipient):
+        """
+        Last state of sender acknowledged by recipient (0 if none left)
+        """
+        seq = self.acked.get(recipient, {}).get(sender, 0)
+        if seq not in self.history.get(sender, ()):
+            return 0
+        return seq
+
+    def encode(self, sender, seq, base):
+        """
+        Relayed value of state seq of sender against baseline base :
+        {"__delta__": [seq, base, changed, removed]} (base 0 is a full state)
+        """
+        self.lock.acquire()
+        try:
+            history = self.history[sender]
+            state = history[seq]
+            if base == 0 or base not in history:
+                return {"__delta__": [seq, 0, state, []]}
+            changed, removed = diff(history[base], state)
+        finally:
+            self.lock.release()
+        return {"__delta__": [seq, base, changed, removed]}
+
+    def ack(self, recipient, sender, seq):
+        """
+        Recipient has rebuilt state seq of sender
+        """
+        self.lock.acquire()
+        try:
+            acked = self.acked.setdefault(recipient, {})
+            if seq > acked.get(sender, 0) and seq in self.history.get(sender, ()):
+                acked[sender] = seq
+        finally:
+            self.lock.release()
+
+    def forget(self, player_identifier):
+        """
+        Drop every state and baseline of a player leaving the room
+        (sequence numbers keep growing so late acks cannot match)
+        """
+        self.lock.acquire()
+        try:
+            self.history.pop(player_identifier, None)
+            self.acked.pop(player_identifier, None)
+            for acked in self.acked.values():
+                acked.pop(player_identifier, None)
+        finally:
+            self.lock.release()
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+#  Message bytes per fragment : with its header a fragment stays under
+#  the usual 1200 bytes safe udp payload, so it is never split by ip
+FRAGMENT_SIZE = 1000
+#  Largest message sent in fragments, largest datagram read
+MAX_MESSAGE_SIZE = 64 * 1024
+MAX_DATAGRAM = 65535
+MAX_FRAGMENTS = (MAX_MESSAGE_SIZE + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE
+#  Seconds a partly received message is kept
+FRAGMENT_TIMEOUT = 2.0
+#  Udp socket buffers : room for the fragments of a few messages at once
+SOCKET_BUFFER = 1024 * 1024
+
+
+def split(data):
+    """
+    Cut a message into fragments of FRAGMENT_SIZE bytes
+    """
+    if len(data) > MAX_MESSAGE_SIZE:
+        raise ValueError("Message too large (%d bytes)" % len(data))
+    return [data[start:start + FRAGMENT_SIZE]
+            for start in range(0, len(data), FRAGMENT_SIZE)]
+
+
+class Reassembler:
+
+    def __init__(self, max_messages=64, timeout=FRAGMENT_TIMEOUT):
+        """
+        Rebuild fragmented messages : at most max_messages are kept
+        partly received (the oldest is dropped for a new one), each for
+        timeout seconds
+        """
+        self.max_messages = max_messages
+        self.timeout = timeout
+        #  Message key -> [deadline, count, {index: fragment}], oldest first
+        self.partial = OrderedDict()
+        self.dropped = 0
+
+    def add(self, key, index, count, fragment, now):
+        """
+        Store a fragment of the message key, return the whole message
+        once all of its fragments arrived (None until then)
+        """
+        self.expire(now)
+        if not (isinstance(index, int) and isinstance(count, int)
+                and 0 <= index < count <= MAX_FRAGMENTS):
+            self.dropped += 1
+            return None
+        entry = self.partial.get(key)
+        if entry is not None and entry[1] != count:
+            #  Fragments of one message all give the same count
+            self.dropped += 1
+            return None
+        if entry is None:
+            if len(self.partial) >= self.max_messages:
+                self.partial.popitem(last=False)
+                self.dropped += 1
+            entry = [now + self.timeout, count, {}]
+            self.partial[key] = entry
+        entry[2][index] = fragment
+        if len(entry[2]) < entry[1]:
+            return None
+        del self.partial[key]
+        return b"".join(entry[2][index] for index in range(entry[1]))
+
+    def expire(self, now):
+        """
+        Drop the messages still incomplete after timeout
+        """
+        while len(self.partial) != 0:
+            key = next(iter(self.partial))
+            if self.partial[key][0] > now:
+                break
+            del self.partial[key]
+            self.dropped += 1
@@ -0,0 +1,44 @@
+import struct
+
+#  Tcp control frames : body length and request id, then json body
+FRAME_HEADER = struct.Struct("!II")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def pack_frame(request_id, body):
+    """
+    Build a length-prefixed control frame
+    """
+    return FRAME_HEADER.pack(len(body), request_id) + body
+
+
+def recv_exactly(sock, size):
+    """
+    Read exactly size bytes from a stream socket (None on disconnect)
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            return None
+        received += count
+    return bytes(data)
+
+
+def recv_frame(sock, header=None):
+    """
+    Read one control frame, return (request_id, body) or (None, None)
+    """
+    if header is None:
+        header = recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None, None
+    length, request_id = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError("Frame too large (%d bytes)" % length)
+    body = recv_exactly(sock, length)
+    if body is None:
+        return None, None
+    return request_id, body
@@ -0,0 +1,79 @@
+import math
+
+
+class Grid:
+
+    def __init__(self, radius):
+        """
+        Uniform grid of player positions, cells as large as the area
+        of interest radius so a query only reads the 9 cells around
+        """
+        self.radius = float(radius)
+        self.cells = {}
+        self.positions = {}
+
+    def cell(self, x, y):
+        """
+        Cell coordinates of a position
+        """
+        return (int(math.floor(x / self.radius)), int(math.floor(y / self.radius)))
+
+    def move(self, player_identifier, x, y):
+        """
+        Update the position of a player, moving it between cells only
+        when it crosses a cell border
+        """
+        x = float(x)
+        y = float(y)
+        cell = self.cell(x, y)
+        previous = self.positions.get(player_identifier)
+        if previous is not None and previous[2] != cell:
+            self.discard(player_identifier, previous[2])
+        if previous is None or previous[2] != cell:
+            self.cells.setdefault(cell, set()).add(player_identifier)
+        self.positions[player_identifier] = (x, y, cell)
+
+    def remove(self, player_identifier):
+        """
+        Forget a player
+        """
+        previous = self.positions.pop(player_identifier, None)
+        if previous is not None:
+            self.discard(player_identifier, previous[2])
+
+    def discard(self, player_identifier, cell):
+        """
+        Remove a player from a cell, dropping empty cells
+        """
+        players = self.cells[cell]
+        players.discard(player_identifier)
+        if len(players) == 0:
+            del self.cells[cell]
+
+    def nearby(self, x, y):
+        """
+        Players within radius of a position
+        """
+        cx, cy = self.cell(x, y)
+        radius = self.radius * self.radius
+        found = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for player_identifier in self.cells.get((cx + dx, cy + dy), ()):
+                    px, py, cell = self.positions[player_identifier]
+                    if (px - x) * (px - x) + (py - y) * (py - y) <= radius:
+                        found.append(player_identifier)
+        return found
+
+    def sees(self, recipient, sender):
+        """
+        Check if sender is in the area of interest of recipient
+        (players without position see and are seen by everyone)
+        """
+        first = self.positions.get(recipient)
+        second = self.positions.get(sender)
+        if first is None or second is None:
+            return True
+        dx = first[0] - second[0]
+        dy = first[1] - second[1]
+        return dx * dx + dy * dy <= self.radius * self.radius
@@ -0,0 +1,214 @@
+import json
+import time
+from collections import OrderedDict, deque
+from threading import Lock
+
+#  Changes remembered to answer "what changed since version v"
+HISTORY = 1024
+#  Encoded answers kept for the current version (repeated lobby polls)
+CACHE_SIZE = 64
+#  Rooms per page when a page is asked without limit
+PAGE_SIZE = 50
+
+
+#  get_rooms query fields : accepted types, and the smallest value of numbers
+QUERY_FIELDS = {"since": (int, None),
+                "offset": (int, 0),
+                "limit": (int, 1),
+                "not_full": (bool, None),
+                "prefix": (str, None),
+                "capacity": (int, None)}
+
+
+def check_query(query):
+    """
+    Raise ValueError unless every field of a get_rooms query is None or
+    of its type (see QUERY_FIELDS)
+    """
+    for name, (kind, minimum) in QUERY_FIELDS.items():
+        value = query.get(name)
+        if value is None:
+            continue
+        if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+            raise ValueError("Invalid %s : %s expected" % (name, kind.__name__))
+        if minimum is not None and value < minimum:
+            raise ValueError("Invalid %s : at least %d expected" % (name, minimum))
+
+
+class RoomListing:
+
+    def __init__(self):
+        """
+        Versioned room listing : each room description is kept json
+        encoded, every change bumps the version, so get_rooms answers
+        are served from cache, as "not modified" or as a delta
+        """
+        self.lock = Lock()
+        self.version = 0
+        #  Room id -> (description, json) in creation order
+        self.entries = OrderedDict()
+        #  (version, room_id) of the latest changes, deltas can be
+        #  computed since floor only
+        self.changes = deque()
+        self.floor = 0
+        #  Query key -> encoded answer, for the current version
+        self.cache = {}
+
+    def update(self, entry):
+        """
+        Add or refresh a room description (id, name, nb_players, capacity)
+        """
+        self.lock.acquire()
+        try:
+            current = self.entries.get(entry["id"])
+            if current is not None and current[0] == entry:
+                return
+            self.entries[entry["id"]] = (entry, json.dumps(entry))
+            self.changed(entry["id"])
+        finally:
+            self.lock.release()
+
+    def restore(self, entries):
+        """
+        Load room descriptions restored from a snapshot as one change :
+        versions then count from the restore time (in ms), so versions
+        given by the previous server process are never taken as current
+        """
+        self.lock.acquire()
+        try:
+            for entry in entries:
+                self.entries[entry["id"]] = (entry, json.dumps(entry))
+            self.version = max(self.version + 1, int(time.time() * 1000))
+            self.changes.clear()
+            self.floor = self.version
+            self.cache.clear()
+        finally:
+            self.lock.release()
+
+    def remove(self, room_id):
+        """
+        Withdraw a room
+        """
+        self.lock.acquire()
+        try:
+            if self.entries.pop(room_id, None) is not None:
+                self.changed(room_id)
+        finally:
+            self.lock.release()
+
+    def changed(self, room_id):
+        """
+        Bump the version (lock held by caller)
+        """
+        self.version += 1
+        self.changes.append((self.version, room_id))
+        if len(self.changes) > HISTORY:
+            self.floor = self.changes.popleft()[0]
+        self.cache.clear()
+
+    def rooms(self):
+        """
+        Every room description, in creation order
+        """
+        self.lock.acquire()
+        try:
+            return [dict(entry) for entry, encoded in self.entries.values()]
+        finally:
+            self.lock.release()
+
+    def query(self, query=None):
+        """
+        Json encoded get_rooms answer
+
+        Without query : the list of every room (legacy answer). A query
+        dict may filter rooms (not_full, prefix of the name, capacity),
+        ask a page (offset, limit) and give the version of the filtered
+        listing the client has (since) : the answer is then "not
+        modified" or the rooms changed since (removed ones, or the ones
+        no longer matching the filters, listed by id), fields of the
+        wrong type raise ValueError
+        """
+        if query is None:
+            key = None
+        else:
+            check_query(query)
+            key = tuple(sorted((name, query.get(name))
+                               for name in ("since", "offset", "limit",
+                                            "not_full", "prefix", "capacity")))
+        self.lock.acquire()
+        try:
+            answer = self.cache.get(key)
+            if answer is None:
+                answer = self.answer(query)
+                if len(self.cache) >= CACHE_SIZE:
+                    self.cache.clear()
+                self.cache[key] = answer
+            return answer
+        finally:
+            self.lock.release()
+
+    def answer(self, query):
+        """
+        Build a get_rooms answer (lock held by caller)
+        """
+        if query is None:
+            return ("[%s]" % ", ".join(encoded for entry, encoded
+                                       in self.entries.values())).encode()
+
+        since = query.get("since")
+        if since == self.version:
+            return json.dumps({"version": self.version,
+                               "modified": False}).encode()
+
+        matches = self.matcher(query)
+        if since is not None and self.floor <= since < self.version:
+            changed = OrderedDict()
+            for version, room_id in reversed(self.changes):
+                if version <= since:
+                    break
+                changed[room_id] = True
+            rooms = []
+            removed = []
+            for room_id in changed:
+                current = self.entries.get(room_id)
+                if current is not None and matches(current[0]):
+                    rooms.append(current[1])
+                else:
+                    removed.append(room_id)
+            return ('{"version": %d, "modified": true, "delta": true, '
+                    '"rooms": [%s], "removed": %s}' % (self.version,
+                                                       ", ".join(rooms),
+                                                       json.dumps(removed))).encode()
+
+        rooms = [encoded for entry, encoded in self.entries.values()
+                 if matches(entry)]
+        offset = int(query.get("offset") or 0)
+        limit = query.get("limit")
+        following = None
+        if limit is not None or offset != 0:
+            limit = int(limit or PAGE_SIZE)
+            if offset + limit < len(rooms):
+                following = offset + limit
+            rooms = rooms[offset:offset + limit]
+        return ('{"version": %d, "modified": true, "delta": false, '
+                '"rooms": [%s], "next": %s}' % (self.version,
+                                                ", ".join(rooms),
+                                                json.dumps(following))).encode()
+
+    def matcher(self, query):
+        """
+        Filter function of a query
+        """
+        not_full = query.get("not_full")
+        prefix = query.get("prefix")
+        capacity = query.get("capacity")
+
+        def matches(entry):
+            if not_full and entry["nb_players"] >= entry["capacity"]:
+                return False
+            if prefix is not None and not str(entry["name"]).startswith(prefix):
+                return False
+            if capacity is not None and entry["capacity"] != capacity:
+                return False
+            return True
+        return matches
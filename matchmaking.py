@@ -0,0 +1,186 @@
+import heapq
+import itertools
+from threading import Lock
+
+
+class Ticket:
+
+    def __init__(self, players, region, rating, now):
+        """
+        Players matched together : a lone player or a whole party,
+        players are (identifier, reply socket, enqueue time)
+        """
+        self.players = players
+        self.region = region
+        self.rating = rating
+        self.enqueued_at = now
+        self.cancelled = False
+
+    def size(self):
+        return len(self.players)
+
+
+class Matchmaker:
+
+    def __init__(self, match_size, interval=0.2, max_wait=2.0, rating_spread=100.0,
+                 spread_growth=50.0):
+        """
+        Batch matchmaking : autojoin requests are queued, every interval
+        seconds rooms of match_size players are formed from players of
+        the same region with close ratings (at most rating_spread apart,
+        plus spread_growth per second waited), players waiting for
+        max_wait seconds get a room even if it is not full
+        """
+        self.match_size = int(match_size)
+        self.interval = float(interval)
+        self.max_wait = float(max_wait)
+        self.rating_spread = float(rating_spread)
+        self.spread_growth = float(spread_growth)
+        self.lock = Lock()
+        #  Region -> heap of (rating, order, ticket), lowest rating first
+        self.buckets = {}
+        #  Party id -> (party size, member tickets) until every member is queued
+        self.parties = {}
+        #  Player identifier -> its ticket (to drop a previous request)
+        self.queued = {}
+        self.order = itertools.count()
+
+    def enqueue(self, identifier, sock, now, region=None, rating=None,
+                party=None, party_size=1):
+        """
+        Queue an autojoin request (party members are matched together
+        once party_size of them are queued), return the players of the
+        ticket it supersedes (the previous request of the player, with
+        its party if it was merged), whose requests are left unanswered
+        """
+        if rating is None:
+            rating = 0.0
+        party_size = max(1, min(int(party_size), self.match_size))
+        ticket = Ticket([(identifier, sock, now)], region, float(rating), now)
+        superseded = []
+        self.lock.acquire()
+        try:
+            previous = self.queued.get(identifier)
+            if previous is not None and not previous.cancelled:
+                previous.cancelled = True
+                superseded = previous.players
+                for player in previous.players:
+                    if player[0] != identifier:
+                        self.queued.pop(player[0], None)
+            self.queued[identifier] = ticket
+            if party is not None and party_size > 1:
+                size, members = self.parties.setdefault(party, (party_size, []))
+                #  Only live tickets count : a member queued again replaces
+                #  its previous ticket
+                members[:] = [member for member in members if not member.cancelled]
+                members.append(ticket)
+                if len(members) < size:
+                    return superseded
+                del self.parties[party]
+                ticket = self.merge(members)
+            self.add(ticket)
+        finally:
+            self.lock.release()
+        return superseded
+
+    def merge(self, members):
+        """
+        One ticket for the live members of a party (lock held by caller)
+        """
+        members = [member for member in members if not member.cancelled]
+        ticket = Ticket([player for member in members for player in member.players],
+                        members[0].region,
+                        sum(member.rating for member in members) / len(members),
+                        min(member.enqueued_at for member in members))
+        for player in ticket.players:
+            self.queued[player[0]] = ticket
+        return ticket
+
+    def add(self, ticket):
+        """
+        File a ticket in its region bucket (lock held by caller)
+        """
+        heapq.heappush(self.buckets.setdefault(ticket.region, []),
+                       (ticket.rating, next(self.order), ticket))
+
+    def form(self, now):
+        """
+        Form this batch of matches, return them as (players, full), see
+        Ticket for players
+        """
+        matches = []
+        self.lock.acquire()
+        try:
+            #  Parties still incomplete after max_wait go with who is there
+            for party, (size, members) in list(self.parties.items()):
+                if now - min(member.enqueued_at for member in members) >= self.max_wait:
+                    del self.parties[party]
+                    if any(not member.cancelled for member in members):
+                        self.add(self.merge(members))
+
+            for region, bucket in list(self.buckets.items()):
+                remaining = []
+                group = []
+                seats = 0
+                while len(bucket) != 0:
+                    entry = heapq.heappop(bucket)
+                    ticket = entry[2]
+                    if ticket.cancelled:
+                        continue
+                    if len(group) != 0 and not self.close(group[0][2], ticket, now):
+                        self.close_group(group, seats, now, matches, remaining)
+                        group = []
+                        seats = 0
+                    if seats + ticket.size() > self.match_size:
+                        remaining.append(entry)
+                        continue
+                    group.append(entry)
+                    seats += ticket.size()
+                    if seats == self.match_size:
+                        self.close_group(group, seats, now, matches, remaining)
+                        group = []
+                        seats = 0
+                self.close_group(group, seats, now, matches, remaining)
+                heapq.heapify(remaining)
+                if len(remaining) != 0:
+                    self.buckets[region] = remaining
+                else:
+                    del self.buckets[region]
+
+            for players, full in matches:
+                for player in players:
+                    self.queued.pop(player[0], None)
+        finally:
+            self.lock.release()
+        return matches
+
+    def close(self, first, ticket, now):
+        """
+        Check if the rating of ticket is close enough to the lowest one
+        of a group (the spread grows while they wait)
+        """
+        waited = now - min(first.enqueued_at, ticket.enqueued_at)
+        return ticket.rating - first.rating <= self.rating_spread + self.spread_growth * waited
+
+    def close_group(self, group, seats, now, matches, remaining):
+        """
+        Match a full group, or a group whose oldest ticket waited too
+        long, and put back the others (lock held by caller)
+        """
+        if len(group) == 0:
+            return
+        tickets = [entry[2] for entry in group]
+        full = seats == self.match_size
+        if full or now - min(ticket.enqueued_at for ticket in tickets) >= self.max_wait:
+            matches.append(([player for ticket in tickets for player in ticket.players],
+                            full))
+            for ticket in tickets:
+                ticket.cancelled = True
+            return
+        remaining.extend(group)
+
+    def size(self):
+        """
+        Players waiting for a match
+        """
+        return len(self.queued)
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+import argparse
+import gc
+import json
+import resource
+import time
+import rooms as registry
+from rooms import Rooms
+
+
+def rss():
+    """
+    Resident memory of this process in bytes (peak memory where
+    /proc is missing)
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def address(index):
+    """
+    Distinct tcp address of the index-th player
+    """
+    return ("10.%d.%d.%d" % ((index >> 16) & 255, (index >> 8) & 255, index & 255),
+            1024 + index % 60000)
+
+
+def unslotted(cls):
+    """
+    Copy of a __slots__ class whose instances have a __dict__ instead
+    """
+    slots = getattr(cls, "__slots__", ())
+    namespace = dict((name, value) for name, value in vars(cls).items()
+                     if name not in slots and name not in ("__slots__", "__weakref__"))
+    return type(cls.__name__, cls.__bases__, namespace)
+
+
+def run(nb_players, capacity, joined, baseline=False):
+    """
+    Register nb_players players (the joined share of them in rooms of
+    capacity players), measure memory and full garbage collection time
+    (with baseline, players and rooms are plain dict backed objects as
+    before __slots__, to compare against)
+    """
+    classes = registry.Player, registry.Room
+    if baseline:
+        registry.Player, registry.Room = map(unslotted, classes)
+    try:
+        return measure(nb_players, capacity, joined, baseline)
+    finally:
+        registry.Player, registry.Room = classes
+
+
+def measure(nb_players, capacity, joined, baseline):
+    """
+    Benchmark body of run, on the classes rooms currently uses
+    """
+    gc.collect()
+    base = rss()
+    rooms = Rooms(capacity)
+
+    start = time.perf_counter()
+    identifiers = []
+    for index in range(nb_players):
+        addr = address(index)
+        identifiers.append(rooms.register(addr, addr[1] + 1).identifier)
+    register_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for identifier in identifiers[:int(nb_players * joined)]:
+        rooms.join(identifier)
+    join_seconds = time.perf_counter() - start
+    del identifiers
+
+    gc.collect()
+    used = rss() - base
+    start = time.perf_counter()
+    gc.collect()
+    gc_seconds = time.perf_counter() - start
+    return {"baseline": baseline,
+            "players": nb_players,
+            "rooms": len(rooms.rooms),
+            "rss_mb": round(used / 1048576.0, 1),
+            "bytes_per_player": int(used / nb_players),
+            "register_us": round(register_seconds / nb_players * 1e6, 2),
+            "join_us": round(join_seconds / max(1, int(nb_players * joined)) * 1e6, 2),
+            "full_gc_ms": round(gc_seconds * 1000, 1),
+            "gc_tracked": len(gc.get_objects())}
+
+
+if __name__ == "__main__":
+    """
+    Memory used by the player and room registry
+    """
+    parser = argparse.ArgumentParser(description='Simple game server memory benchmark')
+    parser.add_argument('--players',
+                        dest='players',
+                        help='Players registered',
+                        default="1000000")
+    parser.add_argument('--capacity',
+                        dest='capacity',
+                        help='Players per room',
+                        default="10")
+    parser.add_argument('--joined',
+                        dest='joined',
+                        help='Share of the players joining a room (0 to 1)',
+                        default="1")
+    parser.add_argument('--baseline',
+                        dest='baseline',
+                        help='Measure dict backed players and rooms (before __slots__)',
+                        action='store_true')
+    parser.add_argument('--json',
+                        dest='json',
+                        help='Print results as json',
+                        action='store_true')
+
+    args = parser.parse_args()
+    result = run(int(args.players), int(args.capacity), float(args.joined),
+                 args.baseline)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key, value in result.items():
+            print("%s : %s" % (key, value))
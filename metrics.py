@@ -0,0 +1,419 @@
+import socket
+import time
+from bisect import bisect_left
+from threading import Thread, Lock
+
+#  Histogram upper bounds : seconds for latencies, players for fan-out
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+FANOUT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+QUEUE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Counter:
+
+    def __init__(self):
+        """
+        Monotonic count
+        """
+        self.value = 0
+
+    def inc(self, value=1):
+        """
+        Add value to the count (several per relayed datagram : not
+        locked, the interpreter lock never switches threads within the
+        += of an int attribute, CPython only does at calls and loop jumps)
+        """
+        self.value += value
+
+    def export(self):
+        """
+        Picklable value, see add
+        """
+        return self.value
+
+    def add(self, exported):
+        """
+        Add the value exported by another counter (other process)
+        """
+        self.inc(exported)
+
+    def reset(self):
+        self.value = 0
+
+    def samples(self, name, labels):
+        """
+        Prometheus samples as (name, labels, value)
+        """
+        return [(name, labels, self.value)]
+
+    def describe(self):
+        return str(self.value)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        """
+        Count of observations per bucket (values up to each bound)
+        """
+        self.lock = Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Record one value
+        """
+        index = bisect_left(self.buckets, value)
+        self.lock.acquire()
+        try:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def export(self):
+        """
+        Picklable value : (bucket counts, sum, count), see add
+        """
+        self.lock.acquire()
+        try:
+            return list(self.counts), self.sum, self.count
+        finally:
+            self.lock.release()
+
+    def add(self, exported):
+        """
+        Add the observations exported by another histogram of the
+        same buckets (other process)
+        """
+        counts, total, count = exported
+        self.lock.acquire()
+        try:
+            for index, value in enumerate(counts):
+                self.counts[index] += value
+            self.sum += total
+            self.count += count
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q quantile (None if empty
+        or beyond the last bucket)
+        """
+        rank = q * self.count
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank and total != 0:
+                if index < len(self.buckets):
+                    return self.buckets[index]
+                return None
+        return None
+
+    def samples(self, name, labels):
+        """
+        Prometheus samples as (name, labels, value), buckets cumulative
+        """
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            samples.append((name + "_bucket", labels + (("le", str(bound)),), total))
+        samples.append((name + "_sum", labels, self.sum))
+        samples.append((name + "_count", labels, self.count))
+        return samples
+
+    def describe(self):
+        return "count %d, p50 <= %s, p99 <= %s" % (self.count,
+                                                    self.quantile(0.5),
+                                                    self.quantile(0.99))
+
+
+class Family:
+
+    def __init__(self, name, help, kind, labelnames=(), buckets=None):
+        """
+        Metric and its children, one per label values
+        (metrics without labels are used directly : family.inc())
+        """
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.children = {}
+        self.lock = Lock()
+        if len(labelnames) == 0:
+            child = self.labels()
+            self.inc = getattr(child, "inc", None)
+            self.observe = getattr(child, "observe", None)
+
+    def labels(self, *values):
+        """
+        Child metric for these label values (created on first use)
+        """
+        child = self.children.get(values)
+        if child is None:
+            self.lock.acquire()
+            try:
+                child = self.children.get(values)
+                if child is None:
+                    if self.kind == "histogram":
+                        child = Histogram(self.buckets)
+                    else:
+                        child = Counter()
+                    self.children[values] = child
+            finally:
+                self.lock.release()
+        return child
+
+    def export(self):
+        """
+        Exported value of every child, by label values
+        """
+        return dict((values, child.export())
+                    for values, child in list(self.children.items()))
+
+    def merged(self, exports):
+        """
+        Copy of the family adding the exports of other processes
+        """
+        family = Family(self.name, self.help, self.kind, self.labelnames, self.buckets)
+        for exported in [self.export()] + exports:
+            for values, value in exported.items():
+                family.labels(*values).add(value)
+        return family
+
+    def samples(self):
+        samples = []
+        for values, child in list(self.children.items()):
+            samples.extend(child.samples(self.name,
+                                         tuple(zip(self.labelnames, values))))
+        return samples
+
+
+class Metrics:
+
+    def __init__(self):
+        """
+        Registry of the server metrics, collectors are callables
+        returning the exports of other processes (relay workers) to
+        add to the rendered metrics
+        """
+        self.families = []
+        self.collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        family = Family(name, help, "counter", labelnames)
+        self.families.append(family)
+        return family
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        family = Family(name, help, "histogram", labelnames, buckets)
+        self.families.append(family)
+        return family
+
+    def export(self):
+        """
+        Every metric value, picklable (to be sent to another process)
+        """
+        return dict((family.name, family.export()) for family in self.families)
+
+    def reset(self):
+        """
+        Zero every metric (processes forked with the values of their parent)
+        """
+        for family in self.families:
+            for child in list(family.children.values()):
+                child.reset()
+
+    def collect(self):
+        """
+        Families with the exports of the collectors added
+        """
+        if len(self.collectors) == 0:
+            return self.families
+        exports = [exported for collector in self.collectors for exported in collector()]
+        return [family.merged([exported.get(family.name, {}) for exported in exports])
+                for family in self.families]
+
+    def render(self):
+        """
+        Every metric in Prometheus text format
+        """
+        lines = []
+        for family in self.collect():
+            lines.append("# HELP %s %s" % (family.name, family.help))
+            lines.append("# TYPE %s %s" % (family.name, family.kind))
+            for name, labels, value in family.samples():
+                if len(labels) != 0:
+                    name += "{%s}" % ",".join('%s="%s"' % label for label in labels)
+                lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        One line per metric child, for the server console
+        """
+        lines = []
+        for family in self.collect():
+            for values, child in sorted(family.children.items()):
+                name = family.name
+                if len(values) != 0:
+                    name += "{%s}" % ",".join(values)
+                lines.append("%s : %s" % (name, child.describe()))
+        return lines
+
+
+metrics = Metrics()
+
+DATAGRAMS_IN = metrics.counter("sgs_udp_datagrams_received_total",
+                               "Udp datagrams received")
+BYTES_IN = metrics.counter("sgs_udp_bytes_received_total",
+                           "Udp bytes received")
+DATAGRAMS_OUT = metrics.counter("sgs_udp_datagrams_sent_total",
+                                "Udp datagrams sent")
+BYTES_OUT = metrics.counter("sgs_udp_bytes_sent_total",
+                            "Udp bytes sent")
+RELAY_FANOUT = metrics.histogram("sgs_relay_fanout",
+                                 "Players a relayed message (or tick flush) is sent to",
+                                 buckets=FANOUT_BUCKETS)
+TCP_REQUEST_SECONDS = metrics.histogram("sgs_tcp_request_seconds",
+                                        "Time to handle a tcp request",
+                                        ("action",))
+LOCK_WAIT_SECONDS = metrics.histogram("sgs_lock_wait_seconds",
+                                      "Time spent waiting for a contended lock",
+                                      ("lock",))
+PARSE_ERRORS = metrics.counter("sgs_parse_errors_total",
+                               "Requests which are not valid json or miss fields",
+                               ("transport",))
+DROPPED = metrics.counter("sgs_dropped_packets_total",
+                          "Udp requests not relayed",
+                          ("reason",))
+MATCHMAKING_QUEUE_SECONDS = metrics.histogram("sgs_matchmaking_queue_seconds",
+                                              "Time players waited for a match",
+                                              buckets=QUEUE_BUCKETS)
+MATCHES = metrics.counter("sgs_matches_total",
+                          "Rooms formed by matchmaking",
+                          ("kind",))
+SNAPSHOT_SECONDS = metrics.histogram("sgs_snapshot_seconds",
+                                     "Time to write a registry snapshot",
+                                     buckets=QUEUE_BUCKETS)
+
+
+class MeteredSocket:
+
+    def __init__(self, sock):
+        """
+        Udp socket (or transport) counting the datagrams it sends
+        """
+        self.sock = sock
+
+    def sendto(self, data, addr):
+        sent = self.sock.sendto(data, addr)
+        DATAGRAMS_OUT.inc()
+        BYTES_OUT.inc(len(data))
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class TimedLock:
+    __slots__ = ("lock", "wait")
+
+    def __init__(self, lock, name):
+        """
+        Lock recording how long contended acquisitions wait
+        (uncontended ones only cost a non-blocking try)
+        """
+        self.lock = lock
+        self.wait = LOCK_WAIT_SECONDS.labels(name)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.wait.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class StatsServer(Thread):
+    def __init__(self, port, host="127.0.0.1"):
+        """
+        Local stats socket : answers every connection (plain or http
+        GET, so Prometheus can scrape it) with the metrics text
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.port = int(port)
+        self.host = host
+        self.is_listening = True
+
+    def run(self):
+        """
+        Serve metrics until stopped
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.settimeout(1)
+        self.sock.listen(16)
+        while self.is_listening:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            try:
+                self.answer(conn)
+            except OSError:
+                pass
+            finally:
+                conn.close()
+        self.sock.close()
+
+    def answer(self, conn):
+        """
+        Send the metrics, with http headers if asked over http
+        """
+        conn.settimeout(0.5)
+        try:
+            request = conn.recv(1024)
+        except socket.timeout:
+            request = b""
+        body = metrics.render().encode()
+        if request.startswith(b"GET "):
+            conn.sendall(b"HTTP/1.0 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: %d\r\n\r\n" % len(body))
+        conn.sendall(body)
+
+    def stop_listening(self):
+        """
+        Ask the server loop to exit
+        """
+        self.is_listening = False
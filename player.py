@@ -1,31 +1,197 @@
 import uuid
 import json
-import socket
+import time
+from metrics import DROPPED
+from wire import encode_relay, encode_fragment
+
+#  Seconds a player is skipped after the server could not send to it
+CONGESTION_BACKOFF = 0.05
+#  Datagrams gathering several messages (tick flushes) are split to stay
+#  under the usual safe udp payload
+MAX_ENVELOPE = 1200
+
+
+def encode_envelope(player_identifier, message, seq=None):
+    """
+    Encode a relayed message as sent to players
+    (seq, see numbered, is listed first under "seq")
+    """
+    envelope = {}
+    if seq is not None:
+        envelope["seq"] = {player_identifier: seq}
+    envelope[player_identifier] = message
+    return json.dumps(envelope).encode()
+
+
+def wrap_payload(player_identifier, payload, seq=None):
+    """
+    Build the relay envelope around an already json encoded payload
+    """
+    return wrap_payloads([(player_identifier, payload, seq)])
+
+
+def wrap_payloads(entries):
+    """
+    Build one relay envelope around several (identifier, json payload, seq)
+    """
+    parts = []
+    sequences = dict((identifier, seq) for identifier, payload, seq in entries
+                     if seq is not None)
+    if len(sequences) != 0:
+        parts.append(b'"seq": ' + json.dumps(sequences).encode())
+    for identifier, payload, seq in entries:
+        parts.append(json.dumps(identifier).encode() + b": " + payload)
+    return b"{" + b", ".join(parts) + b"}"
+
+
+def split_entries(entries, limit=MAX_ENVELOPE):
+    """
+    Group (identifier, session, json payload, seq) envelope entries so
+    each group encodes to about limit bytes at most (a larger entry is
+    sent alone)
+    """
+    groups = []
+    group = []
+    size = 2
+    for entry in entries:
+        #  Identifier under "seq" and before the payload, quotes, separators
+        cost = len(entry[2]) + 2 * len(entry[0]) + 32
+        if len(group) != 0 and size + cost > limit:
+            groups.append(group)
+            group = []
+            size = 2
+        group.append(entry)
+        size += cost
+    if len(group) != 0:
+        groups.append(group)
+    return groups
+
+
+def numbered(player, seq, reliable=False):
+    """
+    Sequence number of a relayed message as given to player : reliable
+    channel ones to players who did not ask for sequence numbers, sender
+    ones (of unreliable messages) to the others (see Player.sequenced)
+    """
+    if player.sequenced == reliable:
+        return None
+    return seq
+
+
+class Envelope:
+    __slots__ = ("entries", "fragment", "reliable", "encoded")
+
+    def __init__(self, entries, fragment=None, reliable=False):
+        """
+        Relayed datagram of (identifier, session, json payload, seq)
+        entries, encoded once per wire protocol (and numbering, see
+        numbered) on first use (or of one fragment of a large message,
+        fragment is (message id, index, count), relayed as is), seq is
+        the sender reliable channel one for reliable envelopes
+        """
+        self.entries = entries
+        self.fragment = fragment
+        self.reliable = reliable
+        self.encoded = {}
+
+    def data(self, player):
+        """
+        Datagram in the wire protocol of player
+        """
+        key = (player.binary, player.sequenced)
+        data = self.encoded.get(key)
+        if data is not None:
+            return data
+        entries = [(identifier, session, payload, numbered(player, seq, self.reliable))
+                   for identifier, session, payload, seq in self.entries]
+        if self.fragment is not None:
+            data = self.fragment_data(player, entries[0])
+        elif player.binary:
+            data = encode_relay([(session, payload, seq)
+                                 for identifier, session, payload, seq in entries])
+        else:
+            data = wrap_payloads([(identifier, payload, seq)
+                                  for identifier, session, payload, seq in entries])
+        self.encoded[key] = data
+        return data
+
+    def fragment_data(self, player, entry):
+        """
+        Fragment datagram in the wire protocol of player
+        """
+        identifier, session, payload, seq = entry
+        if player.binary:
+            return encode_fragment(session, seq, self.fragment, payload)
+        header = [identifier, seq] + list(self.fragment)
+        return json.dumps({"__fragment__": header}).encode() + b"\n" + payload
 
 
 class Player:
+    #  No per instance dict : servers keep millions of players
+    __slots__ = ("identifier", "session", "binary", "sequenced", "addr", "udp_addr",
+                 "last_seen", "congested_until")
 
-    def __init__(self, addr, udp_port):
+    def __init__(self, addr, udp_port, identifier=None, session=None):
         """
-        Identify a remote player
+        Identify a remote player (session is the small id standing for
+        it on the binary wire protocol, sequenced players get the sender
+        sequence numbers of unreliable messages, see numbered)
         """
-        self.identifier = str(uuid.uuid4())
+        if identifier is None:
+            identifier = str(uuid.uuid4())
+        self.identifier = identifier
+        self.session = session
+        self.binary = False
+        self.sequenced = False
         self.addr = addr
         self.udp_addr = (addr[0], int(udp_port))
+        self.last_seen = time.time()
+        self.congested_until = 0
 
-    def send_tcp(self, success, data, sock):
+    def send_tcp(self, success, data, sock, extra=None):
         """
         Send tcp packet to player for server interaction
+        (extra fields, such as the room udp endpoint, are added as is)
         """
         success_string = "False"
         if success:
             success_string = "True"
-        message = json.dumps({"success": success_string, "message": data})
-        sock.send(message.encode())
+        message = {"success": success_string, "message": data}
+        if extra is not None:
+            message.update(extra)
+        sock.send(json.dumps(message).encode())
+
+    def send_tcp_encoded(self, data, sock):
+        """
+        Send a successful tcp response whose message is already json
+        encoded
+        """
+        sock.send(b'{"success": "True", "message": ' + data + b'}')
 
-    def send_udp(self, player_identifier, message):
+    def send_udp(self, player_identifier, message, sock):
         """
         Send udp packet to player (game logic interaction)
+        through the server udp socket
+        """
+        self.send_datagram(encode_envelope(player_identifier, message), sock)
+
+    def send_datagram(self, data, sock):
+        """
+        Send an already encoded udp packet (or an Envelope) to player
+        (dropped for a while once the server socket send buffer was full)
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.sendto(json.dumps({player_identifier: message}).encode(), self.udp_addr)
+        if isinstance(data, Envelope):
+            data = data.data(self)
+        if self.congested_until:
+            if time.time() < self.congested_until:
+                DROPPED.labels("send_buffer_full").inc()
+                return
+            self.congested_until = 0
+        try:
+            sock.sendto(data, self.udp_addr)
+        except BlockingIOError:
+            self.congested_until = time.time() + CONGESTION_BACKOFF
+            DROPPED.labels("send_buffer_full").inc()
+        except (OSError, OverflowError):
+            #  Datagram too large, unreachable address : skip this player only
+            DROPPED.labels("send_error").inc()
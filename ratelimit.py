@@ -0,0 +1,58 @@
+from collections import OrderedDict
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None, now=0):
+        """
+        Allow rate units per second on average and up to burst at once
+        (burst defaults to one second of traffic)
+        """
+        self.rate = float(rate)
+        if burst is None:
+            burst = rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = now
+
+    def take(self, now, cost=1):
+        """
+        Spend cost tokens, return False (spending nothing) when there
+        are not enough of them
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter:
+
+    def __init__(self, rate, burst=None, max_keys=65536):
+        """
+        One token bucket per key (at most max_keys buckets : the least
+        recently used one is forgotten for a new key, in O(1), so a
+        flood of new source addresses costs the same as known ones)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        #  Key -> bucket, least recently used first
+        self.buckets = OrderedDict()
+
+    def allow(self, key, now, cost=1):
+        """
+        Spend cost tokens of the key bucket, return False when over
+        the limit
+        """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets.popitem(last=False)
+            bucket = TokenBucket(self.rate, self.burst, now)
+            self.buckets[key] = bucket
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(now, cost)
@@ -0,0 +1,220 @@
+import json
+import random
+from collections import OrderedDict
+from threading import Lock
+
+#  First resend delay in seconds, doubled on each try up to MAX_DELAY
+RESEND_DELAY = 0.1
+MAX_DELAY = 1.0
+#  Messages in flight, acknowledged and buffered ahead of the in-order point
+WINDOW = 32
+#  A channel holding more messages, or an unacknowledged message older
+#  than GIVE_UP seconds, has a peer which is gone : see stalled
+MAX_PENDING = 256
+GIVE_UP = 10.0
+
+
+def frame(seq, acks, epoch):
+    """
+    Header line of a reliable datagram sent to a client
+    (seq 0 only carries acks, epoch is the server channel one)
+    """
+    return json.dumps({"__reliable__": [seq] + acks + [epoch]}).encode() + b"\n"
+
+
+class ReliableChannel:
+
+    def __init__(self, epoch=0):
+        """
+        Reliable, ordered message stream over udp with one peer
+
+        Every datagram carries [seq, ack, bits, epoch] : ack is the last
+        message delivered in order and bit i of bits tells message
+        ack + 1 + i was received too, so only missing ones are resent.
+        Messages are resent until acknowledged, or until the channel
+        stalls (see abandon), the channel is dropped with the player.
+        Epoch names the numbering both ends agreed on : server picks
+        it, a peer still numbering messages of a previous epoch (server
+        restarted, other node) starts over, see reset.
+        """
+        self.lock = Lock()
+        self.epoch = epoch
+        self.retired = set()
+        self.next_seq = 0
+        self.pending = OrderedDict()
+        self.acked = 0
+        self.delivered = 0
+        self.early = {}
+
+    def push(self, item, now):
+        """
+        Number an outgoing message and keep it until acknowledged,
+        return its seq if it can be sent now (None while WINDOW
+        messages are in flight : due sends it later)
+        """
+        self.lock.acquire()
+        try:
+            self.next_seq += 1
+            seq = self.next_seq
+            #  [item, next send, sends so far, pushed at]
+            if seq > self.acked + WINDOW:
+                self.pending[seq] = [item, now, -1, now]
+                return None
+            self.pending[seq] = [item, now + RESEND_DELAY, 0, now]
+        finally:
+            self.lock.release()
+        return seq
+
+    def acks(self):
+        """
+        Acknowledgement state sent with every datagram : [ack, bits]
+        """
+        bits = 0
+        self.lock.acquire()
+        try:
+            for seq in self.early:
+                bits |= 1 << (seq - self.delivered - 1)
+            ack = self.delivered
+        finally:
+            self.lock.release()
+        return [ack, bits]
+
+    def acknowledge(self, ack, bits):
+        """
+        Drop the outgoing messages the peer has received
+        """
+        self.lock.acquire()
+        try:
+            if ack > self.acked:
+                self.acked = ack
+            while len(self.pending) != 0:
+                seq = next(iter(self.pending))
+                if seq > ack:
+                    break
+                del self.pending[seq]
+            offset = 0
+            while bits:
+                if bits & 1:
+                    self.pending.pop(ack + 1 + offset, None)
+                bits >>= 1
+                offset += 1
+        finally:
+            self.lock.release()
+
+    def receive(self, seq, item):
+        """
+        Accept an incoming message, return the messages now deliverable
+        in order (duplicates and messages beyond the window are ignored)
+        """
+        self.lock.acquire()
+        try:
+            if seq <= self.delivered or seq > self.delivered + WINDOW:
+                return []
+            self.early[seq] = item
+            items = []
+            while self.delivered + 1 in self.early:
+                self.delivered += 1
+                items.append(self.early.pop(self.delivered))
+        finally:
+            self.lock.release()
+        return items
+
+    def reset(self, epoch):
+        """
+        Start the numbering over in a new epoch : nothing was delivered
+        yet, messages not acknowledged are numbered again from 1 and
+        sent at once (datagrams of retired epochs are to be ignored)
+        """
+        self.lock.acquire()
+        try:
+            entries = list(self.pending.values())
+            self.retired.add(self.epoch)
+            self.retired.discard(epoch)
+            self.epoch = epoch
+            self.next_seq = 0
+            self.pending = OrderedDict()
+            self.acked = 0
+            self.delivered = 0
+            self.early = {}
+            for entry in entries:
+                self.next_seq += 1
+                self.pending[self.next_seq] = [entry[0], 0, -1, entry[3]]
+        finally:
+            self.lock.release()
+
+    def stalled(self, now):
+        """
+        Check if the peer stopped acknowledging : more than MAX_PENDING
+        messages kept, or the oldest one pushed GIVE_UP seconds ago
+        """
+        self.lock.acquire()
+        try:
+            if len(self.pending) == 0:
+                return False
+            oldest = next(iter(self.pending.values()))
+            return len(self.pending) > MAX_PENDING or now - oldest[3] > GIVE_UP
+        finally:
+            self.lock.release()
+
+    def abandon(self, epoch):
+        """
+        Drop the messages not acknowledged and start over in a new
+        epoch (the peer, if ever back, starts over too), return the
+        number of messages dropped
+        """
+        self.lock.acquire()
+        try:
+            dropped = len(self.pending)
+            self.pending = OrderedDict()
+        finally:
+            self.lock.release()
+        self.reset(epoch)
+        return dropped
+
+    def due(self, now):
+        """
+        Messages to send now as (seq, item) : unacknowledged ones whose
+        delay is over (backing off each time) and held ones the window
+        now allows
+        """
+        if len(self.pending) == 0:
+            return []
+        resend = []
+        self.lock.acquire()
+        try:
+            for seq, entry in self.pending.items():
+                if seq > self.acked + WINDOW:
+                    break
+                if entry[1] > now:
+                    continue
+                entry[2] += 1
+                entry[1] = now + min(RESEND_DELAY * 2 ** entry[2], MAX_DELAY)
+                resend.append((seq, entry[0]))
+        finally:
+            self.lock.release()
+        return resend
+
+
+class LossySocket:
+
+    def __init__(self, sock, loss=0.1, seed=None):
+        """
+        Udp socket (or transport) dropping a share of the datagrams
+        it sends, to test the reliable channel on a local network
+        """
+        self.sock = sock
+        self.loss = float(loss)
+        self.random = random.Random(seed)
+        self.dropped = 0
+
+    def sendto(self, data, addr):
+        """
+        Send a datagram, unless it is picked to be lost
+        """
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return len(data)
+        return self.sock.sendto(data, addr)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
@@ -1,61 +1,355 @@
 import uuid
-from player import Player
+import hashlib
+import hmac
+import json
+import os
+import itertools
+import random
+import time
+import heapq
+from collections import deque
+from threading import Lock, RLock
+from delta import DeltaEncoder
+from interest import Grid
+from listing import RoomListing
+from matchmaking import Matchmaker
+from metrics import RELAY_FANOUT, DROPPED, TimedLock
+from ratelimit import TokenBucket, RateLimiter
+from reliable import ReliableChannel, RESEND_DELAY, frame
+from timers import TimerWheel
+from player import Player, Envelope, encode_envelope, wrap_payload, wrap_payloads, \
+    split_entries, numbered
+
+#  Room options clients may set when creating a room
+ROOM_OPTIONS = ("tick_rate", "delta", "interest_radius")
 
 
 class Rooms:
 
-    def __init__(self, capacity=2):
+    def __init__(self, capacity=2, options=None, idle_timeout=None,
+                 empty_grace=None, player_limit=None, matchmaking=None):
         """
         Handle rooms and set maximum rooms capacity
+        (and default room options, see Room, players not seen for
+        idle_timeout seconds are evicted by evict_idle, rooms empty
+        for empty_grace seconds are deleted by remove_empty, each
+        player udp traffic is limited to player_limit (rate, burst),
+        autojoin requests are queued for batch matchmaking when
+        matchmaking holds the Matchmaker settings)
         """
         self.rooms = {}
         self.players = {}
         self.room_capacity = capacity
+        if options is None:
+            options = {}
+        self.room_options = options
+        #  Next tick of each tick room : heap of (time, room_id)
+        self.schedule = []
+        self.schedule_lock = Lock()
+        #  Indexes : tcp address -> player, non-full rooms in creation order,
+        #  player -> tuple of the rooms joined (keyed by player.identifier
+        #  so requests do not keep copies of identifiers alive)
+        self.addresses = {}
+        self.available = {}
+        self.memberships = {}
+        #  Room descriptions served to get_rooms, see listing
+        self.listing = RoomListing()
+        #  Binary protocol sessions : small id -> player or room
+        self.sessions = {}
+        self.room_sessions = {}
+        self.session_ids = itertools.count(1)
+        #  Idle players deadlines, checked against last_seen when they fire
+        self.idle_timeout = idle_timeout
+        self.idle = TimerWheel(time.time())
+        #  Rooms which became empty : (deadline, room_id) in deadline order
+        self.empty_grace = empty_grace
+        self.empty = deque()
+        #  Guards the registry (rooms, players and indexes), never taken
+        #  by the relay path : each room has its own lock for its members
+        self.lock = TimedLock(RLock(), "registry")
+        #  Reliable channels by player, the ones with messages to resend
+        #  (channel epochs differ from a server process to another)
+        self.instance = random.getrandbits(31)
+        #  Signs the tokens proving which client owns an identifier
+        #  (shared by the nodes of a cluster, kept by snapshots)
+        self.secret = os.urandom(32)
+        self.channels = {}
+        self.resending = {}
+        self.channels_lock = Lock()
+        #  Token bucket per udp source address, used by the udp server only
+        self.player_limit = player_limit
+        self.limiter = None
+        if player_limit is not None:
+            self.limiter = RateLimiter(*player_limit)
+        self.matchmaker = None
+        if matchmaking is not None:
+            settings = dict(matchmaking)
+            if not settings.get("match_size"):
+                settings["match_size"] = capacity
+            self.matchmaker = Matchmaker(**settings)
+
+    def register(self, addr, udp_port, identifier=None, binary=False, sequenced=False,
+                 token=None):
+        """
+        Register player (optionally keeping an identifier given at a
+        previous register, here or by another node, with the token given
+        along, see owns, binary players get datagrams in the binary
+        protocol, see wire, sequenced players get sender sequence
+        numbers, see Player)
+        """
+        udp_port = int(udp_port)
+        if not 0 < udp_port < 65536:
+            raise ValueError("Invalid udp port %d" % udp_port)
+        self.lock.acquire()
+        try:
+            player = self.addresses.get(addr)
+            if player is None and identifier is not None:
+                #  Identifiers are seen by every roommate : not a proof
+                if not self.owns(identifier, token):
+                    raise ClientNotRegistered()
+                player = self.players.get(identifier)
+            if player is not None:
+                if player.addr != addr:
+                    self.addresses.pop(player.addr, None)
+                    player.addr = addr
+                player.udp_addr = (addr[0], udp_port)
+            else:
+                player = Player(addr, udp_port, identifier, next(self.session_ids))
+                self.players[player.identifier] = player
+                self.sessions[player.session] = player
+                if self.idle_timeout:
+                    self.idle.schedule(player.identifier,
+                                       player.last_seen + self.idle_timeout)
+            player.binary = binary
+            player.sequenced = sequenced
+            player.last_seen = time.time()
+            self.addresses[addr] = player
+        finally:
+            self.lock.release()
+
+        #  A registering client starts its reliable channel over
+        self.restart_channel(player)
+        return player
 
-    def register(self, addr, udp_port):
+    def token(self, identifier):
         """
-        Register player
+        Token given at register, proving the client owns identifier
         """
-        player = None
-        for registered_player in self.players.values():
-            if registered_player.addr == addr:
-                player = registered_player
-                player.udp_addr((addr[0], udp_port))
-                break
+        return hmac.new(self.secret, identifier.encode(), hashlib.sha256).hexdigest()
 
-        if player is None:
-            player = Player(addr, udp_port)
-            self.players[player.identifier] = player
+    def owns(self, identifier, token):
+        """
+        Check token is the one given along identifier at register
+        (identifiers are server issued uuids only)
+        """
+        if not isinstance(identifier, str) or not isinstance(token, str):
+            return False
+        try:
+            if str(uuid.UUID(identifier)) != identifier:
+                return False
+        except ValueError:
+            return False
+        return hmac.compare_digest(self.token(identifier).encode(), token.encode())
 
-        return player
+    def restart_channel(self, player):
+        """
+        Start the reliable channel with a player over, if any (messages
+        not acknowledged yet are numbered again and resent)
+        """
+        self.channels_lock.acquire()
+        try:
+            channel = self.channels.get(player.identifier)
+            if channel is not None:
+                channel.reset(self.epoch(player))
+                if len(channel.pending) != 0:
+                    self.resending[player.identifier] = channel
+        finally:
+            self.channels_lock.release()
+
+    def epoch(self, player):
+        """
+        Epoch of the reliable channel with a player, given at register
+        (never 0, another after a restart, see ReliableChannel)
+        """
+        return (self.instance + player.session) % 0x7fffffff + 1
 
-    def join(self, player_identifier, room_id=None):
+    def allow(self, address):
         """
-        Add player to room
+        Check a datagram from address against the per player limit
+        """
+        if self.limiter is None:
+            return True
+        return self.limiter.allow(address, time.time())
+
+    def seen(self, player_identifier):
+        """
+        Record activity of a player (its idle timer is only checked
+        when it fires, so this never touches the timer wheel)
+        """
+        player = self.players.get(player_identifier)
+        if player is not None:
+            player.last_seen = time.time()
+
+    def evict_idle(self, now):
+        """
+        Evict the players whose idle timer fired and who were not seen
+        since, return their identifiers
+        """
+        if not self.idle_timeout:
+            return []
+        evicted = []
+        self.lock.acquire()
+        try:
+            for player_identifier in self.idle.advance(now):
+                player = self.players.get(player_identifier)
+                if player is None:
+                    continue
+                deadline = player.last_seen + self.idle_timeout
+                if deadline > now:
+                    self.idle.schedule(player_identifier, deadline)
+                    continue
+                self.evict(player_identifier)
+                evicted.append(player_identifier)
+        finally:
+            self.lock.release()
+        return evicted
+
+    def evict(self, player_identifier):
+        """
+        Remove a player from its rooms and forget it
+        """
+        self.lock.acquire()
+        try:
+            for room_id in list(self.memberships.get(player_identifier, ())):
+                try:
+                    self.leave(player_identifier, room_id)
+                except (RoomNotFound, NotInRoom):
+                    pass
+            self.memberships.pop(player_identifier, None)
+            player = self.players.pop(player_identifier, None)
+            if player is not None:
+                self.sessions.pop(player.session, None)
+                if self.addresses.get(player.addr) is player:
+                    del self.addresses[player.addr]
+            self.idle.cancel(player_identifier)
+        finally:
+            self.lock.release()
+
+        self.channels_lock.acquire()
+        try:
+            self.channels.pop(player_identifier, None)
+            self.resending.pop(player_identifier, None)
+        finally:
+            self.channels_lock.release()
+
+    def add_player(self, player):
+        """
+        Register a player created elsewhere (another worker or node)
+        """
+        self.lock.acquire()
+        try:
+            if player.session is None:
+                player.session = next(self.session_ids)
+            self.players[player.identifier] = player
+            self.sessions[player.session] = player
+        finally:
+            self.lock.release()
+
+    def restore(self, players, rooms, secret=None):
+        """
+        Load the registry saved by a snapshot, before serving (see
+        snapshot) : players are (identifier, session, binary, tcp
+        address, udp port, sequenced), rooms are (identifier, name, capacity,
+        session, options, members sessions), secret signed the tokens of
+        the players. Sessions are kept and restored players count as
+        seen now, return the restored room ids
+        """
+        if secret is not None:
+            self.secret = secret
+        now = time.time()
+        restored = []
+        self.lock.acquire()
+        try:
+            loaded = []
+            for identifier, session, binary, addr, udp_port, sequenced in players:
+                player = Player(addr, udp_port, identifier, session)
+                player.binary = binary
+                player.sequenced = sequenced
+                player.last_seen = now
+                loaded.append(player)
+            self.players.update((player.identifier, player) for player in loaded)
+            self.sessions.update((player.session, player) for player in loaded)
+            self.addresses.update((player.addr, player) for player in loaded)
+            if self.idle_timeout:
+                self.idle.schedule_all([player.identifier for player in loaded],
+                                       now + self.idle_timeout)
+
+            for identifier, name, capacity, session, options, members in rooms:
+                room_options = dict(self.room_options)
+                room_options.update(options)
+                room = Room(identifier, capacity, name, room_options)
+                room.session = session
+                #  Members which left since the snapshot are skipped
+                for member in members[:capacity]:
+                    player = self.sessions.get(member)
+                    if player is not None:
+                        room.players[player.identifier] = player
+                        self.memberships[player.identifier] = \
+                            self.memberships.get(player.identifier, ()) + (identifier,)
+                if room.grid is not None:
+                    room.unplaced.update(room.players)
+                self.rooms[identifier] = room
+                self.room_sessions[session] = room
+                if not room.is_full():
+                    self.available[identifier] = room
+                if room.is_empty():
+                    self.schedule_empty(room)
+                restored.append(room)
+            self.listing.restore([room.describe() for room in restored])
+
+            #  New sessions follow the restored ones
+            last = max(itertools.chain(self.sessions, self.room_sessions), default=0)
+            self.session_ids = itertools.count(last + 1)
+        finally:
+            self.lock.release()
+
+        for room in restored:
+            if room.tick_rate:
+                self.schedule_room(room.identifier)
+        return [room.identifier for room in restored]
+
+    def join(self, player_identifier, room_id=None, legacy=False):
+        """
+        Add player to room (legacy players ignore the udp endpoint of
+        the join answer, see ShardedRooms)
         """
         if player_identifier not in self.players:
             raise ClientNotRegistered()
 
         player = self.players[player_identifier]
 
-        if room_id is None:
-            for room_id in self.rooms.keys():
-                if not self.rooms[room_id].is_full():
-                    self.rooms[room_id].players.append(player)
-                    return room_id
-                    break
-            room_id = self.create()
-            self.join(player_identifier, room_id)
-            return room_id
-
-        elif room_id in self.rooms:
-            if not self.rooms[room_id].is_full():
-                self.rooms[room_id].players.append(player)
-                return room_id
-            else:
-                raise RoomFull()
-        else:
-            raise RoomNotFound()
+        self.lock.acquire()
+        try:
+            if room_id is None:
+                if len(self.available) != 0:
+                    room_id = next(iter(self.available))
+                else:
+                    room_id = self.create()
+
+            if room_id not in self.rooms:
+                raise RoomNotFound()
+
+            room = self.rooms[room_id]
+            room.join(player)
+            joined = self.memberships.get(player.identifier, ())
+            if room.identifier not in joined:
+                self.memberships[player.identifier] = joined + (room.identifier,)
+            if room.is_full():
+                self.available.pop(room_id, None)
+            self.listing.update(room.describe())
+        finally:
+            self.lock.release()
+        return room_id
 
     def leave(self, player_identifier, room_id):
         """
@@ -66,94 +360,483 @@ class Rooms:
 
         player = self.players[player_identifier]
 
-        if room_id in self.rooms:
-            self.rooms[room_id].leave(player)
-        else:
-            raise RoomNotFound()
+        self.lock.acquire()
+        try:
+            if room_id in self.rooms:
+                room = self.rooms[room_id]
+                if room.leave(player):
+                    self.schedule_empty(room)
+                joined = self.memberships.get(player.identifier, ())
+                if room_id in joined:
+                    self.memberships[player.identifier] = tuple(
+                        other for other in joined if other != room_id)
+                self.available[room_id] = room
+                self.listing.update(room.describe())
+            else:
+                raise RoomNotFound()
+        finally:
+            self.lock.release()
 
-    def create(self, room_name=None):
+    def create(self, room_name=None, identifier=None, options=None, session=None,
+               legacy=False):
         """
-        Create a new room
+        Create a new room (options override the default room options,
+        session is given when mirroring a room created elsewhere, legacy
+        as for join)
         """
-        identifier = str(uuid.uuid4())
-        self.rooms[identifier] = Room(identifier,
-                                      self.room_capacity,
-                                      room_name)
+        if identifier is None:
+            identifier = str(uuid.uuid4())
+        room_options = dict(self.room_options)
+        if options is not None:
+            room_options.update(options)
+        room = Room(identifier, self.room_capacity, room_name, room_options)
+        self.lock.acquire()
+        try:
+            if session is None:
+                session = next(self.session_ids)
+            room.session = session
+            self.rooms[identifier] = room
+            self.available[identifier] = room
+            self.room_sessions[session] = room
+            self.listing.update(room.describe())
+            #  Reclaimed if nobody ever joins
+            self.schedule_empty(room)
+        finally:
+            self.lock.release()
+
+        if room.tick_rate:
+            self.schedule_room(identifier)
         return identifier
 
-    def remove_empty(self):
+    def schedule_room(self, room_id):
         """
-        Delete empty rooms
+        Start ticking a tick room
         """
-        for room_id in list(self.rooms.keys()):
-            if self.rooms[room_id].is_empty():
-                del self.rooms[room_id]
+        self.schedule_lock.acquire()
+        try:
+            heapq.heappush(self.schedule, (time.time(), room_id))
+        finally:
+            self.schedule_lock.release()
 
-    def send(self, identifier, room_id, message, sock):
+    def schedule_empty(self, room):
         """
-        Send data to all players in room, except sender
+        Queue a room which just became empty (registry lock held by caller)
         """
-        if room_id not in self.rooms:
-            raise RoomNotFound()
+        if self.empty_grace is None:
+            return
+        #  New rooms get at least a second to be joined by their creator
+        self.empty.append((room.emptied_at + max(self.empty_grace, 1.0),
+                           room.identifier))
 
-        room = self.rooms[room_id]
-        if not room.is_in_room(identifier):
-            raise NotInRoom()
+    def remove_empty(self, now=None):
+        """
+        Delete the rooms still empty since their grace period began,
+        return their identifiers (only queued rooms are looked at)
+        """
+        if now is None:
+            now = time.time()
+        removed = []
+        self.lock.acquire()
+        try:
+            while len(self.empty) != 0 and self.empty[0][0] <= now:
+                deadline, room_id = self.empty.popleft()
+                room = self.rooms.get(room_id)
+                if room is None:
+                    continue
+                room.lock.acquire()
+                try:
+                    #  Rooms joined since, or emptied again later, are skipped
+                    if room.is_empty() and room.emptied_at + self.empty_grace <= now:
+                        del self.rooms[room_id]
+                        self.available.pop(room_id, None)
+                        self.room_sessions.pop(room.session, None)
+                        self.listing.remove(room_id)
+                        removed.append(room_id)
+                finally:
+                    room.lock.release()
+        finally:
+            self.lock.release()
+        return removed
+
+    def remove(self, room_id):
+        """
+        Delete a room whatever its players
+        """
+        self.lock.acquire()
+        try:
+            room = self.rooms.pop(room_id, None)
+            self.available.pop(room_id, None)
+            if room is not None:
+                self.room_sessions.pop(room.session, None)
+                self.listing.remove(room_id)
+        finally:
+            self.lock.release()
+
+    def endpoint(self, room_id):
+        """
+        Extra response fields telling players where the room lives
+        (None when served by this process udp port)
+        """
+        return None
 
-        for player in room.players:
-            if player.identifier != identifier:
-                player.send_udp(identifier, message)
+    def list_rooms(self):
+        """
+        Describe every room (id, name, players count and capacity)
+        """
+        return self.listing.rooms()
 
-    def sendto(self, identifier, room_id, recipients, message, sock):
+    def query_rooms(self, query=None):
+        """
+        Json encoded get_rooms answer (see RoomListing.query), served
+        without taking the registry lock
+        """
+        return self.listing.query(query)
+
+    def send(self, identifier, room_id, message, sock, position=None, seq=None,
+             reliable=False):
+        """
+        Send data to all players in room, except sender
+        """
+        self.send_data(identifier,
+                       room_id,
+                       json.dumps(message).encode(),
+                       sock,
+                       position,
+                       seq,
+                       reliable)
+
+    def send_data(self, identifier, room_id, payload, sock, position=None, seq=None,
+                  reliable=False, fragment=None):
+        """
+        Send a json encoded message to all players in room, except sender
+        (tick rooms keep it until the next tick, interest rooms only send
+        it to players around the sender position, reliable messages are
+        sent at once on each player reliable channel, fragments of large
+        messages are sent at once as is, see fragments)
+        """
+        room = self.rooms.get(room_id)
+        if room is None:
+            raise RoomNotFound()
+
+        room.lock.acquire()
+        try:
+            if not room.is_in_room(identifier):
+                raise NotInRoom()
+            session = room.players[identifier].session
+            if position is not None and room.grid is not None:
+                room.move(identifier, position[0], position[1])
+            if room.tick_rate and not reliable and fragment is None:
+                room.updates[identifier] = (payload, seq, session)
+                return
+            targets = room.audience(identifier)
+            #  Reliable messages were acknowledged already, never shed them
+            if not reliable and not room.allow(len(targets)):
+                DROPPED.labels("room_rate").inc()
+                return
+        finally:
+            room.lock.release()
+
+        RELAY_FANOUT.observe(len(targets))
+        envelope = Envelope([(identifier, session, payload, seq)], fragment, reliable)
+        if reliable:
+            self.send_reliable(targets, envelope, sock)
+            return
+
+        if room.delta is not None and fragment is None:
+            room.send_delta(identifier, payload, seq, targets, sock)
+            return
+
+        for player in targets:
+            player.send_datagram(envelope, sock)
+
+    def sendto(self, identifier, room_id, recipients, message, sock, seq=None,
+               reliable=False):
         """
         Send data to specific player(s)
         """
-        if room_id not in self.rooms:
+        self.sendto_data(identifier,
+                         room_id,
+                         recipients,
+                         json.dumps(message).encode(),
+                         sock,
+                         seq,
+                         reliable)
+
+    def sendto_data(self, identifier, room_id, recipients, payload, sock, seq=None,
+                    reliable=False, fragment=None):
+        """
+        Send a json encoded message to specific player(s)
+        """
+        room = self.rooms.get(room_id)
+        if room is None:
             raise RoomNotFound()
 
-        room = self.rooms[room_id]
-        if not room.is_in_room(identifier):
-            raise NotInRoom()
-   
         if isinstance(recipients, str):
             recipients = [recipients]
-            
-        for player in room.players:
-            if player.identifier in recipients:
-                player.send_udp(identifier, message)
+
+        room.lock.acquire()
+        try:
+            if not room.is_in_room(identifier):
+                raise NotInRoom()
+            session = room.players[identifier].session
+            targets = [room.players[recipient]
+                       for recipient in dict.fromkeys(recipients)
+                       if recipient in room.players]
+            if not reliable and not room.allow(len(targets)):
+                DROPPED.labels("room_rate").inc()
+                return
+        finally:
+            room.lock.release()
+
+        RELAY_FANOUT.observe(len(targets))
+        envelope = Envelope([(identifier, session, payload, seq)], fragment, reliable)
+        if reliable:
+            self.send_reliable(targets, envelope, sock)
+            return
+        for player in targets:
+            player.send_datagram(envelope, sock)
+
+    def channel(self, player):
+        """
+        Reliable channel with a player (created on first use)
+        """
+        channel = self.channels.get(player.identifier)
+        if channel is None:
+            self.channels_lock.acquire()
+            try:
+                channel = self.channels.setdefault(player.identifier,
+                                                   ReliableChannel(self.epoch(player)))
+            finally:
+                self.channels_lock.release()
+        return channel
+
+    def send_reliable(self, targets, envelope, sock):
+        """
+        Send an Envelope to players on their reliable channel
+        """
+        now = time.time()
+        for player in targets:
+            data = envelope.data(player)
+            channel = self.channel(player)
+            seq = channel.push(data, now)
+            if channel.stalled(now):
+                self.abandon(player, channel)
+                continue
+            self.channels_lock.acquire()
+            try:
+                self.resending[player.identifier] = channel
+            finally:
+                self.channels_lock.release()
+            if seq is not None:
+                player.send_datagram(frame(seq, channel.acks(), channel.epoch) + data,
+                                     sock)
+
+    def abandon(self, player, channel):
+        """
+        Give up the messages a player does not acknowledge any more (gone
+        without leaving, or never reachable), counted as dropped
+        """
+        dropped = channel.abandon(random.getrandbits(31) + 1)
+        DROPPED.labels("reliable_abandoned").inc(dropped)
+        self.channels_lock.acquire()
+        try:
+            self.resending.pop(player.identifier, None)
+        finally:
+            self.channels_lock.release()
+
+    def receive_reliable(self, identifier, reliable, item, sock):
+        """
+        Handle the [seq, ack, bits, epoch] of a reliable datagram from a
+        player, acknowledge it and return the requests now deliverable
+        in order (datagrams of another epoch are only answered with the
+        current one, so the player starts over, see ReliableChannel)
+        """
+        player = self.players.get(identifier)
+        if player is None:
+            return []
+        seq, ack, bits = reliable[:3]
+        channel = self.channel(player)
+        if len(reliable) > 3 and reliable[3] != channel.epoch:
+            player.send_datagram(frame(0, channel.acks(), channel.epoch), sock)
+            return []
+        channel.acknowledge(int(ack), int(bits))
+        if seq == 0:
+            return []
+        items = channel.receive(int(seq), item)
+        player.send_datagram(frame(0, channel.acks(), channel.epoch), sock)
+        return items
+
+    def resend(self, now, sock):
+        """
+        Resend the reliable messages players did not acknowledge in time
+        (and send the ones held by a full window), return the delay
+        until the next check (None without channels)
+        """
+        for identifier, channel in list(self.resending.items()):
+            player = self.players.get(identifier)
+            if player is not None and channel.stalled(now):
+                self.abandon(player, channel)
+            elif player is not None:
+                for seq, data in channel.due(now):
+                    player.send_datagram(frame(seq, channel.acks(), channel.epoch) + data,
+                                         sock)
+            self.channels_lock.acquire()
+            try:
+                if player is None or len(channel.pending) == 0:
+                    self.resending.pop(identifier, None)
+            finally:
+                self.channels_lock.release()
+        if len(self.channels) == 0:
+            return None
+        return RESEND_DELAY / 2
+
+    def ack(self, identifier, room_id, acks):
+        """
+        Record the states a player rebuilt in a delta room ({sender: seq})
+        """
+        room = self.rooms.get(room_id)
+        if room is None:
+            raise RoomNotFound()
+        if not room.is_in_room(identifier):
+            raise NotInRoom()
+        if room.delta is None:
+            return
+
+        for sender, seq in acks.items():
+            room.delta.ack(identifier, sender, int(seq))
+
+    def tick(self, now, sock):
+        """
+        Flush the tick rooms which are due and resend lost reliable
+        messages, return the delay until the next tick (None without
+        tick rooms nor reliable channels)
+        """
+        self.schedule_lock.acquire()
+        try:
+            due_rooms = []
+            while len(self.schedule) != 0 and self.schedule[0][0] <= now:
+                due, room_id = heapq.heappop(self.schedule)
+                room = self.rooms.get(room_id)
+                if room is None:
+                    continue
+                due_rooms.append(room)
+                #  Skip missed ticks instead of bursting to catch up
+                heapq.heappush(self.schedule,
+                               (max(due + 1.0 / room.tick_rate, now), room_id))
+            delay = None
+            if len(self.schedule) != 0:
+                delay = self.schedule[0][0] - now
+        finally:
+            self.schedule_lock.release()
+
+        for room in due_rooms:
+            room.flush(sock)
+
+        resend_delay = self.resend(now, sock)
+        if resend_delay is not None and (delay is None or resend_delay < delay):
+            delay = resend_delay
+        return delay
 
 
 class Room:
+    __slots__ = ("capacity", "players", "emptied_at", "session", "lock", "options",
+                 "tick_rate", "updates", "delta", "grid", "unplaced", "limit",
+                 "identifier", "name")
 
-    def __init__(self, identifier, capacity, room_name):
+    def __init__(self, identifier, capacity, room_name, options=None):
         """
         Create a new room on server
+
+        Options : tick_rate (relay the latest message of each player
+        tick_rate times per second), delta (relay dict messages as
+        changes since the state each player acknowledged), rate_limit
+        ((rate, burst) of datagrams relayed immediately, set by server)
         """
+        if options is None:
+            options = {}
         self.capacity = capacity
-        self.players = []
+        self.players = {}
+        self.emptied_at = time.time()
+        self.session = None
+        self.lock = TimedLock(Lock(), "room")
+        self.options = options
+        self.tick_rate = None
+        if options.get("tick_rate"):
+            self.tick_rate = float(options["tick_rate"])
+        self.updates = {}
+        self.delta = None
+        if options.get("delta"):
+            self.delta = DeltaEncoder()
+        #  Interest rooms : players positions, members without position
+        self.grid = None
+        self.unplaced = None
+        if options.get("interest_radius"):
+            self.grid = Grid(options["interest_radius"])
+            self.unplaced = set()
+        self.limit = None
+        if options.get("rate_limit"):
+            self.limit = TokenBucket(*options["rate_limit"])
         self.identifier = identifier
         if room_name is not None:
             self.name = room_name
         else:
             self.name = self.identifier
 
+    def describe(self):
+        """
+        Room description given by get_rooms
+        """
+        return {"id": self.identifier,
+                "name": self.name,
+                "nb_players": len(self.players),
+                "capacity": self.capacity}
+
     def join(self, player):
         """
         Add player to room
         """
-        if not self.is_full():
-            self.players.append(player)
-        else:
-            raise RoomFull()
+        self.lock.acquire()
+        try:
+            if not self.is_full():
+                self.players[player.identifier] = player
+                if self.grid is not None:
+                    self.unplaced.add(player.identifier)
+            else:
+                raise RoomFull()
+        finally:
+            self.lock.release()
 
     def leave(self, player):
         """
-        Remove player from room
+        Remove player from room, return True if the room became empty
         """
-        if player in self.players:
-            self.players.remove(player)
-        else:
-            raise NotInRoom()
+        self.lock.acquire()
+        try:
+            if player.identifier in self.players:
+                del self.players[player.identifier]
+                if self.grid is not None:
+                    self.grid.remove(player.identifier)
+                    self.unplaced.discard(player.identifier)
+            else:
+                raise NotInRoom()
+            emptied = self.is_empty()
+            if emptied:
+                self.emptied_at = time.time()
+        finally:
+            self.lock.release()
+
+        if self.delta is not None:
+            self.delta.forget(player.identifier)
+        return emptied
+
+    def allow(self, fan_out):
+        """
+        Spend the room budget for a message sent to fan_out players
+        (room lock held by caller)
+        """
+        if self.limit is None:
+            return True
+        return self.limit.take(time.time(), min(fan_out, self.limit.burst))
 
     def is_empty(self):
         """
@@ -177,12 +860,130 @@ class Room:
         """
         Check if player is in room
         """
-        in_room = False
-        for player in self.players:
-            if player.identifier == player_identifier:
-                in_room = True
-                break
-        return in_room
+        return player_identifier in self.players
+
+    def move(self, player_identifier, x, y):
+        """
+        Update the position of a player in an interest room
+        (room lock held by caller)
+        """
+        self.grid.move(player_identifier, x, y)
+        self.unplaced.discard(player_identifier)
+
+    def audience(self, sender):
+        """
+        Players receiving messages of sender (room lock held by caller)
+        """
+        position = None
+        if self.grid is not None:
+            position = self.grid.positions.get(sender)
+        if position is None:
+            return [player for player in self.players.values()
+                    if player.identifier != sender]
+
+        identifiers = self.grid.nearby(position[0], position[1])
+        identifiers.extend(self.unplaced)
+        return [self.players[identifier] for identifier in identifiers
+                if identifier != sender and identifier in self.players]
+
+    def flush(self, sock):
+        """
+        Send each player one datagram with the updates of the others
+        """
+        self.lock.acquire()
+        try:
+            updates = self.updates
+            self.updates = {}
+            targets = list(self.players.values())
+        finally:
+            self.lock.release()
+
+        if len(updates) == 0:
+            return
+
+        RELAY_FANOUT.observe(len(targets))
+        if self.delta is not None or self.grid is not None:
+            self.flush_each(updates, targets, sock)
+            return
+
+        entries = [(sender, session, payload, seq)
+                   for sender, (payload, seq, session) in updates.items()]
+        snapshot = [Envelope(group) for group in split_entries(entries)]
+        for player in targets:
+            if player.identifier not in updates:
+                envelopes = snapshot
+            elif len(updates) > 1:
+                envelopes = [Envelope(group) for group
+                             in split_entries([entry for entry in entries
+                                               if entry[0] != player.identifier])]
+            else:
+                continue
+            for envelope in envelopes:
+                player.send_datagram(envelope, sock)
+
+    def flush_each(self, updates, targets, sock):
+        """
+        Tick flush built for each player : updates of the players in
+        its area of interest (interest rooms), against the baseline it
+        acknowledged (delta rooms, always relayed as json)
+        """
+        states = {}
+        if self.delta is not None:
+            for sender, (payload, seq, session) in updates.items():
+                state = json.loads(payload)
+                if isinstance(state, dict):
+                    states[sender] = self.delta.update(sender, state)
+
+        for player in targets:
+            entries = []
+            for sender, (payload, seq, session) in updates.items():
+                if sender == player.identifier:
+                    continue
+                if self.grid is not None and not self.grid.sees(player.identifier, sender):
+                    continue
+                if sender in states:
+                    base = self.delta.baseline(sender, player.identifier)
+                    payload = json.dumps(self.delta.encode(sender,
+                                                           states[sender],
+                                                           base)).encode()
+                entries.append((sender, session, payload, seq))
+            for group in split_entries(entries):
+                if self.delta is None:
+                    player.send_datagram(Envelope(group), sock)
+                else:
+                    player.send_datagram(wrap_payloads([(sender, payload,
+                                                         numbered(player, seq))
+                                                        for sender, session, payload, seq
+                                                        in group]),
+                                         sock)
+
+    def send_delta(self, sender, payload, seq, targets, sock):
+        """
+        Relay a message of a delta room, encoding it once per baseline
+        """
+        state = json.loads(payload)
+        if not isinstance(state, dict):
+            encoded = {}
+            for player in targets:
+                data = encoded.get(player.sequenced)
+                if data is None:
+                    data = wrap_payload(sender, payload, numbered(player, seq))
+                    encoded[player.sequenced] = data
+                player.send_datagram(data, sock)
+            return
+
+        state_seq = self.delta.update(sender, state)
+        groups = {}
+        for player in targets:
+            base = self.delta.baseline(sender, player.identifier)
+            groups.setdefault((base, player.sequenced), []).append(player)
+
+        for (base, sequenced), players in groups.items():
+            data = encode_envelope(sender,
+                                   self.delta.encode(sender, state_seq, base),
+                                   seq if sequenced else None)
+            for player in players:
+                player.send_datagram(data, sock)
 
 
 class RoomFull(Exception):
@@ -199,3 +1000,13 @@ class NotInRoom(Exception):
 
 class ClientNotRegistered(Exception):
     pass
+
+
+class RoomRedirect(Exception):
+    def __init__(self, room_id, node):
+        """
+        Room is served by another node (host, tcp_port and udp_port)
+        """
+        Exception.__init__(self, room_id)
+        self.room_id = room_id
+        self.node = node
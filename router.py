@@ -0,0 +1,535 @@
+import json
+import struct
+import time
+from framing import pack_frame
+from metrics import DATAGRAMS_IN, BYTES_IN, TCP_REQUEST_SECONDS, PARSE_ERRORS, DROPPED, \
+    MATCHMAKING_QUEUE_SECONDS, MATCHES
+from rooms import RoomNotFound, NotInRoom, RoomFull, RoomRedirect, ClientNotRegistered, \
+    ROOM_OPTIONS
+from wire import PREFIX, decode_request, single_value, valid_fragment
+from fragments import MAX_MESSAGE_SIZE
+
+#  Tcp actions timed separately, others are timed as "other"
+ACTIONS = ("register", "heartbeat", "join", "autojoin", "get_rooms",
+           "create", "leave", "resolve")
+
+
+def legacy_complete(data):
+    """
+    True once a legacy tcp request is whole (valid json, or too large to
+    wait for more)
+    """
+    if len(data) >= MAX_MESSAGE_SIZE:
+        return True
+    try:
+        json.loads(data)
+    except ValueError:
+        return False
+    return True
+
+
+class Router:
+
+    def __init__(self, rooms):
+        """
+        Decode client requests and apply them to rooms
+
+        Locking is done by rooms : the registry for control actions and
+        each room for its own traffic
+        """
+        self.rooms = rooms
+        self.msg = '{"success": "%(success)s", "message":"%(message)s"}'
+
+    def handle_udp(self, data, address, sock):
+        """
+        Process one datagram received by the udp server
+
+        A datagram is either a json request or a json header followed
+        by a newline and the raw json message, relayed as is (headers with a "reliable" [seq, ack, bits] field belong to the
+        player reliable channel, seq 0 only carries acks), datagrams over
+        the per player limit are dropped before being decoded, binary
+        datagrams (see wire) are relayed by relay_binary, bind requests
+        give the udp address of a player (see bind), headers with a
+        "fragment" [message id, index, count] field carry one fragment of
+        a large message, relayed as is without reassembly, other raw
+        messages are decoded once to check they hold one json value, see
+        single_value
+        """
+        DATAGRAMS_IN.inc()
+        BYTES_IN.inc(len(data))
+        if not self.rooms.allow(address):
+            DROPPED.labels("player_rate").inc()
+            return
+        if data[:1] == PREFIX:
+            self.relay_binary(data, address, sock)
+            return
+        raw = None
+        newline = data.find(b"\n")
+        if newline != -1:
+            raw = data[newline + 1:]
+            data = data[:newline]
+
+        try:
+            data = json.loads(data)
+            if not isinstance(data, dict):
+                raise ValueError("Not a json object")
+            self.rooms.seen(data.get('identifier'))
+            if data.get('action') == "bind":
+                self.bind(data, address)
+                return
+            try:
+                reliable = data['reliable']
+            except KeyError:
+                reliable = None
+
+            if reliable is None:
+                self.relay(data, raw, sock)
+            else:
+                #  Reliable requests are relayed once, in order
+                for data, raw in self.rooms.receive_reliable(data.get('identifier'),
+                                                             reliable,
+                                                             (data, raw),
+                                                             sock):
+                    self.relay(data, raw, sock, True)
+
+        except (KeyError, TypeError, ValueError):
+            PARSE_ERRORS.labels("udp").inc()
+
+    def bind(self, data, address):
+        """
+        Send the datagrams of a player to the address of its bind request,
+        which carries the token given at register (a NAT may map the udp
+        port the player gave to another one)
+        """
+        identifier = data.get('identifier')
+        if not self.rooms.owns(identifier, data.get('payload')):
+            DROPPED.labels("spoofed").inc()
+            return
+        player = self.rooms.players.get(identifier)
+        if player is not None:
+            player.udp_addr = (address[0], address[1])
+
+    def relay(self, data, raw, sock, reliable=False):
+        """
+        Apply one decoded udp request (raw is the message to relay as is)
+        """
+        try:
+            identifier = data['identifier']
+        except KeyError:
+            identifier = None
+
+        try:
+            room_id = data['room_id']
+        except KeyError:
+            room_id = None
+
+        try:
+            payload = data['payload']
+        except KeyError:
+            payload = None
+
+        try:
+            action = data['action']
+        except KeyError:
+            action = None
+
+        try:
+            position = data['position']
+        except KeyError:
+            position = None
+
+        #  Reliable messages are numbered by the sender reliable channel,
+        #  others may be by the sender itself (only given to sequenced
+        #  players, see numbered)
+        if reliable:
+            seq = int(data['reliable'][0])
+        else:
+            seq = data.get('seq')
+            if not isinstance(seq, int) or isinstance(seq, bool) or seq <= 0:
+                seq = None
+
+        try:
+            fragment = data['fragment']
+        except KeyError:
+            fragment = None
+
+        #  Fragment headers are relayed to binary players packed : checked
+        #  before the fan-out, so no recipient is skipped half way
+        if fragment is not None and not valid_fragment(fragment):
+            DROPPED.labels("invalid_message").inc()
+            return
+
+        #  Whole messages are spliced in envelopes as is : one json value only
+        if raw is not None and fragment is None and not single_value(raw):
+            DROPPED.labels("invalid_message").inc()
+            return
+
+        try:
+            if room_id not in self.rooms.rooms.keys():
+                raise RoomNotFound
+            if action == "send":
+                try:
+                    if raw is None:
+                        self.rooms.send(identifier,
+                                        room_id,
+                                        payload['message'],
+                                        sock,
+                                        position,
+                                        seq,
+                                        reliable)
+                    else:
+                        self.rooms.send_data(identifier,
+                                             room_id,
+                                             raw,
+                                             sock,
+                                             position,
+                                             seq,
+                                             reliable,
+                                             fragment)
+                except:
+                    DROPPED.labels("rejected").inc()
+            elif action == "ack":
+                try:
+                    self.rooms.ack(identifier, room_id, payload)
+                except:
+                    DROPPED.labels("rejected").inc()
+            elif action == "sendto":
+                try:
+                    if raw is None:
+                        self.rooms.sendto(identifier,
+                                          room_id,
+                                          payload['recipients'],
+                                          payload['message'],
+                                          sock,
+                                          seq,
+                                          reliable)
+                    else:
+                        self.rooms.sendto_data(identifier,
+                                               room_id,
+                                               payload['recipients'],
+                                               raw,
+                                               sock,
+                                               seq,
+                                               reliable,
+                                               fragment)
+                except:
+                    DROPPED.labels("rejected").inc()
+        except RoomNotFound:
+            DROPPED.labels("room_not_found").inc()
+
+    def relay_binary(self, data, address, sock):
+        """
+        Apply one binary send or sendto request (see wire), sessions are
+        small numbers : requests not coming from the udp address of the
+        player (given at register, or learned by bind) are dropped (binary
+        requests are never reliable, their seq is the sender own one, see
+        numbered)
+        """
+        try:
+            (player_session, room_session, seq, recipients, position,
+             fragment, payload) = decode_request(data)
+        except struct.error:
+            PARSE_ERRORS.labels("udp").inc()
+            return
+
+        player = self.rooms.sessions.get(player_session)
+        room = self.rooms.room_sessions.get(room_session)
+        if player is None or room is None:
+            DROPPED.labels("unknown_session").inc()
+            return
+        if tuple(address[:2]) != player.udp_addr:
+            DROPPED.labels("spoofed").inc()
+            return
+        if fragment is None and not single_value(payload):
+            DROPPED.labels("invalid_message").inc()
+            return
+        player.last_seen = time.time()
+
+        try:
+            if recipients is None:
+                self.rooms.send_data(player.identifier,
+                                     room.identifier,
+                                     payload,
+                                     sock,
+                                     position,
+                                     seq,
+                                     fragment=fragment)
+            else:
+                self.rooms.sendto_data(player.identifier,
+                                       room.identifier,
+                                       [self.rooms.sessions[recipient].identifier
+                                        for recipient in recipients
+                                        if recipient in self.rooms.sessions],
+                                       payload,
+                                       sock,
+                                       seq,
+                                       fragment=fragment)
+        except Exception:
+            DROPPED.labels("rejected").inc()
+
+    def handle_tcp(self, conn, addr, data):
+        """
+        Process one control request received by the tcp server
+        """
+        start = time.perf_counter()
+        try:
+            data = json.loads(data)
+            action = data['action']
+            identifier = None
+            try:
+                identifier = data['identifier']
+            except KeyError:
+                pass  # Silently pass
+
+            room_id = None
+            try:
+                room_id = data['room_id']
+            except KeyError:
+                pass  # Silently pass
+
+            payload = None
+            try:
+                payload = data['payload']
+            except KeyError:
+                pass  # Silently pass
+            self.route(conn,
+                       addr,
+                       action,
+                       payload,
+                       identifier,
+                       room_id)
+            if action not in ACTIONS:
+                action = "other"
+            TCP_REQUEST_SECONDS.labels(action).observe(time.perf_counter() - start)
+        except KeyError:
+            PARSE_ERRORS.labels("tcp").inc()
+            print("Json from %s:%s is not valid" % addr)
+            conn.send("Json is not valid".encode())
+        except ValueError:
+            PARSE_ERRORS.labels("tcp").inc()
+            print("Message from %s:%s is not valid json string" % addr)
+            conn.send("Message is not a valid json string".encode())
+        except OSError:
+            raise  # Connection lost, the session ends
+        except Exception as e:
+            #  A bad request must not end a persistent session
+            PARSE_ERRORS.labels("tcp").inc()
+            print("Request from %s:%s failed (%s)" % (addr[0], addr[1], repr(e)))
+            conn.send((self.msg % {"success": "False",
+                                   "message": "Invalid request"}).encode())
+
+    def route(self,
+              sock,
+              addr,
+              action,
+              payload,
+              identifier=None,
+              room_id=None):
+        """
+        Route received data for processing
+        """
+        if action == "register":
+            #  Payload is the udp port, or a dict asking for a protocol
+            #  and for sender sequence numbers
+            #  (and the token proving the identifier given is ours)
+            binary = False
+            sequenced = False
+            token = None
+            if isinstance(payload, dict):
+                binary = payload.get("protocol") == "binary"
+                sequenced = payload.get("sequenced") is True
+                token = payload.get("token")
+                payload = payload["udp_port"]
+            try:
+                client = self.rooms.register(addr, int(payload), identifier, binary,
+                                             sequenced, token)
+            except (TypeError, ValueError):
+                sock.send((self.msg % {"success": "False",
+                                       "message": "Invalid udp port"}).encode())
+                return 0
+            except ClientNotRegistered:
+                sock.send((self.msg % {"success": "False",
+                                       "message": "Unknown identifier"}).encode())
+                return 0
+            #  Epoch the reliable channel of the client starts from, token
+            #  to give to register again with the same identifier
+            extra = {"epoch": self.rooms.epoch(client),
+                     "token": self.rooms.token(client.identifier)}
+            if binary:
+                extra.update({"protocol": "binary", "session": client.session})
+            client.send_tcp(True, client.identifier, sock, extra)
+            return 0
+
+        if identifier is None:
+            sock.send((self.msg % {"success": "False",
+                                   "message": "You must register"}).encode())
+            return 0
+
+        if identifier is not None:
+            if identifier not in self.rooms.players.keys():
+                print("Unknown identifier %s for %s:%s" % (identifier, addr[0], addr[1]))
+                sock.send((self.msg % {"success": "False", "message": "Unknown identifier"}).encode())
+                return 0
+
+            # Get client object
+            client = self.rooms.players[identifier]
+            client.last_seen = time.time()
+            #  One-shot connections : the udp endpoint of join answers is
+            #  not followed (see ShardedRooms)
+            legacy = not isinstance(sock, FramedReply)
+
+            if action == "heartbeat":
+                return 0  # No response, last_seen is enough
+            elif action == "join":
+                try:
+                    #  Only autojoin picks a room : a room id is required
+                    #  (rooms of other nodes are looked up by rooms.join)
+                    if not isinstance(payload, str):
+                        raise RoomNotFound()
+                    self.rooms.join(identifier, payload, legacy)
+                    self.joined(client, payload, sock)
+                except RoomNotFound:
+                    client.send_tcp(False, room_id, sock)
+                except RoomFull:
+                    client.send_tcp(False, room_id, sock)
+                except RoomRedirect as e:
+                    client.send_tcp(False, e.room_id, sock, {"redirect": e.node})
+            elif action == "autojoin":
+                if self.rooms.matchmaker is not None and not legacy:
+                    #  Answered once matched, see matchmake (legacy one-shot
+                    #  connections are closed too early : first-fit for them)
+                    criteria = payload if isinstance(payload, dict) else {}
+                    superseded = self.rooms.matchmaker.enqueue(identifier,
+                                                               sock,
+                                                               time.time(),
+                                                               criteria.get("region"),
+                                                               criteria.get("rating"),
+                                                               criteria.get("party"),
+                                                               criteria.get("party_size", 1))
+                    for other, other_sock, enqueued_at in superseded:
+                        try:
+                            client.send_tcp(False, "Superseded", other_sock)
+                        except OSError:
+                            pass  # Player gone
+                    return 0
+                try:
+                    room_id = self.rooms.join(identifier, legacy=legacy)
+                    self.joined(client, room_id, sock)
+                except RoomRedirect as e:
+                    client.send_tcp(False, e.room_id, sock, {"redirect": e.node})
+            elif action == "get_rooms":
+                #  Payload is None (every room) or a query, see RoomListing
+                if not isinstance(payload, dict):
+                    payload = None
+                try:
+                    answer = self.rooms.query_rooms(payload)
+                except ValueError as e:
+                    client.send_tcp(False, str(e), sock)
+                    return 0
+                client.send_tcp_encoded(answer, sock)
+            elif action == "create":
+                if isinstance(payload, dict):
+                    options = dict((key, payload[key]) for key in ROOM_OPTIONS
+                                   if key in payload)
+                    room_identifier = self.rooms.create(payload.get("name"),
+                                                        options=options,
+                                                        legacy=legacy)
+                else:
+                    room_identifier = self.rooms.create(payload, legacy=legacy)
+                self.rooms.join(client.identifier, room_identifier, legacy)
+                self.joined(client, room_identifier, sock)
+            elif action == 'leave':
+                try:
+                    if room_id not in self.rooms.rooms:
+                        raise RoomNotFound()
+                    self.rooms.leave(identifier, room_id)
+                    client.send_tcp(True, room_id, sock)
+                except RoomNotFound:
+                    client.send_tcp(False, room_id, sock)
+                except NotInRoom:
+                    client.send_tcp(False, room_id, sock)
+            elif action == "resolve":
+                #  Only players sharing a room with the requester are resolved
+                joined = [self.rooms.rooms.get(room_id)
+                          for room_id in self.rooms.memberships.get(identifier, ())]
+                identifiers = {}
+                for session in payload:
+                    player = self.rooms.sessions.get(int(session))
+                    if player is not None and any(room is not None and
+                                                  room.is_in_room(player.identifier)
+                                                  for room in joined):
+                        identifiers[session] = player.identifier
+                client.send_tcp(True, identifiers, sock)
+            else:
+                client.send_tcp(False, "Unknown action", sock)
+
+
+    def matchmake(self, now):
+        """
+        Form a batch of matches, each in a new room, and answer the
+        autojoin requests of their players
+        """
+        for players, full in self.rooms.matchmaker.form(now):
+            MATCHES.labels("full" if full else "partial").inc()
+            room_id = self.rooms.create()
+            for identifier, sock, enqueued_at in players:
+                MATCHMAKING_QUEUE_SECONDS.observe(now - enqueued_at)
+                client = self.rooms.players.get(identifier)
+                if client is None:
+                    continue  # Evicted while waiting
+                try:
+                    self.rooms.join(identifier, room_id)
+                except (ClientNotRegistered, RoomNotFound, RoomFull):
+                    try:
+                        client.send_tcp(False, room_id, sock)
+                    except OSError:
+                        pass  # Player gone
+                    continue
+                try:
+                    self.joined(client, room_id, sock)
+                except OSError:
+                    #  Player gone : not left in the room as a ghost
+                    try:
+                        self.rooms.leave(identifier, room_id)
+                    except (ClientNotRegistered, RoomNotFound, NotInRoom):
+                        pass
+
+    def joined(self, client, room_id, sock):
+        """
+        Answer a successful join with where the room lives (and, for
+        binary players, the sessions of the room and its players)
+        """
+        extra = self.rooms.endpoint(room_id)
+        if client.binary:
+            room = self.rooms.rooms[room_id]
+            extra = dict(extra or {})
+            extra["room_session"] = room.session
+            extra["sessions"] = dict((player.identifier, player.session)
+                                     for player in list(room.players.values()))
+        client.send_tcp(True, room_id, sock, extra)
+
+
+class FramedReply:
+    def __init__(self, conn, request_id, lock=None):
+        """
+        Socket-like wrapper answering one request of a framed session
+        (lock serializes writes when answers may come from another
+        thread, e.g. matchmaking)
+        """
+        self.conn = conn
+        self.request_id = request_id
+        self.lock = lock
+
+    def send(self, data):
+        """
+        Send data as the response frame of the request
+        """
+        if self.lock is None:
+            self.conn.sendall(pack_frame(self.request_id, data))
+            return len(data)
+        self.lock.acquire()
+        try:
+            self.conn.sendall(pack_frame(self.request_id, data))
+        finally:
+            self.lock.release()
+        return len(data)
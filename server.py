@@ -1,28 +1,66 @@
 #!/usr/bin/python
 
 import argparse
+import os
+import select
 import socket
-import json
 import time
-from threading import Thread, Lock
-from rooms import Rooms, RoomNotFound, NotInRoom, RoomFull
-
-
-def main_loop(tcp_port, udp_port, rooms):
+from threading import Thread, Event, Lock
+from framing import FRAME_HEADER, recv_exactly, recv_frame
+from metrics import MeteredSocket, StatsServer, DROPPED, metrics
+from reliable import LossySocket
+from rooms import Rooms
+import snapshot
+from router import Router, FramedReply, legacy_complete
+from fragments import MAX_DATAGRAM, SOCKET_BUFFER
+
+
+def main_loop(tcp_port, udp_port, rooms, mode="threaded", loss=0.0,
+              stats_port=None, snapshot_path=None, snapshot_interval=10.0):
     """
-    Start udp and tcp server threads
+    Start udp and tcp servers (threaded or asyncio engine), loss is
+    the share of udp datagrams dropped on purpose (tests), metrics are
+    served on the local stats_port if given, the registry is saved to
+    snapshot_path every snapshot_interval seconds (and restored from
+    it on start)
     """
-    lock = Lock()
-    udp_server = UdpServer(udp_port, rooms, lock)
-    tcp_server = TcpServer(tcp_port, rooms, lock)
-    udp_server.start()
-    tcp_server.start()
+    if snapshot_path is not None:
+        restore(rooms, snapshot_path)
+
+    #  Sharded rooms are relayed by their worker processes
+    workers = getattr(rooms, "workers", [])
+    if len(workers) != 0:
+        udp_port = None
+
+    if mode == "asyncio":
+        from aioserver import AsyncServer
+        async_server = AsyncServer(tcp_port, udp_port, rooms, loss)
+        servers = [async_server]
+    else:
+        tcp_server = TcpServer(tcp_port, rooms)
+        servers = [tcp_server]
+        if udp_port is not None:
+            udp_server = UdpServer(udp_port, rooms, loss)
+            servers.append(udp_server)
+            servers.append(Ticker(rooms, udp_server.sock))
+    servers.extend(workers)
+    if rooms.idle_timeout or rooms.empty_grace is not None:
+        servers.append(Reaper(rooms))
+    if rooms.matchmaker is not None and mode != "asyncio":
+        servers.append(Matchmaking(rooms))
+    if stats_port:
+        servers.append(StatsServer(stats_port))
+    if snapshot_path is not None:
+        servers.append(Snapshotter(rooms, snapshot_path, snapshot_interval))
+    for server in servers:
+        server.start()
     is_running = True
     print("Simple Game Server.")
     print("--------------------------------------")
     print("list : list rooms")
     print("room #room_id : print room information")
     print("user #user_id : print user information")
+    print("stats : print server metrics")
     print("quit : quit server")
     print("--------------------------------------")
 
@@ -30,11 +68,11 @@ def main_loop(tcp_port, udp_port, rooms):
         cmd = input("cmd >")
         if cmd == "list":
             print("Rooms :")
-            for room_id, room in rooms.rooms.items():
-                print("%s - %s (%d/%d)" % (room.identifier,
-                                           room.name,
-                                           len(room.players),
-                                           room.capacity))
+            for room in rooms.list_rooms():
+                print("%s - %s (%d/%d)" % (room["id"],
+                                           room["name"],
+                                           room["nb_players"],
+                                           room["capacity"]))
         elif cmd.startswith("room "):
             try:
                 id = cmd[5:]
@@ -44,111 +82,101 @@ def main_loop(tcp_port, udp_port, rooms):
                                            len(room.players),
                                            room.capacity))
                 print("Players :")
-                for player in room.players:
+                for player in list(room.players.values()):
                     print(player.identifier)
             except:
                 print("Error while getting room informations")
         elif cmd.startswith("user "):
             try:
                 player = rooms.players[cmd[5:]]
-                print("%s : %s:%d" % (player.identifier,
-                                      player.udp_addr[0],
-                                      player.udp_addr[1]))
+                print("%s : %s:%d (last seen %ds ago)" % (player.identifier,
+                                                          player.udp_addr[0],
+                                                          player.udp_addr[1],
+                                                          time.time() - player.last_seen))
             except:
                 print("Error while getting user informations")
+        elif cmd == "stats":
+            for line in metrics.summary():
+                print(line)
+            if rooms.matchmaker is not None:
+                print("Players waiting for a match : %d" % rooms.matchmaker.size())
         elif cmd == "quit":
             print("Shutting down  server...")
-            udp_server.is_listening = False
-            tcp_server.is_listening = False
+            for server in servers:
+                server.stop_listening()
             is_running = False
 
-    udp_server.join()
-    tcp_server.join()
+    for server in servers:
+        server.join()
+
+
+def restore(rooms, path):
+    """
+    Load the registry snapshot at path, if any
+    """
+    if not os.path.exists(path):
+        return
+    start = time.perf_counter()
+    try:
+        nb_players, nb_rooms = snapshot.load(rooms, path)
+    except (OSError, ValueError) as e:
+        print("Snapshot %s not restored (%s)" % (path, e))
+        return
+    print("Restored %d players and %d rooms from %s in %.1f ms" % (
+        nb_players, nb_rooms, path, (time.perf_counter() - start) * 1000))
 
 
 class UdpServer(Thread):
-    def __init__(self, udp_port, rooms, lock):
+    def __init__(self, udp_port, rooms, loss=0.0):
         """
-        Create a new udp server
+        Create a new udp server (dropping a loss share of the
+        datagrams it sends, see LossySocket)
+
+        The socket never blocks : a datagram which does not fit in the
+        send buffer is dropped and its recipient skipped for a while
         """
         Thread.__init__(self)
         self.rooms = rooms
-        self.lock = lock
+        self.router = Router(rooms)
         self.is_listening = True
         self.udp_port = int(udp_port)
-        self.msg = '{"success": %(success)s, "message":"%(message)s"}'
+        self.sock = socket.socket(socket.AF_INET,
+                                  socket.SOCK_DGRAM)
+        self.sock.bind(("0.0.0.0", self.udp_port))
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        self.sock = MeteredSocket(self.sock)
+        if loss:
+            self.sock = LossySocket(self.sock, loss)
 
     def run(self):
         """
         Start udp server
         """
-        self.sock = socket.socket(socket.AF_INET,
-                                  socket.SOCK_DGRAM)
-        self.sock.bind(("0.0.0.0", self.udp_port))
-        self.sock.setblocking(0)
-        self.sock.settimeout(5)
         while self.is_listening:
+            readable, writable, failed = select.select([self.sock], [], [], 5)
+            if len(readable) == 0:
+                continue
             try:
-                data, address = self.sock.recvfrom(1024)
-            except socket.timeout:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, ConnectionResetError):
                 continue
 
+            #  One bad datagram must not end the only udp thread
             try:
-                data = json.loads(data)
-                try:
-                    identifier = data['identifier']
-                except KeyError:
-                    identifier = None
-
-                try:
-                    room_id = data['room_id']
-                except KeyError:
-                    room_id = None
-
-                try:
-                    payload = data['payload']
-                except KeyError:
-                    payload = None
-
-                try:
-                    action = data['action']
-                except KeyError:
-                    action = None
-
-                try:
-                    if room_id not in self.rooms.rooms.keys():
-                        raise RoomNotFound
-                    self.lock.acquire()
-                    try:
-                        if action == "send":
-                            try:
-                                self.rooms.send(identifier,
-                                                room_id,
-                                                payload['message'],
-                                                self.sock)
-                            except:
-                                pass
-                        elif action == "sendto":
-                            try:
-                                self.rooms.sendto(identifier,
-                                                  room_id,
-                                                  payload['recipients'],
-                                                  payload['message'],
-                                                  self.sock)
-                            except:
-                                pass
-                    finally:
-                        self.lock.release()
-                except RoomNotFound:
-                    print("Room not found")
-
-            except KeyError:
-                print("Json from %s:%s is not valid" % address)
-            except ValueError:
-                print("Message from %s:%s is not valid json string" % address)
+                self.router.handle_udp(data, address, self.sock)
+            except Exception:
+                DROPPED.labels("error").inc()
 
         self.stop()
 
+    def stop_listening(self):
+        """
+        Ask the server loop to exit
+        """
+        self.is_listening = False
+
     def stop(self):
         """
         Stop server
@@ -156,17 +184,151 @@ class UdpServer(Thread):
         self.sock.close()
 
 
+class Ticker(Thread):
+    def __init__(self, rooms, sock):
+        """
+        Drive periodic room work (tick rooms, reliable resends) on the
+        udp server socket
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.rooms = rooms
+        self.sock = sock
+        self.is_listening = True
+        self.wakeup = Event()
+
+    def run(self):
+        """
+        Tick rooms until stopped
+        """
+        while self.is_listening:
+            #  A failed flush must not stop every tick room
+            try:
+                delay = self.rooms.tick(time.time(), self.sock)
+            except Exception as e:
+                print("Tick failed (%s)" % repr(e))
+                delay = None
+            if delay is None or delay > 0.5:
+                delay = 0.5
+            if delay > 0:
+                self.wakeup.wait(delay)
+
+    def stop_listening(self):
+        """
+        Ask the ticker to exit
+        """
+        self.is_listening = False
+        self.wakeup.set()
+
+
+class Reaper(Thread):
+    def __init__(self, rooms):
+        """
+        Evict idle players, one timer wheel step at a time, and delete
+        the rooms left empty
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.rooms = rooms
+        self.is_listening = True
+        self.wakeup = Event()
+
+    def run(self):
+        """
+        Advance the idle timers and the empty rooms queue until stopped
+        """
+        while self.is_listening:
+            now = time.time()
+            for identifier in self.rooms.evict_idle(now):
+                print("Player %s evicted (idle)" % identifier)
+            self.rooms.remove_empty(now)
+            self.wakeup.wait(self.rooms.idle.resolution)
+
+    def stop_listening(self):
+        """
+        Ask the reaper to exit
+        """
+        self.is_listening = False
+        self.wakeup.set()
+
+
+class Snapshotter(Thread):
+    def __init__(self, rooms, path, interval):
+        """
+        Save the registry to path every interval seconds, and once
+        more when the server quits
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.rooms = rooms
+        self.path = path
+        self.interval = interval
+        self.is_listening = True
+        self.wakeup = Event()
+
+    def run(self):
+        """
+        Save snapshots until stopped
+        """
+        while True:
+            self.wakeup.wait(self.interval)
+            try:
+                snapshot.save(self.rooms, self.path)
+            except OSError as e:
+                print("Snapshot %s not saved (%s)" % (self.path, e))
+            if not self.is_listening:
+                break
+
+    def stop_listening(self):
+        """
+        Ask the snapshotter to save a last snapshot and exit
+        """
+        self.is_listening = False
+        self.wakeup.set()
+
+
+class Matchmaking(Thread):
+    def __init__(self, rooms):
+        """
+        Form matches from the queued autojoin requests, one batch per
+        matchmaker interval
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.router = Router(rooms)
+        self.interval = rooms.matchmaker.interval
+        self.is_listening = True
+        self.wakeup = Event()
+
+    def run(self):
+        """
+        Form batches until stopped
+        """
+        while self.is_listening:
+            try:
+                self.router.matchmake(time.time())
+            except Exception as e:
+                print("Matchmaking failed (%s)" % repr(e))
+            self.wakeup.wait(self.interval)
+
+    def stop_listening(self):
+        """
+        Ask the matchmaking thread to exit
+        """
+        self.is_listening = False
+        self.wakeup.set()
+
+
 class TcpServer(Thread):
-    def __init__(self, tcp_port, rooms, lock):
+    def __init__(self, tcp_port, rooms):
         """
         Create a new tcp server
         """
         Thread.__init__(self)
-        self.lock = lock
+        self.router = Router(rooms)
         self.tcp_port = int(tcp_port)
         self.rooms = rooms
         self.is_listening = True
-        self.msg = '{"success": "%(success)s", "message":"%(message)s"}'
 
     def run(self):
         """
@@ -174,127 +336,31 @@ class TcpServer(Thread):
         """
         self.sock = socket.socket(socket.AF_INET,
                                   socket.SOCK_STREAM)
+        #  A restarted server binds again at once, despite the
+        #  connections of the previous process left in TIME_WAIT
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind(('0.0.0.0', self.tcp_port))
         self.sock.setblocking(0)
         self.sock.settimeout(5)
-        time_reference = time.time()
-        self.sock.listen(1)
+        self.sock.listen(128)
 
         while self.is_listening:
-
-            #  Clean empty rooms
-            if time_reference + 60 < time.time():
-                self.rooms.remove_empty()
-                time_reference = time.time()
             try:
                 conn, addr = self.sock.accept()
             except socket.timeout:
                 continue
 
-            data = conn.recv(1024)
-            try:
-                data = json.loads(data)
-                action = data['action']
-                identifier = None
-                try:
-                    identifier = data['identifier']
-                except KeyError:
-                    pass  # Silently pass
-
-                room_id = None
-                try:
-                    room_id = data['room_id']
-                except KeyError:
-                    pass  # Silently pass
-
-                payload = None
-                try:
-                    payload = data['payload']
-                except KeyError:
-                    pass  # Silently pass
-                self.lock.acquire()
-                try:
-                    self.route(conn,
-                               addr,
-                               action,
-                               payload,
-                               identifier,
-                               room_id)
-                finally:
-                    self.lock.release()
-            except KeyError:
-                print("Json from %s:%s is not valid" % addr)
-                conn.send("Json is not valid")
-            except ValueError:
-                print("Message from %s:%s is not valid json string" % addr)
-                conn.send("Message is not a valid json string")
-
-            conn.close()
+            conn.settimeout(None)
+            session = TcpSession(conn, addr, self.router)
+            session.start()
 
         self.stop()
 
-    def route(self,
-              sock,
-              addr,
-              action,
-              payload,
-              identifier=None,
-              room_id=None):
-        """
-        Route received data for processing
-        """
-        if action == "register":
-            client = self.rooms.register(addr, int(payload))
-            client.send_tcp(True, client.identifier, sock)
-            return 0
-
-        if identifier is not None:
-            if identifier not in self.rooms.players.keys():
-                print("Unknown identifier %s for %s:%s" % (identifier, addr[0], addr[1]))
-                sock.send(self.msg % {"success": "False", "message": "Unknown identifier"})
-                return 0
-
-            # Get client object
-            client = self.rooms.players[identifier]
-
-            if action == "join":
-                try:
-                    if payload not in self.rooms.rooms.keys():
-                        raise RoomNotFound()
-                    self.rooms.join(identifier, payload)
-                    client.send_tcp(True, payload, sock)
-                except RoomNotFound:
-                    client.send_tcp(False, room_id, sock)
-                except RoomFull:
-                    client.send_tcp(False, room_id, sock)
-            elif action == "autojoin":
-                room_id = self.rooms.join(identifier)
-                client.send_tcp(True, room_id, sock)
-            elif action == "get_rooms":
-                rooms = []
-                for id_room, room in self.rooms.rooms.items():
-                    rooms.append({"id": id_room,
-                                  "name": room.name,
-                                  "nb_players": len(room.players),
-                                  "capacity": room.capacity})
-                client.send_tcp(True, rooms, sock)
-            elif action == "create":
-                room_identifier = self.rooms.create(payload)
-                self.rooms.join(client.identifier, room_identifier)
-                client.send_tcp(True, room_identifier, sock)
-            elif action == 'leave':
-                try:
-                    if room_id not in self.rooms.rooms:
-                        raise RoomNotFound()
-                    self.rooms.leave(identifier, room_id)
-                    client.send_tcp(True, room_id, sock)
-                except RoomNotFound:
-                    client.send_tcp(False, room_id, sock)
-                except NotInRoom:
-                    client.send_tcp(False, room_id, sock)
-            else:
-                sock.send_tcp(self.msg % {"success": "False",
-                                          "message": "You must register"})
+    def stop_listening(self):
+        """
+        Ask the server loop to exit
+        """
+        self.is_listening = False
 
     def stop(self):
         """
@@ -303,6 +369,54 @@ class TcpServer(Thread):
         self.sock.close()
 
 
+class TcpSession(Thread):
+    def __init__(self, conn, addr, router):
+        """
+        Serve the requests of one tcp connection
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.conn = conn
+        #  Answers may also be sent by the matchmaking thread
+        self.write_lock = Lock()
+        self.addr = addr
+        self.router = router
+
+    def run(self):
+        """
+        Serve a legacy one-shot request or a framed persistent session
+        """
+        try:
+            first = recv_exactly(self.conn, 1)
+            if first is None:
+                return
+            if first == b"{":
+                #  Legacy client : one json request per connection
+                data = first + self.conn.recv(1023)
+                #  Requests filling the first read may go on
+                while len(data) >= 1024 and not legacy_complete(data):
+                    chunk = self.conn.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                self.router.handle_tcp(self.conn, self.addr, data)
+                return
+
+            header = first + (recv_exactly(self.conn, FRAME_HEADER.size - 1) or b"")
+            while len(header) == FRAME_HEADER.size:
+                request_id, body = recv_frame(self.conn, header)
+                if request_id is None:
+                    break
+                self.router.handle_tcp(FramedReply(self.conn, request_id, self.write_lock),
+                                       self.addr,
+                                       body)
+                header = recv_exactly(self.conn, FRAME_HEADER.size) or b""
+        except (OSError, ValueError):
+            pass  # Client gone or sent garbage
+        finally:
+            self.conn.close()
+
+
 if __name__ == "__main__":
     """
     Start a game server
@@ -320,7 +434,153 @@ if __name__ == "__main__":
                         dest='room_capacity',
                         help='Max players per room',
                         default="3")
+    parser.add_argument('--tick-rate',
+                        dest='tick_rate',
+                        help='Default room tick rate in Hz (0 relays every message immediately)',
+                        default="0")
+    parser.add_argument('--delta',
+                        dest='delta',
+                        help='Relay dict messages as changes since the state each player acknowledged',
+                        action='store_true')
+    parser.add_argument('--interest-radius',
+                        dest='interest_radius',
+                        help='Default area of interest radius (0 sends room messages to every player)',
+                        default="0")
+    parser.add_argument('--workers',
+                        dest='workers',
+                        help='Udp relay worker processes (udp ports udpport to udpport + workers - 1)',
+                        default="1")
+    parser.add_argument('--directory',
+                        dest='directory',
+                        help='Cluster mode : room directory address (host:port)',
+                        default=None)
+    parser.add_argument('--advertise',
+                        dest='advertise',
+                        help='Cluster mode : host given to redirected clients',
+                        default="127.0.0.1")
+    parser.add_argument('--mode',
+                        dest='mode',
+                        help='Server engine (threaded or asyncio)',
+                        choices=["threaded", "asyncio"],
+                        default="threaded")
+    parser.add_argument('--idle-timeout',
+                        dest='idle_timeout',
+                        help='Evict players not seen for this many seconds (0, the default, keeps them forever)',
+                        default="0")
+    parser.add_argument('--empty-room-grace',
+                        dest='empty_grace',
+                        help='Delete rooms left empty for this many seconds',
+                        default="10")
+    parser.add_argument('--player-rate',
+                        dest='player_rate',
+                        help='Udp datagrams per second accepted from each player (0 for no limit)',
+                        default="0")
+    parser.add_argument('--player-burst',
+                        dest='player_burst',
+                        help='Udp datagrams accepted at once from a player (default one second of player rate)',
+                        default=None)
+    parser.add_argument('--room-rate',
+                        dest='room_rate',
+                        help='Datagrams per second relayed by each room (0 for no limit)',
+                        default="0")
+    parser.add_argument('--room-burst',
+                        dest='room_burst',
+                        help='Datagrams relayed at once by a room (default one second of room rate)',
+                        default=None)
+    parser.add_argument('--matchmaking',
+                        dest='matchmaking',
+                        help='Queue autojoin requests and form rooms every this many seconds (0 joins the first non-full room)',
+                        default="0")
+    parser.add_argument('--match-size',
+                        dest='match_size',
+                        help='Players per matched room (0 for the room capacity)',
+                        default="0")
+    parser.add_argument('--match-max-wait',
+                        dest='match_max_wait',
+                        help='Seconds after which waiting players get a room even if not full',
+                        default="2")
+    parser.add_argument('--rating-spread',
+                        dest='rating_spread',
+                        help='Largest rating difference within a matched room',
+                        default="100")
+    parser.add_argument('--rating-spread-growth',
+                        dest='rating_spread_growth',
+                        help='Rating spread added per second waited',
+                        default="50")
+    parser.add_argument('--stats-port',
+                        dest='stats_port',
+                        help='Local tcp port serving metrics in Prometheus text format (0 disables it)',
+                        default="0")
+    parser.add_argument('--snapshot',
+                        dest='snapshot',
+                        help='File the player and room registry is saved to, and restored from on start',
+                        default=None)
+    parser.add_argument('--snapshot-interval',
+                        dest='snapshot_interval',
+                        help='Seconds between registry snapshots',
+                        default="10")
+    parser.add_argument('--loss',
+                        dest='loss',
+                        help='Share of sent udp datagrams dropped on purpose, to test reliable messages (0 to 1)',
+                        default="0")
 
     args = parser.parse_args()
-    rooms = Rooms(int(args.room_capacity))
-    main_loop(args.tcp_port, args.udp_port, rooms)
+    options = {"tick_rate": float(args.tick_rate) or None,
+               "delta": args.delta,
+               "interest_radius": float(args.interest_radius) or None}
+    if float(args.room_rate):
+        options["rate_limit"] = (float(args.room_rate),
+                                 args.room_burst and float(args.room_burst))
+    idle_timeout = float(args.idle_timeout) or None
+    empty_grace = float(args.empty_grace)
+    player_limit = None
+    if float(args.player_rate):
+        player_limit = (float(args.player_rate),
+                        args.player_burst and float(args.player_burst))
+    matchmaking = None
+    if float(args.matchmaking):
+        if int(args.match_size) > int(args.room_capacity):
+            parser.error("--match-size can not exceed --capacity")
+        matchmaking = {"interval": float(args.matchmaking),
+                       "match_size": int(args.match_size),
+                       "max_wait": float(args.match_max_wait),
+                       "rating_spread": float(args.rating_spread),
+                       "spread_growth": float(args.rating_spread_growth)}
+    if args.directory is not None:
+        from cluster import ClusterRooms
+        host, port = args.directory.split(":")
+        rooms = ClusterRooms(int(args.room_capacity),
+                             (host, int(port)),
+                             {"host": args.advertise,
+                              "tcp_port": int(args.tcp_port),
+                              "udp_port": int(args.udp_port)},
+                             options,
+                             idle_timeout,
+                             empty_grace,
+                             player_limit,
+                             matchmaking)
+    elif int(args.workers) > 1:
+        from sharding import ShardedRooms
+        rooms = ShardedRooms(int(args.room_capacity),
+                             args.udp_port,
+                             int(args.workers),
+                             options,
+                             idle_timeout,
+                             empty_grace,
+                             player_limit,
+                             matchmaking)
+    else:
+        rooms = Rooms(int(args.room_capacity),
+                      options,
+                      idle_timeout,
+                      empty_grace,
+                      player_limit,
+                      matchmaking)
+    main_loop(args.tcp_port,
+              args.udp_port,
+              rooms,
+              args.mode,
+              float(args.loss),
+              int(args.stats_port),
+              args.snapshot,
+              float(args.snapshot_interval))
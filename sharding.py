@@ -0,0 +1,356 @@
+from multiprocessing import Process, Queue, Condition, Value
+from queue import Empty
+from threading import Lock
+from metrics import metrics
+from player import Player
+from rooms import Rooms, RoomNotFound
+
+
+class ShardedRooms(Rooms):
+
+    def __init__(self, capacity, udp_port, nb_workers, options=None,
+                 idle_timeout=None, empty_grace=None, player_limit=None,
+                 matchmaking=None):
+        """
+        Room directory of the tcp process, each room is relayed by
+        the worker process owning it (worker k listens on udp_port + k,
+        create and join wait for the worker without holding the registry
+        lock, see ShardWorker.wait).
+        Legacy clients (one-shot tcp connections) ignore the udp port
+        of the join answer and always send to udp_port : they only
+        create and join rooms of worker 0, joining a room of another
+        worker is refused
+        """
+        Rooms.__init__(self, capacity, options, idle_timeout, empty_grace,
+                       player_limit, matchmaking)
+        self.workers = [ShardWorker(capacity, int(udp_port) + index, player_limit,
+                                    self.instance, self.secret)
+                        for index in range(nb_workers)]
+        self.owners = {}
+        self.loads = [0] * nb_workers
+        #  Datagrams are counted by the workers : merged into the metrics
+        #  of this process when rendered
+        self.stats_lock = Lock()
+        metrics.collectors.append(self.collect_metrics)
+
+    def register(self, addr, udp_port, identifier=None, binary=False, sequenced=False,
+                 token=None):
+        """
+        Register player, propagate udp address (and protocol) changes
+        to workers
+        """
+        self.lock.acquire()
+        try:
+            known = addr in self.addresses or identifier in self.players
+            player = Rooms.register(self, addr, udp_port, identifier, binary, sequenced,
+                                    token)
+            if known:
+                for worker in self.workers:
+                    worker.send(("update",
+                                 player.identifier,
+                                 player.udp_addr,
+                                 player.binary,
+                                 player.sequenced))
+        finally:
+            self.lock.release()
+        return player
+
+    def create(self, room_name=None, identifier=None, options=None, session=None,
+               legacy=False):
+        """
+        Create a new room on the least loaded worker, or on worker 0
+        for legacy players (returns once the worker has it)
+        """
+        self.lock.acquire()
+        try:
+            identifier = Rooms.create(self, room_name, identifier, options, session)
+            owner = 0 if legacy else self.loads.index(min(self.loads))
+            self.owners[identifier] = owner
+            self.loads[owner] += 1
+            worker = self.workers[owner]
+            command = worker.send(("create",
+                                   identifier,
+                                   room_name,
+                                   self.rooms[identifier].options,
+                                   self.rooms[identifier].session))
+        finally:
+            self.lock.release()
+        worker.wait(command)
+        return identifier
+
+    def restore(self, players, rooms, secret=None):
+        """
+        Load a snapshot, spread the restored rooms and their players
+        over the workers
+        """
+        self.lock.acquire()
+        try:
+            restored = Rooms.restore(self, players, rooms, secret)
+            #  Not started yet : workers check bind tokens with this secret
+            for worker in self.workers:
+                worker.secret = self.secret
+            for identifier in restored:
+                room = self.rooms[identifier]
+                owner = self.loads.index(min(self.loads))
+                self.owners[identifier] = owner
+                self.loads[owner] += 1
+                worker = self.workers[owner]
+                worker.send(("create", identifier, room.name, room.options, room.session))
+                for player in list(room.players.values()):
+                    worker.send(("join", identifier, player.identifier, player.addr,
+                                 player.udp_addr[1], player.session, player.binary,
+                                 player.sequenced))
+        finally:
+            self.lock.release()
+        return restored
+
+    def schedule_room(self, room_id):
+        """
+        Tick rooms are ticked by their owner worker
+        """
+        pass
+
+    def join(self, player_identifier, room_id=None, legacy=False):
+        """
+        Add player to room, on the directory and on the owner worker
+        (returns once the worker relays the player datagrams)
+        """
+        self.lock.acquire()
+        try:
+            if room_id is None:
+                room_id = self.available_room(legacy)
+            if room_id is not None:
+                worker, command = self.add_member(player_identifier, room_id, legacy)
+        finally:
+            self.lock.release()
+        if room_id is None:
+            #  Created (and waited for) without holding the registry lock
+            room_id = self.create(legacy=legacy)
+            self.lock.acquire()
+            try:
+                worker, command = self.add_member(player_identifier, room_id, legacy)
+            finally:
+                self.lock.release()
+        worker.wait(command)
+        return room_id
+
+    def available_room(self, legacy=False):
+        """
+        First non-full room (of worker 0 for legacy players, whose
+        datagrams only reach it), None if there is none (registry lock
+        held by caller)
+        """
+        return next((room_id for room_id in self.available
+                     if not legacy or self.owners.get(room_id) == 0), None)
+
+    def add_member(self, player_identifier, room_id, legacy=False):
+        """
+        Add player to room on the directory and queue it on the owner
+        worker, return (worker, command) to wait for (registry lock held
+        by caller)
+        """
+        if legacy and self.owners.get(room_id, 0) != 0:
+            raise RoomNotFound()
+        room_id = Rooms.join(self, player_identifier, room_id)
+        player = self.players[player_identifier]
+        worker = self.workers[self.owners[room_id]]
+        command = worker.send(("join",
+                               room_id,
+                               player.identifier,
+                               player.addr,
+                               player.udp_addr[1],
+                               player.session,
+                               player.binary,
+                               player.sequenced))
+        return worker, command
+
+    def leave(self, player_identifier, room_id):
+        """
+        Remove a player from a room, on the directory and on the owner worker
+        """
+        self.lock.acquire()
+        try:
+            Rooms.leave(self, player_identifier, room_id)
+            self.workers[self.owners[room_id]].send(("leave",
+                                                     room_id,
+                                                     player_identifier))
+        finally:
+            self.lock.release()
+
+    def evict(self, player_identifier):
+        """
+        Forget a player, on the directory and on every worker
+        """
+        self.lock.acquire()
+        try:
+            Rooms.evict(self, player_identifier)
+            for worker in self.workers:
+                worker.send(("evict", player_identifier))
+        finally:
+            self.lock.release()
+
+    def remove_empty(self, now=None):
+        """
+        Delete empty rooms, on the directory and on their owner workers
+        """
+        self.lock.acquire()
+        try:
+            removed = Rooms.remove_empty(self, now)
+            for room_id in removed:
+                owner = self.owners.pop(room_id)
+                self.loads[owner] -= 1
+                self.workers[owner].send(("remove", room_id))
+        finally:
+            self.lock.release()
+        return removed
+
+    def collect_metrics(self):
+        """
+        Metrics exports of the workers answering within a second
+        """
+        self.stats_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                commands = [worker.send(("stats",)) for worker in self.workers]
+            finally:
+                self.lock.release()
+            exports = []
+            for worker, command in zip(self.workers, commands):
+                try:
+                    #  Answers to earlier requests which timed out are skipped
+                    number, exported = worker.results.get(timeout=1.0)
+                    while number < command:
+                        number, exported = worker.results.get(timeout=1.0)
+                    exports.append(exported)
+                except Empty:
+                    pass
+        finally:
+            self.stats_lock.release()
+        return exports
+
+    def endpoint(self, room_id):
+        """
+        Udp port of the worker relaying the room
+        """
+        return {"udp_port": self.workers[self.owners[room_id]].udp_port}
+
+
+class ShardWorker(Process):
+    def __init__(self, capacity, udp_port, player_limit=None, instance=None,
+                 secret=None):
+        """
+        Worker process relaying udp traffic of its own rooms
+        (limiting each player as the directory would, see Rooms,
+        reliable channels get the epochs the directory gave at register
+        from instance, bind requests are checked with the directory
+        secret)
+        """
+        Process.__init__(self)
+        self.daemon = True
+        self.capacity = capacity
+        self.udp_port = udp_port
+        self.player_limit = player_limit
+        self.instance = instance
+        self.secret = secret
+        self.queue = Queue()
+        self.results = Queue()
+        #  Commands sent (counted by the directory) and applied (counted
+        #  by the worker) : the queue is first in first out, so command n
+        #  is applied once applied reaches n
+        self.sent = 0
+        self.applied = Value("Q", 0, lock=False)
+        self.condition = Condition()
+
+    def send(self, command):
+        """
+        Queue a directory change, return its number (see wait)
+        """
+        self.sent += 1
+        self.queue.put(command)
+        return self.sent
+
+    def wait(self, command, timeout=1.0):
+        """
+        Wait until the worker applied the command numbered command
+        """
+        self.condition.acquire()
+        try:
+            self.condition.wait_for(lambda: self.applied.value >= command, timeout)
+        finally:
+            self.condition.release()
+
+    def run(self):
+        """
+        Serve udp and apply directory changes until stopped
+        """
+        from server import UdpServer, Ticker
+
+        #  Metrics of this process only, see ShardedRooms.collect_metrics
+        metrics.reset()
+        #  Rooms are removed by the directory, not reclaimed here
+        rooms = Rooms(self.capacity, player_limit=self.player_limit)
+        if self.instance is not None:
+            rooms.instance = self.instance
+        if self.secret is not None:
+            rooms.secret = self.secret
+        udp_server = UdpServer(self.udp_port, rooms)
+        ticker = Ticker(rooms, udp_server.sock)
+        udp_server.start()
+        ticker.start()
+        while True:
+            command = self.queue.get()
+            if command is None:
+                break
+            try:
+                self.apply(rooms, command)
+            except Exception as e:
+                print("Worker %d : %s failed (%s)" % (self.udp_port,
+                                                       command[0],
+                                                       repr(e)))
+            self.condition.acquire()
+            try:
+                self.applied.value += 1
+                self.condition.notify_all()
+            finally:
+                self.condition.release()
+        ticker.stop_listening()
+        udp_server.stop_listening()
+        udp_server.join()
+
+    def apply(self, rooms, command):
+        """
+        Mirror one directory change on the worker rooms
+        """
+        action = command[0]
+        if action == "create":
+            rooms.create(command[2], command[1], command[3], command[4])
+        elif action == "join":
+            room_id, identifier, addr, udp_port, session, binary, sequenced = command[1:]
+            if identifier not in rooms.players:
+                rooms.add_player(Player(addr, udp_port, identifier, session))
+            rooms.players[identifier].binary = binary
+            rooms.players[identifier].sequenced = sequenced
+            rooms.join(identifier, room_id)
+        elif action == "leave":
+            rooms.leave(command[2], command[1])
+        elif action == "remove":
+            rooms.remove(command[1])
+        elif action == "update":
+            player = rooms.players.get(command[1])
+            if player is not None:
+                player.udp_addr = command[2]
+                player.binary = command[3]
+                player.sequenced = command[4]
+                rooms.restart_channel(player)
+        elif action == "evict":
+            rooms.evict(command[1])
+        elif action == "stats":
+            #  Numbered as the directory numbered the command (see send)
+            self.results.put((self.applied.value + 1, metrics.export()))
+
+    def stop_listening(self):
+        """
+        Ask the worker to exit
+        """
+        self.queue.put(None)
@@ -0,0 +1,206 @@
+import gc
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from itertools import accumulate
+from metrics import SNAPSHOT_SECONDS
+from rooms import ROOM_OPTIONS
+
+#  Snapshot file : header (magic, players count, rooms count, save time,
+#  secret of the player tokens), then one section per column, each
+#  prefixed by its length. Numbers are packed little endian arrays,
+#  strings and options json lists. Snapshots of MAGIC_V1 have no secret
+MAGIC = b"SGS2"
+HEADER = struct.Struct("<4sIId32s")
+MAGIC_V1 = b"SGS1"
+HEADER_V1 = struct.Struct("<4sIId")
+LENGTH = struct.Struct("<Q")
+#  Player columns : session, protocol flags (BINARY, SEQUENCED), tcp
+#  port, udp port, identifier, tcp host
+PLAYER_COLUMNS = ("I", "B", "H", "H", None, None)
+BINARY = 1
+SEQUENCED = 2
+#  Room columns : session, capacity, members count, identifier, name,
+#  options, then the members sessions of every room one after another
+ROOM_COLUMNS = ("I", "I", "I", None, None, None)
+#  Entries copied per registry lock acquisition
+BATCH = 1000
+
+
+def player_fields(player):
+    """
+    Player record, in PLAYER_COLUMNS order
+    """
+    flags = (BINARY if player.binary else 0) | (SEQUENCED if player.sequenced else 0)
+    return (player.session, flags, player.addr[1], player.udp_addr[1],
+            player.identifier, player.addr[0])
+
+
+def room_fields(room):
+    """
+    Room record, in ROOM_COLUMNS order followed by the members sessions
+    """
+    return (room.session, room.capacity, len(room.players), room.identifier,
+            room.name, dict((option, room.options.get(option)) for option in ROOM_OPTIONS),
+            [player.session for player in room.players.values()])
+
+
+def capture(rooms, registry, fields):
+    """
+    Copy the fields of the entries of a registry dict of rooms, BATCH
+    entries per registry lock acquisition so tcp requests are never
+    held long (the relay path does not take this lock), return the
+    batches of records
+    """
+    rooms.lock.acquire()
+    try:
+        keys = list(registry)
+    finally:
+        rooms.lock.release()
+
+    batches = []
+    for start in range(0, len(keys), BATCH):
+        rooms.lock.acquire()
+        try:
+            batch = [fields(entry) for entry in map(registry.get, keys[start:start + BATCH])
+                     if entry is not None]
+        finally:
+            rooms.lock.release()
+        batches.append(batch)
+    return batches
+
+
+def pack(typecode, batches):
+    """
+    Encode a column from batches of values : packed array of typecode,
+    or json list (encoded batch by batch, a single huge json.dumps call
+    would hold the interpreter lock, stalling the relay threads)
+    """
+    if typecode is None:
+        chunks = [json.dumps(values)[1:-1] for values in batches if len(values) != 0]
+        return ("[%s]" % ", ".join(chunks)).encode()
+    column = array(typecode)
+    for values in batches:
+        column.extend(values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tobytes()
+
+
+def unpack(typecode, data):
+    """
+    Decode a column encoded by pack
+    """
+    if typecode is None:
+        return json.loads(data)
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def columns(typecodes, batches):
+    """
+    Encoded columns of batches of records (tuples of len(typecodes)
+    fields or more)
+    """
+    return [pack(typecode, [[record[index] for record in batch] for batch in batches])
+            for index, typecode in enumerate(typecodes)]
+
+
+def save(rooms, path):
+    """
+    Write a snapshot of the players and rooms of rooms to path : the
+    file is written aside then renamed, a crash never leaves a partial
+    snapshot behind. Return the number of (players, rooms) saved
+    """
+    start = time.perf_counter()
+    players = capture(rooms, rooms.players, player_fields)
+    room_records = capture(rooms, rooms.rooms, room_fields)
+    nb_players = sum(len(batch) for batch in players)
+    nb_rooms = sum(len(batch) for batch in room_records)
+
+    sections = columns(PLAYER_COLUMNS, players)
+    sections.extend(columns(ROOM_COLUMNS, room_records))
+    sections.append(pack("I", [[member for record in batch for member in record[-1]]
+                               for batch in room_records]))
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as snapshot:
+        snapshot.write(HEADER.pack(MAGIC, nb_players, nb_rooms, time.time(), rooms.secret))
+        for section in sections:
+            snapshot.write(LENGTH.pack(len(section)))
+            snapshot.write(section)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary, path)
+    SNAPSHOT_SECONDS.observe(time.perf_counter() - start)
+    return nb_players, nb_rooms
+
+
+def read(path):
+    """
+    Decode a snapshot (mapped in memory, not read) : (players, rooms,
+    saved at, secret), see Rooms.restore for players, rooms and secret
+    """
+    with open(path, "rb") as snapshot:
+        data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[:4] == MAGIC_V1:
+            header = HEADER_V1
+            magic, nb_players, nb_rooms, saved_at = header.unpack_from(data)
+            secret = None
+        else:
+            header = HEADER
+            magic, nb_players, nb_rooms, saved_at, secret = header.unpack_from(data)
+        if magic != MAGIC and magic != MAGIC_V1:
+            raise ValueError("Not a snapshot : %s" % path)
+        offset = header.size
+        sections = []
+        for typecode in PLAYER_COLUMNS + ROOM_COLUMNS + ("I",):
+            length, = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+            if offset + length > len(data):
+                raise ValueError("Truncated snapshot : %s" % path)
+            sections.append(unpack(typecode, data[offset:offset + length]))
+            offset += length
+    except struct.error:
+        raise ValueError("Truncated snapshot : %s" % path)
+    finally:
+        data.close()
+
+    sessions, flags, tcp_ports, udp_ports, identifiers, hosts = sections[:6]
+    players = list(zip(identifiers, sessions, [bool(flag & BINARY) for flag in flags],
+                       zip(hosts, tcp_ports), udp_ports,
+                       [bool(flag & SEQUENCED) for flag in flags]))
+    (room_sessions, capacities, counts, room_identifiers, names, options,
+     members) = sections[6:]
+    room_members = [members[end - count:end]
+                    for end, count in zip(accumulate(counts), counts)]
+    room_entries = list(zip(room_identifiers, names, capacities, room_sessions,
+                            options, room_members))
+    if len(players) != nb_players or len(room_entries) != nb_rooms:
+        raise ValueError("Corrupt snapshot : %s" % path)
+    return players, room_entries, saved_at, secret
+
+
+def load(rooms, path):
+    """
+    Restore the players and rooms of a snapshot into empty rooms,
+    return the number of (players, rooms) restored
+    """
+    #  Every object created here lives on : collecting meanwhile is wasted
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        players, room_entries, saved_at, secret = read(path)
+        rooms.restore(players, room_entries, secret)
+    finally:
+        if enabled:
+            gc.enable()
+    return len(players), len(room_entries)
@@ -0,0 +1,95 @@
+class TimerWheel:
+
+    def __init__(self, now, resolution=1.0, slots=64, levels=3):
+        """
+        Hierarchical timer wheel : level 0 has one slot per resolution
+        step, each slot of level n covers a full turn of level n - 1,
+        timers cascade down a level when their slot comes up
+
+        Scheduling and cancelling are O(1), advancing is O(1) per
+        step plus the timers expiring or cascading
+        """
+        self.resolution = float(resolution)
+        self.slots = slots
+        self.levels = [[{} for slot in range(slots)] for level in range(levels)]
+        self.current = int(now / self.resolution)
+        self.timers = {}
+
+    def schedule(self, key, deadline):
+        """
+        Fire key at deadline (replacing its previous timer)
+        """
+        self.cancel(key)
+        self.place(key, max(int(deadline / self.resolution), self.current + 1))
+
+    def cancel(self, key):
+        """
+        Forget the timer of key
+        """
+        position = self.timers.pop(key, None)
+        if position is not None:
+            level, slot = position
+            del self.levels[level][slot][key]
+
+    def schedule_all(self, keys, deadline):
+        """
+        Fire keys which have no timer yet at the same deadline (one slot
+        lookup for all of them)
+        """
+        step = max(int(deadline / self.resolution), self.current + 1)
+        level, slot = self.position(step)
+        self.levels[level][slot].update(dict.fromkeys(keys, step))
+        self.timers.update(dict.fromkeys(keys, (level, slot)))
+
+    def place(self, key, step):
+        """
+        Put a timer in the lowest level whose current turn holds its step
+        (timers beyond the last level turn wait there and cascade again)
+        """
+        level, slot = self.position(step)
+        self.levels[level][slot][key] = step
+        self.timers[key] = (level, slot)
+
+    def position(self, step):
+        """
+        Level and slot of a timer firing at step
+        """
+        span = 1
+        for level in range(len(self.levels)):
+            if step // (span * self.slots) == self.current // (span * self.slots):
+                break
+            if level == len(self.levels) - 1:
+                break
+            span *= self.slots
+        return level, (step // span) % self.slots
+
+    def advance(self, now):
+        """
+        Move the wheel to now, return the keys whose timer expired
+        """
+        expired = []
+        target = int(now / self.resolution)
+        while self.current < target:
+            self.current += 1
+            span = self.slots
+            for level in range(1, len(self.levels)):
+                if self.current % span != 0:
+                    break
+                slot = (self.current // span) % self.slots
+                timers = self.levels[level][slot]
+                self.levels[level][slot] = {}
+                for key, step in timers.items():
+                    del self.timers[key]
+                    self.place(key, step)
+                span *= self.slots
+
+            slot = self.current % self.slots
+            timers = self.levels[0][slot]
+            self.levels[0][slot] = {}
+            for key, step in timers.items():
+                del self.timers[key]
+                expired.append(key)
+        return expired
+
+    def __len__(self):
+        return len(self.timers)
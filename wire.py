@@ -0,0 +1,159 @@
+import json
+import struct
+
+#  Binary datagrams start with MAGIC (json ones start with "{")
+MAGIC = 0xB1
+PREFIX = bytes([MAGIC])
+#  Relayed fragments of a large message (see fragments)
+FRAGMENT_MAGIC = 0xB2
+FRAGMENT_PREFIX = bytes([FRAGMENT_MAGIC])
+
+#  Request flags : sendto (recipients follow the header), position follows,
+#  the message is a fragment (message id, index and count follow)
+SENDTO = 1
+POSITION = 2
+FRAGMENT = 4
+
+#  Player request : magic, flags, player session, room session, seq (0 for
+#  none), recipients count, then recipients sessions, position and the
+#  json message relayed as is
+REQUEST = struct.Struct("!BBIIIH")
+RECIPIENT = struct.Struct("!I")
+COORDINATES = struct.Struct("!ff")
+FRAGMENT_INFO = struct.Struct("!IHH")
+
+#  Relayed datagram : magic, entries count, then for each entry sender
+#  session, seq (0 for none), message length and json message
+RELAY = struct.Struct("!BH")
+ENTRY = struct.Struct("!IIH")
+
+#  Relayed fragment : magic, sender session, seq, message id, index and
+#  count, then the fragment bytes
+RELAY_FRAGMENT = struct.Struct("!BIIIHH")
+
+#  Relayed json messages are decoded to check them (the value is thrown
+#  away, they are still relayed as is), see single_value
+DECODER = json.JSONDecoder()
+WHITESPACE = " \t\n\r"
+
+
+def single_value(payload):
+    """
+    Check that a json message relayed as is holds exactly one json
+    value : it is spliced in the {sender: message} envelopes, so
+    anything else could forge messages of other players or break the
+    envelopes gathering several messages. The message is fully decoded
+    (about 2.5 us for 60 bytes, 24 us for 850 bytes), the C decoder
+    beating any scanner written in python
+    """
+    try:
+        text = payload.decode()
+        start = len(text) - len(text.lstrip(WHITESPACE))
+        value, end = DECODER.raw_decode(text, start)
+    except (UnicodeDecodeError, ValueError):
+        return False
+    return text[end:].strip(WHITESPACE) == ""
+
+
+def valid_fragment(fragment):
+    """
+    Check the [message id, index, count] of a fragment given in a json
+    header fits the relayed fragment header (index below count)
+    """
+    if not isinstance(fragment, (list, tuple)) or len(fragment) != 3:
+        return False
+    if any(not isinstance(value, int) or isinstance(value, bool) for value in fragment):
+        return False
+    message_id, index, count = fragment
+    return 0 <= message_id < 1 << 32 and 0 <= index < count < 1 << 16
+
+
+def encode_request(player_session, room_session, seq, payload,
+                   recipients=None, position=None, fragment=None):
+    """
+    Build a binary send (or sendto when recipients sessions are given,
+    fragment is the (message id, index, count) of a fragment payload)
+    """
+    flags = 0
+    parts = []
+    if recipients is not None:
+        flags |= SENDTO
+        parts.extend(RECIPIENT.pack(recipient) for recipient in recipients)
+    else:
+        recipients = ()
+    if position is not None:
+        flags |= POSITION
+        parts.append(COORDINATES.pack(position[0], position[1]))
+    if fragment is not None:
+        flags |= FRAGMENT
+        parts.append(FRAGMENT_INFO.pack(*fragment))
+    header = REQUEST.pack(MAGIC, flags, player_session, room_session,
+                          seq or 0, len(recipients))
+    return header + b"".join(parts) + payload
+
+
+def decode_request(data):
+    """
+    Split a binary request : (player session, room session, seq,
+    recipients sessions or None, position or None, fragment or None,
+    payload)
+    """
+    magic, flags, player_session, room_session, seq, count = REQUEST.unpack_from(data)
+    offset = REQUEST.size
+    recipients = None
+    if flags & SENDTO:
+        recipients = [RECIPIENT.unpack_from(data, offset + index * RECIPIENT.size)[0]
+                      for index in range(count)]
+        offset += count * RECIPIENT.size
+    position = None
+    if flags & POSITION:
+        position = COORDINATES.unpack_from(data, offset)
+        offset += COORDINATES.size
+    fragment = None
+    if flags & FRAGMENT:
+        fragment = FRAGMENT_INFO.unpack_from(data, offset)
+        offset += FRAGMENT_INFO.size
+    return (player_session, room_session, seq or None, recipients, position,
+            fragment, data[offset:])
+
+
+def encode_relay(entries):
+    """
+    Build a binary relayed datagram from (session, json payload, seq)
+    """
+    parts = [RELAY.pack(MAGIC, len(entries))]
+    for session, payload, seq in entries:
+        parts.append(ENTRY.pack(session, seq or 0, len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def decode_relay(data):
+    """
+    Split a binary relayed datagram into (session, json payload, seq)
+    """
+    magic, count = RELAY.unpack_from(data)
+    offset = RELAY.size
+    entries = []
+    for index in range(count):
+        session, seq, length = ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        entries.append((session, data[offset:offset + length], seq or None))
+        offset += length
+    return entries
+
+
+def encode_fragment(session, seq, fragment, payload):
+    """
+    Build a binary relayed fragment ((message id, index, count) fragment)
+    """
+    return RELAY_FRAGMENT.pack(FRAGMENT_MAGIC, session, seq or 0, *fragment) + payload
+
+
+def decode_fragment(data):
+    """
+    Split a binary relayed fragment : (session, seq, message id, index,
+    count, payload)
+    """
+    magic, session, seq, message_id, index, count = RELAY_FRAGMENT.unpack_from(data)
+    return session, seq or None, message_id, index, count, data[RELAY_FRAGMENT.size:]